@@ -0,0 +1,81 @@
+import json
+import time
+import random
+import asyncio
+
+import numpy as np
+
+from utils import load_ids
+
+
+async def post(host, port, path, payload):
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(payload).encode('utf-8')
+    writer.write(b'POST %s HTTP/1.1\r\nHost: %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n'
+                 % (path.encode('latin-1'), host.encode('latin-1'), len(body)) + body)
+    await writer.drain()
+
+    response = await reader.read()
+    writer.close()
+
+    head, _, body = response.partition(b'\r\n\r\n')
+    status = int(head.split()[1])
+    return status, json.loads(body)
+
+
+async def run(args, sentences):
+    '''
+    open loop load: requests are sent at Poisson arrival times of the given rate, whether or not the previous ones
+    were answered, and the latency of each is measured from its own send time
+    '''
+    latencies, errors = [], 0
+    semaphore = asyncio.Semaphore(args.max_connections)
+
+    async def send(ids):
+        nonlocal errors
+        async with semaphore:
+            start_time = time.perf_counter()
+            status, _ = await post(args.host, args.port, '/translate', dict(ids=ids))
+            if status == 200:
+                latencies.append(time.perf_counter() - start_time)
+            else:
+                errors += 1
+
+    tasks = []
+    start_time = time.perf_counter()
+
+    for ids in sentences:
+        tasks.append(asyncio.create_task(send(ids)))
+        if args.rate > 0:
+            await asyncio.sleep(random.expovariate(args.rate))
+
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start_time
+
+    latencies = 1000 * np.array(latencies)
+    print('%d sentences in %.1fs, %d errors' % (len(sentences), elapsed, errors))
+    print('throughput = %.2f sentences / s' % (len(latencies) / elapsed))
+    print('latency p50 = %.1f ms | p99 = %.1f ms | max = %.1f ms' % (
+        np.percentile(latencies, 50), np.percentile(latencies, 99), latencies.max()))
+
+
+def main(args):
+    random.seed(args.seed)
+    sentences = [ids.tolist() for ids in load_ids(args.src)]
+    sentences = random.sample(sentences, min(args.num_sentences, len(sentences)))
+    asyncio.run(run(args, sentences))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='load generator for the translation server (serve.py)')
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--src", help="source ids to translate", default='dataset/nl/wmt17_en_de/valid.en.ids.gz')
+    parser.add_argument("--num_sentences", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=20., help="requests per second, 0 sends them all at once")
+    parser.add_argument("--max_connections", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+
+    main(parser.parse_args())
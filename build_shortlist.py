@@ -0,0 +1,46 @@
+import json
+import time
+
+from model.shortlist import build_shortlist, Shortlist
+from utils import load_ids, epoch_time
+
+
+def main(args):
+    '''
+    Builds the lexical shortlist used to restrict the output projection at decoding time, from source / target
+    co-occurrences in the training corpus.
+    '''
+    start_time = time.time()
+
+    with open('dataset/nl/wmt17_en_de/vocabulary.json', 'r') as f:
+        vocabulary = json.load(f)
+
+    sources, targets = load_ids(args.src), load_ids(args.tgt)
+    assert len(sources) == len(targets), 'source and target corpora must be aligned'
+
+    if args.num_sentences is not None and args.num_sentences < len(sources):
+        print('using the first %d of the %d sentence pairs' % (args.num_sentences, len(sources)))
+        sources, targets = sources[:args.num_sentences], targets[:args.num_sentences]
+
+    shortlist = Shortlist(**build_shortlist(sources, targets, len(vocabulary), topk=args.topk,
+                                            num_frequent=args.num_frequent))
+    shortlist.save(args.output)
+
+    sizes = shortlist.indptr[1:] - shortlist.indptr[:-1]
+    mins, secs = epoch_time(start_time, time.time())
+    print('%d sentence pairs | %d frequent tokens | %.1f candidates per source token | %dm %ds' % (
+        len(sources), len(shortlist.frequent), sizes[sizes > 0].mean(), mins, secs))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='lexical shortlist from the co-occurrences of the training corpus')
+    parser.add_argument("--src", default='dataset/nl/wmt17_en_de/train.en.ids.gz')
+    parser.add_argument("--tgt", default='dataset/nl/wmt17_en_de/train.de.ids.gz')
+    parser.add_argument("--output", default='output/shortlist.npz')
+    parser.add_argument("--num_sentences", type=int, default=None, help="first sentence pairs used, all by default")
+    parser.add_argument("--topk", type=int, default=50, help="target tokens kept per source token")
+    parser.add_argument("--num_frequent", type=int, default=1000, help="most frequent target tokens, always candidates")
+
+    main(parser.parse_args())
@@ -0,0 +1,276 @@
+import os
+import gzip
+import json
+import time
+import multiprocessing
+
+import torch
+
+from model.checkpoint import load_weights, atomic_save
+from utils import build_seq2seq
+from translate import open_text, parse_line, translate_window, SOS_TOKEN, EOS_TOKEN
+
+# layout of the output directory:
+# manifest.json                   the shards of the input, written once the input is split
+# source/shard-00000.ids.gz       source ids of every shard, one sentence per line with sos / eos, as the dataset files
+# translations/shard-00000.ids.gz translations of a shard, line by line, in the same format
+# translations/shard-00000.json   throughput of a shard, written after its translations: a shard is done when it exists
+# every file is written next to its destination and renamed, a crash never leaves a partial shard behind
+
+SHARD_NAME = 'shard-%05d'
+
+
+def write_ids(lines, f):
+    # mtime 0, so a shard written twice is identical
+    with gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as out:
+        out.write(''.join(' '.join(map(str, ids)) + '\n' for ids in lines).encode('utf-8'))
+
+
+def write_json(obj, f):
+    f.write(json.dumps(obj, indent=2).encode('utf-8'))
+
+
+def read_ids(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return [[int(x) for x in line.split()] for line in f]
+
+
+def shard_paths(output_dir, shard):
+    name = SHARD_NAME % shard
+    return (os.path.join(output_dir, 'source', name + '.ids.gz'),
+            os.path.join(output_dir, 'translations', name + '.ids.gz'),
+            os.path.join(output_dir, 'translations', name + '.json'))
+
+
+# splitting
+
+def split(args, vocabulary):
+    '''
+    Splits the input into shards of `shard_size` sentences, streamed so the input is never held in memory, and
+    writes the manifest once all of them are on disk. A manifest left by an earlier run is reused as is, after checking
+    that it was made from the same input with the same shard size.
+    '''
+    manifest_path = os.path.join(args.output_dir, 'manifest.json')
+    settings = dict(input=os.path.abspath(args.input), input_format=args.input_format, shard_size=args.shard_size)
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+
+        assert all(manifest[key] == value for key, value in settings.items()), \
+            '%s was made from another input or shard size, use a new output directory' % manifest_path
+        return manifest
+
+    os.makedirs(os.path.join(args.output_dir, 'source'), exist_ok=True)
+    os.makedirs(os.path.join(args.output_dir, 'translations'), exist_ok=True)
+
+    shards, lines = [], []
+
+    def flush():
+        atomic_save(lines, shard_paths(args.output_dir, len(shards))[0], save_fn=write_ids)
+        shards.append(len(lines))
+        lines.clear()
+
+    with open_text(args.input, 'rt') as f:
+        for line in f:
+            lines.append(parse_line(line, args.input_format, vocabulary))
+            if len(lines) == args.shard_size:
+                flush()
+
+    if len(lines) > 0:
+        flush()
+
+    manifest = dict(settings, shards=shards, sentences=sum(shards))
+    atomic_save(manifest, manifest_path, save_fn=write_json)
+    return manifest
+
+
+def pending_shards(manifest, output_dir):
+    return [shard for shard in range(len(manifest['shards'])) if not os.path.exists(shard_paths(output_dir, shard)[2])]
+
+
+# translation of a shard
+
+def load_model(args, num_tokens, device):
+    torch.set_num_threads(args.threads)
+
+    model = build_seq2seq(num_tokens)
+    load_weights(model, args.checkpoint)
+    return model.to(device).eval()
+
+
+def translate_shard(model, shard, args, device, worker):
+    source_path, translation_path, record_path = shard_paths(args.output_dir, shard)
+    max_src_len = model.encoder.max_seq_len
+
+    sources = [ids[:max_src_len] for ids in read_ids(source_path)]
+
+    start_time = time.perf_counter()
+    translations = translate_window(model, sources, args.max_len, args.max_batch_tokens, args.max_batch_size, device)
+    elapsed = time.perf_counter() - start_time
+
+    # empty sources stay empty lines, to keep the shards aligned with the input
+    lines = [[SOS_TOKEN] + ids + [EOS_TOKEN] if len(src) > 0 else [] for src, ids in zip(sources, translations)]
+    atomic_save(lines, translation_path, save_fn=write_ids)
+
+    record = dict(shard=shard, worker=worker, sentences=len(sources), source_tokens=sum(map(len, sources)),
+                  output_tokens=sum(map(len, translations)), seconds=elapsed)
+    atomic_save(record, record_path, save_fn=write_json)
+    return record
+
+
+def report(record, done, total, start_time):
+    elapsed = time.perf_counter() - start_time
+    print('shard %d (worker %d) | %.1f sentences / s | %.0f output tokens / s | %d / %d done in %.0f s' % (
+        record['shard'], record['worker'], record['sentences'] / max(record['seconds'], 1e-9),
+        record['output_tokens'] / max(record['seconds'], 1e-9), done, total, elapsed), flush=True)
+
+
+# worker processes
+
+WORKER = dict()
+
+
+def init_worker(args, num_tokens):
+    worker = multiprocessing.current_process()._identity[0] - 1
+    WORKER.update(args=args, worker=worker, model=load_model(args, num_tokens, torch.device(args.device)))
+
+
+def run_worker(shard):
+    return translate_shard(WORKER['model'], shard, WORKER['args'], torch.device(WORKER['args'].device),
+                           WORKER['worker'])
+
+
+def translate_with_workers(args, num_tokens, pending, total):
+    # shards are handed to the next free worker, each worker loads its own copy of the model
+    done = total - len(pending)
+    start_time = time.perf_counter()
+
+    if args.workers == 1:
+        model = load_model(args, num_tokens, torch.device(args.device))
+        for shard in pending:
+            done += 1
+            report(translate_shard(model, shard, args, torch.device(args.device), 0), done, total, start_time)
+        return
+
+    with multiprocessing.get_context('spawn').Pool(args.workers, initializer=init_worker,
+                                                   initargs=(args, num_tokens)) as pool:
+        for record in pool.imap_unordered(run_worker, pending):
+            done += 1
+            report(record, done, total, start_time)
+
+
+def translate_with_accelerate(args, num_tokens, vocabulary):
+    # one process per device under accelerate launch, rank r translates every num_processes-th pending shard
+    from accelerate import Accelerator
+
+    accelerator = Accelerator()
+
+    if accelerator.is_main_process:
+        split(args, vocabulary)
+    accelerator.wait_for_everyone()
+
+    manifest = split(args, vocabulary)
+    pending = pending_shards(manifest, args.output_dir)
+    mine = pending[accelerator.process_index::accelerator.num_processes]
+
+    model = load_model(args, num_tokens, accelerator.device)
+    start_time = time.perf_counter()
+
+    print('rank %d: %d of the %d shards left to translate' % (accelerator.process_index, len(mine), len(pending)),
+          flush=True)
+
+    for done, shard in enumerate(mine):
+        record = translate_shard(model, shard, args, accelerator.device, accelerator.process_index)
+        report(record, done + 1, len(mine), start_time)
+
+    accelerator.wait_for_everyone()
+    return manifest, accelerator.is_main_process
+
+
+# summary and merging
+
+def summarize(manifest, output_dir, elapsed):
+    records = []
+    for shard in range(len(manifest['shards'])):
+        record_path = shard_paths(output_dir, shard)[2]
+        if os.path.exists(record_path):
+            with open(record_path, 'r') as f:
+                records.append(json.load(f))
+
+    sentences = sum(record['sentences'] for record in records)
+    output_tokens = sum(record['output_tokens'] for record in records)
+    decoding = sum(record['seconds'] for record in records)
+
+    print('%d / %d shards, %d / %d sentences translated' % (len(records), len(manifest['shards']), sentences,
+                                                             manifest['sentences']))
+    print('decoding: %.1f sentences / s, %.0f output tokens / s per worker' % (
+        sentences / max(decoding, 1e-9), output_tokens / max(decoding, 1e-9)))
+    print('this run: %.1f s wall clock' % elapsed)
+
+    return len(records) == len(manifest['shards'])
+
+
+def merge(manifest, output_dir, path):
+    # gzip members can be concatenated, the shards are copied as they are into one file of the whole corpus
+    def save_fn(_, f):
+        for shard in range(len(manifest['shards'])):
+            with open(shard_paths(output_dir, shard)[1], 'rb') as shard_file:
+                f.write(shard_file.read())
+
+    atomic_save(None, path, save_fn=save_fn)
+    print('translations of the %d sentences written to %s' % (manifest['sentences'], path))
+
+
+def main(args):
+    '''
+    Translates a large corpus, for back-translation: the input (token ids as in the dataset files, or BPE tokens) is
+    split into shards, every shard is decoded greedily in length sorted batches by one of `workers` processes, or by
+    the ranks of accelerate launch with --accelerate, and its translations are written in the id format of the dataset
+    files, one line per input line. A shard only counts as done once its translations are on disk, so a run that
+    crashed or was killed picks up from the remaining shards when restarted with the same arguments. With --merge, the
+    shards are concatenated into a single file once all of them are done.
+    '''
+    with open(args.vocabulary, 'r') as f:
+        vocabulary = json.load(f)
+
+    start_time = time.perf_counter()
+
+    if args.accelerate:
+        manifest, is_main_process = translate_with_accelerate(args, len(vocabulary), vocabulary)
+        if not is_main_process:
+            return
+    else:
+        manifest = split(args, vocabulary)
+        pending = pending_shards(manifest, args.output_dir)
+        print('%d sentences in %d shards, %d left to translate' % (manifest['sentences'], len(manifest['shards']),
+                                                                   len(pending)), flush=True)
+        translate_with_workers(args, len(vocabulary), pending, len(manifest['shards']))
+
+    complete = summarize(manifest, args.output_dir, time.perf_counter() - start_time)
+
+    if complete and args.merge is not None:
+        merge(manifest, args.output_dir, args.merge)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='sharded, resumable translation of a corpus for back-translation')
+    parser.add_argument("--checkpoint", help="model weights", default='output/model_seq2seq.weights')
+    parser.add_argument("--vocabulary", default='dataset/nl/wmt17_en_de/vocabulary.json')
+    parser.add_argument("--input", help="input file, gzip if it ends in .gz", required=True)
+    parser.add_argument("--input_format", choices=['bpe', 'ids'], default='ids',
+                        help="BPE tokens or token ids (as in the dataset files) per line")
+    parser.add_argument("--output_dir", help="shards, manifest and translations, reused to resume", required=True)
+    parser.add_argument("--merge", default=None, help="file (.ids.gz) of all the translations, once every shard is done")
+    parser.add_argument("--shard_size", type=int, default=100000, help="sentences per shard")
+    parser.add_argument("--workers", type=int, default=1, help="decoding processes, each with its own model")
+    parser.add_argument("--accelerate", action='store_true', help="one process per device, under accelerate launch")
+    parser.add_argument("--max_batch_tokens", type=int, default=4096, help="padded source tokens per batch")
+    parser.add_argument("--max_batch_size", type=int, default=128)
+    parser.add_argument("--max_len", type=int, default=120)
+    parser.add_argument("--device", default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--threads", type=int, default=4, help="torch threads per worker")
+
+    main(parser.parse_args())
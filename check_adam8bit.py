@@ -0,0 +1,125 @@
+import json
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from model.optimizer import get_optimizer
+from model.xtransformer import XTransformer
+from utils import load_ids, PackedTextDataset, PackedCollate
+
+PAD_IDX = 3
+
+
+def build_model(num_tokens, args):
+    return XTransformer(dim=args.dim, tie_token_embeds=True, return_tgt_loss=True, enc_num_tokens=num_tokens,
+                        enc_depth=args.depth, enc_heads=args.heads, enc_max_seq_len=args.max_len,
+                        dec_num_tokens=num_tokens, dec_depth=args.depth, dec_heads=args.heads,
+                        dec_max_seq_len=args.max_len)
+
+
+def optimizer_state_bytes(optimizer):
+    return sum(t.numel() * t.element_size() for state in optimizer.state.values() for t in state.values()
+               if torch.is_tensor(t))
+
+
+@torch.no_grad()
+def evaluate(model, loader):
+    model.eval()
+    losses = [model(src, tgt, mask_src=mask_src).item() for src, tgt, mask_src in loader]
+    model.train()
+    return np.mean(losses)
+
+
+def train(name, initial_state, train_dataset, dev_loader, num_tokens, args):
+    model = build_model(num_tokens, args)
+    model.load_state_dict(initial_state)
+    optimizer = get_optimizer(model.parameters(), args.lr, wd=0.01, eight_bit=name == '8 bit AdamW')
+
+    # same shuffling for both optimizers
+    generator = torch.Generator().manual_seed(0)
+    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, generator=generator,
+                              collate_fn=PackedCollate(train_dataset, pad_idx=PAD_IDX))
+
+    torch.manual_seed(0)
+    losses, step, elapsed = [], 0, 0.
+
+    while step < args.steps:
+        for src, tgt, mask_src in train_loader:
+            start_time = time.perf_counter()
+            loss = model(src, tgt, mask_src=mask_src)
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
+            optimizer.step()
+            optimizer.zero_grad()
+            elapsed += time.perf_counter() - start_time
+
+            losses.append(loss.item())
+            step += 1
+
+            if step % args.report_every == 0:
+                print('%s | step %d | train loss %.4f' % (name, step, np.mean(losses[-args.report_every:])))
+
+            if step == args.steps:
+                break
+
+    return dict(train_loss=np.mean(losses[-args.report_every:]), dev_loss=evaluate(model, dev_loader),
+                state_bytes=optimizer_state_bytes(optimizer), ms_per_step=1000 * elapsed / args.steps)
+
+
+def main(args):
+    '''
+    Trains the same small model from the same initialization on the same batches of a WMT subset, with AdamW and with
+    the 8 bit AdamW of model/adam8bit.py, and compares the losses and the memory of the optimizer states.
+    '''
+    torch.set_num_threads(args.threads)
+
+    with open(args.vocabulary, 'r') as f:
+        num_tokens = len(json.load(f))
+
+    X_train, Y_train = load_ids(args.src)[:args.num_sentences], load_ids(args.tgt)[:args.num_sentences]
+    X_dev, Y_dev = load_ids(args.dev_src)[:args.num_dev], load_ids(args.dev_tgt)[:args.num_dev]
+
+    train_dataset = PackedTextDataset(X_train, Y_train, args.max_len)
+    dev_dataset = PackedTextDataset(X_dev, Y_dev, args.max_len)
+    dev_loader = DataLoader(dev_dataset, batch_size=args.batch_size, collate_fn=PackedCollate(dev_dataset, PAD_IDX))
+
+    torch.manual_seed(0)
+    initial_state = build_model(num_tokens, args).state_dict()
+
+    results = {name: train(name, initial_state, train_dataset, dev_loader, num_tokens, args)
+               for name in ('AdamW', '8 bit AdamW')}
+
+    for name, result in results.items():
+        print('%s | train loss %.4f | dev loss %.4f | optimizer state %.1f MB | %.0f ms / step' % (
+            name, result['train_loss'], result['dev_loss'], result['state_bytes'] / 2 ** 20, result['ms_per_step']))
+
+    reference, quantized = results['AdamW'], results['8 bit AdamW']
+    print('dev loss delta = %.4f, optimizer state %.1f%% smaller' % (
+        quantized['dev_loss'] - reference['dev_loss'], 100 * (1 - quantized['state_bytes'] / reference['state_bytes'])))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='convergence of 8 bit AdamW against AdamW on a WMT subset')
+    parser.add_argument("--src", type=str, default='dataset/nl/wmt17_en_de/train.en.ids.gz')
+    parser.add_argument("--tgt", type=str, default='dataset/nl/wmt17_en_de/train.de.ids.gz')
+    parser.add_argument("--dev_src", type=str, default='dataset/nl/wmt17_en_de/valid.en.ids.gz')
+    parser.add_argument("--dev_tgt", type=str, default='dataset/nl/wmt17_en_de/valid.de.ids.gz')
+    parser.add_argument("--vocabulary", type=str, default='dataset/nl/wmt17_en_de/vocabulary.json')
+    parser.add_argument("--num_sentences", type=int, default=20000)
+    parser.add_argument("--num_dev", type=int, default=500)
+    parser.add_argument("--steps", type=int, default=1000)
+    parser.add_argument("--report_every", type=int, default=100)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--max_len", type=int, default=64)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--heads", type=int, default=4)
+    parser.add_argument("--lr", type=float, default=5e-4)
+    parser.add_argument("--clip", type=float, default=1.)
+    parser.add_argument("--threads", type=int, default=1)
+
+    main(parser.parse_args())
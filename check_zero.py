@@ -0,0 +1,178 @@
+import os
+import copy
+import tempfile
+import contextlib
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+from model.optimizer import get_optimizer
+from model.xtransformer import XTransformer, AttentionLayers
+
+PAD_IDX = 3
+
+
+def build_model(num_tokens):
+    model = XTransformer(dim=64, tie_token_embeds=True, return_tgt_loss=True, enc_num_tokens=num_tokens, enc_depth=2,
+                         enc_heads=4, enc_max_seq_len=32, dec_num_tokens=num_tokens, dec_depth=2, dec_heads=4,
+                         dec_max_seq_len=32)
+
+    # without any kind of dropout, so every run computes the same gradients
+    for module in model.modules():
+        if isinstance(module, torch.nn.Dropout):
+            module.p = 0.
+        if isinstance(module, AttentionLayers):
+            module.layer_dropouts = (0.,) * len(module.layer_dropouts)
+            module.cross_attn_tokens_dropout = 0.
+
+    return model
+
+
+def make_batches(args):
+    # one list of per rank batches per step
+    generator = torch.Generator().manual_seed(1)
+    batches = []
+    for _ in range(args.steps):
+        src = torch.randint(4, args.num_tokens, (args.world_size, args.batch_size, 20), generator=generator)
+        tgt = torch.randint(4, args.num_tokens, (args.world_size, args.batch_size, 16), generator=generator)
+        batches.append(list(zip(src, tgt)))
+    return batches
+
+
+def gradients_synchronized(model):
+    # whether every rank holds the same gradients, as after the all-reduce of DistributedDataParallel
+    local = torch.stack([p.grad.float().sum() if p.grad is not None else torch.zeros(()) for p in model.parameters()])
+    gathered = [torch.zeros_like(local) for _ in range(dist.get_world_size())]
+    dist.all_gather(gathered, local)
+    return all(torch.equal(gathered[0], other) for other in gathered[1:])
+
+
+def train_step(model, optimizer, src, tgt, clip, sharded, no_sync=False):
+    # DistributedDataParallel prepares its all-reduce in the forward pass, no_sync must cover it as well as backward
+    with model.no_sync() if no_sync else contextlib.nullcontext():
+        loss = model(src, tgt, mask_src=src != PAD_IDX)
+        loss.backward()
+
+    if no_sync:
+        # the ranks train on different batches, their local gradients differ until the optimizer reduces them
+        assert not gradients_synchronized(model), 'gradients were all-reduced by DistributedDataParallel under no_sync'
+
+    if sharded:
+        optimizer.clip_grad_norm_(clip)
+    else:
+        torch.nn.utils.clip_grad_norm_(model.parameters(), clip)
+
+    optimizer.step()
+    optimizer.zero_grad()
+
+
+def reference(args, initial_state, batches):
+    # single process AdamW on the average of the per rank losses, which is what DistributedDataParallel optimizes
+    model = build_model(args.num_tokens)
+    model.load_state_dict(initial_state)
+    optimizer = get_optimizer(list(model.parameters()), args.lr, wd=0.01)
+
+    states = []
+    for step, ranks in enumerate(batches):
+        loss = sum(model(src, tgt, mask_src=src != PAD_IDX) for src, tgt in ranks) / len(ranks)
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
+        optimizer.step()
+        optimizer.zero_grad()
+
+        if step == args.steps // 2 - 1:
+            states.append(copy.deepcopy(model.state_dict()))
+
+    return states[0], copy.deepcopy(model.state_dict())
+
+
+def worker(rank, args, initial_state, batches, checkpoint_path, results):
+    os.environ['MASTER_ADDR'], os.environ['MASTER_PORT'] = '127.0.0.1', str(args.port)
+    dist.init_process_group('gloo', rank=rank, world_size=args.world_size)
+    torch.manual_seed(0)
+
+    def build(shard_gradients):
+        model = build_model(args.num_tokens)
+        model.load_state_dict(initial_state)
+        optimizer = get_optimizer(model.parameters(), args.lr, wd=0.01, zero=True, shard_gradients=shard_gradients)
+        return DistributedDataParallel(model, find_unused_parameters=True), optimizer
+
+    half = args.steps // 2
+
+    for shard_gradients in (False, True):
+        model, optimizer = build(shard_gradients)
+
+        for step in range(half):
+            src, tgt = batches[step][rank]
+            train_step(model, optimizer, src, tgt, args.clip, sharded=True, no_sync=shard_gradients)
+
+        # checkpoint half way, resume it in a new model and optimizer
+        state = optimizer.state_dict()
+        weights = model.module.state_dict()
+        if rank == 0:
+            torch.save(dict(optimizer=state, model=weights), checkpoint_path)
+            results['stage %d, half way' % (1 + shard_gradients)] = weights
+
+        dist.barrier()
+        checkpoint = torch.load(checkpoint_path)
+        model, optimizer = build(shard_gradients)
+        model.module.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+
+        for step in range(half, args.steps):
+            src, tgt = batches[step][rank]
+            train_step(model, optimizer, src, tgt, args.clip, sharded=True, no_sync=shard_gradients)
+
+        state_numel = sum(t.numel() for flat in optimizer.flat for t in flat.exp_avg + flat.exp_avg_sq)
+        if rank == 0:
+            results['stage %d, resumed' % (1 + shard_gradients)] = model.module.state_dict()
+            results['stage %d, state numel per rank' % (1 + shard_gradients)] = state_numel
+
+        dist.barrier()
+
+    dist.destroy_process_group()
+
+
+def max_difference(a, b):
+    return max((a[key].float() - b[key].float()).abs().max().item() for key in a)
+
+
+def main(args):
+    '''
+    Checks the sharded optimizer on cpu with the gloo backend: `world_size` processes train a small model with
+    ZeroAdamW, checkpoint half way and resume, and the weights must match single process AdamW on the same batches.
+    '''
+    torch.manual_seed(0)
+    initial_state = build_model(args.num_tokens).state_dict()
+    batches = make_batches(args)
+
+    half_state, final_state = reference(args, initial_state, batches)
+    num_params = sum(t.numel() for t in build_model(args.num_tokens).parameters())
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = mp.Manager().dict()
+        mp.spawn(worker, args=(args, initial_state, batches, os.path.join(directory, 'checkpoint.pt'), results),
+                 nprocs=args.world_size)
+
+    for stage in (1, 2):
+        print('stage %d | max difference to AdamW: half way %.2e, after resuming %.2e | optimizer state %d / %d' % (
+            stage, max_difference(half_state, results['stage %d, half way' % stage]),
+            max_difference(final_state, results['stage %d, resumed' % stage]),
+            results['stage %d, state numel per rank' % stage], 2 * num_params))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='sharded optimizer against AdamW, on cpu with gloo')
+    parser.add_argument("--world_size", type=int, default=2)
+    parser.add_argument("--steps", type=int, default=6)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--num_tokens", type=int, default=50)
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--clip", type=float, default=0.5)
+    parser.add_argument("--port", type=int, default=29512)
+
+    main(parser.parse_args())
@@ -0,0 +1,140 @@
+import os
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+
+from check_zero import build_model, PAD_IDX
+from model.comm_hooks import COMM_HOOKS, register_comm_hook
+from model.optimizer import get_optimizer
+
+
+def make_batch(generator, args):
+    # a task a small model learns in a few hundred steps: the target is the source reversed, through a fixed mapping
+    src = torch.randint(4, args.num_tokens, (args.batch_size, args.seq_len), generator=generator)
+    tgt = (src.flip(-1) * 7) % (args.num_tokens - 4) + 4
+    sos = torch.ones(args.batch_size, 1, dtype=torch.long)
+    return src, torch.cat((sos, tgt), dim=-1)
+
+
+def count_all_reduce_bytes(counter):
+    # the hooks all-reduce through torch.distributed.all_reduce, which is wrapped to add up the bytes sent
+    all_reduce = dist.all_reduce
+
+    def counted(tensor, *args, **kwargs):
+        counter['bytes'] += tensor.numel() * tensor.element_size()
+        return all_reduce(tensor, *args, **kwargs)
+
+    dist.all_reduce = counted
+
+
+def worker(rank, args, initial_state, results):
+    os.environ['MASTER_ADDR'], os.environ['MASTER_PORT'] = '127.0.0.1', str(args.port)
+    dist.init_process_group('gloo', rank=rank, world_size=args.world_size)
+    torch.set_num_threads(args.threads)
+
+    counter = dict(bytes=0)
+    count_all_reduce_bytes(counter)
+
+    for name in args.hooks:
+        model = build_model(args.num_tokens)
+        model.load_state_dict(initial_state)
+        optimizer = get_optimizer(model.parameters(), args.lr, wd=0.01)
+        model = DistributedDataParallel(model, find_unused_parameters=True)
+
+        if name == 'none':
+            # the python equivalent of the built-in all-reduce, so its bytes are counted the same way
+            model.register_comm_hook(None, default_hooks.allreduce_hook)
+        else:
+            register_comm_hook(model, name, powersgd_rank=args.powersgd_rank,
+                               powersgd_start_iter=args.powersgd_start_iter)
+
+        # different batches on every rank, the same for every hook
+        generator = torch.Generator().manual_seed(1 + rank)
+        losses, step_bytes, step_times = [], [], []
+
+        for step in range(args.steps):
+            src, tgt = make_batch(generator, args)
+
+            counter['bytes'] = 0
+            start_time = time.perf_counter()
+
+            loss = model(src, tgt, mask_src=src != PAD_IDX)
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
+            optimizer.step()
+            optimizer.zero_grad()
+
+            step_times.append(time.perf_counter() - start_time)
+            step_bytes.append(counter['bytes'])
+
+            mean_loss = loss.detach().clone()
+            dist.all_reduce(mean_loss)
+            losses.append(mean_loss.item() / args.world_size)
+
+        if rank == 0:
+            # communication and speed once PowerSGD has started
+            compressed = slice(args.powersgd_start_iter, None)
+            results[name] = dict(losses=losses, bytes=np.mean(step_bytes[compressed]),
+                                 ms=1000 * np.mean(step_times[compressed]))
+
+        dist.barrier()
+
+    dist.destroy_process_group()
+
+
+def main(args):
+    '''
+    Trains the same small model with DistributedDataParallel on cpu with the gloo backend, once per communication hook,
+    on the same batches, and compares the losses, the bytes all-reduced per step and the step time.
+    '''
+    torch.manual_seed(0)
+    initial_state = build_model(args.num_tokens).state_dict()
+
+    results = mp.Manager().dict()
+    mp.spawn(worker, args=(args, initial_state, results), nprocs=args.world_size)
+
+    reference = results['none'] if 'none' in results else None
+    window = args.report_every
+
+    for name in args.hooks:
+        result = results[name]
+        losses = result['losses']
+        curve = ' '.join('%.3f' % np.mean(losses[i:i + window]) for i in range(0, len(losses), window))
+        print('%s | loss %s' % (name, curve))
+
+    for name in args.hooks:
+        result = results[name]
+        final_loss = np.mean(result['losses'][-window:])
+        line = '%s | final loss %.4f | %.1f KB all-reduced / step | %.1f ms / step' % (
+            name, final_loss, result['bytes'] / 1024, result['ms'])
+
+        if reference is not None and name != 'none':
+            line += ' | %.1fx less communication' % (reference['bytes'] / max(result['bytes'], 1))
+
+        print(line)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='gradient compression hooks against plain all-reduce, on cpu with gloo')
+    parser.add_argument("--hooks", type=str, nargs='+', choices=COMM_HOOKS, default=list(COMM_HOOKS))
+    parser.add_argument("--world_size", type=int, default=2)
+    parser.add_argument("--steps", type=int, default=300)
+    parser.add_argument("--report_every", type=int, default=50)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--seq_len", type=int, default=12)
+    parser.add_argument("--num_tokens", type=int, default=50)
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--clip", type=float, default=1.)
+    parser.add_argument("--powersgd_rank", type=int, default=2)
+    parser.add_argument("--powersgd_start_iter", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--port", type=int, default=29513)
+
+    main(parser.parse_args())
@@ -0,0 +1,70 @@
+import os
+import json
+import time
+
+import numpy as np
+import torch
+
+from model.checkpoint import load_weights
+from model.distillation import build_teacher_store
+from utils import load_ids, build_seq2seq
+
+
+def main(args):
+    '''
+    Runs a trained model once over a training corpus and stores the top k of its distribution at every target position,
+    for the distillation of a student: set TEACHER_STORE of train_enc_dec_mp.py to the output directory, the student
+    then trains on these instead of running the teacher at every epoch. The store lines up with the corpus line by
+    line, so it must be built on the training files and with the MAX_LEN of the student trainer.
+    '''
+    torch.set_num_threads(args.threads)
+    device = 'cuda' if torch.cuda.is_available() and not args.cpu else 'cpu'
+
+    with open(args.vocabulary, 'r') as f:
+        vocabulary = json.load(f)
+
+    model = build_seq2seq(len(vocabulary), max_seq_len=args.max_len)
+    load_weights(model, args.checkpoint)
+    model.to(device)
+
+    X, Y = load_ids(args.src), load_ids(args.tgt)
+
+    start_time = time.perf_counter()
+    store = build_teacher_store(model, X, Y, args.output, topk=args.topk, max_len=args.max_len,
+                                max_batch_tokens=args.max_batch_tokens, max_batch_size=args.max_batch_size,
+                                device=device, log_every=args.log_every)
+    elapsed = time.perf_counter() - start_time
+
+    positions = int(store.offsets[-1])
+    size = sum(os.path.getsize(os.path.join(args.output, name)) for name in ('ids.bin', 'logprobs.bin'))
+    full_size = positions * len(vocabulary) * 4
+
+    print('%d sentences, %d target positions in %.1f s (%.0f positions / s)' % (
+        store.num_sentences, positions, elapsed, positions / max(elapsed, 1e-9)))
+    print('top %d store: %.1f MB (%.1f MB for the full distributions in float32)' % (
+        args.topk, size / 2 ** 20, full_size / 2 ** 20))
+
+    ids, logprobs = store.arrays()
+    if positions > 0:
+        print('teacher probability mass in the top %d: %.3f on average' % (
+            args.topk, np.exp(logprobs[:].astype(np.float32)).sum(axis=-1).mean()))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='top k teacher distributions over a training corpus, for distillation')
+    parser.add_argument("--checkpoint", help="teacher weights", default='output/model_seq2seq.weights')
+    parser.add_argument("--output", help="directory of the teacher store", default='output/teacher_store')
+    parser.add_argument("--src", help="training source ids", default='dataset/nl/wmt17_en_de/train.en.ids.gz')
+    parser.add_argument("--tgt", help="training target ids", default='dataset/nl/wmt17_en_de/train.de.ids.gz')
+    parser.add_argument("--vocabulary", default='dataset/nl/wmt17_en_de/vocabulary.json')
+    parser.add_argument("--topk", type=int, default=16, help="teacher tokens stored per target position")
+    parser.add_argument("--max_len", type=int, default=120, help="MAX_LEN of the student trainer")
+    parser.add_argument("--max_batch_tokens", type=int, default=8192)
+    parser.add_argument("--max_batch_size", type=int, default=256)
+    parser.add_argument("--log_every", type=int, default=100, help="batches between progress reports")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--cpu", action='store_true')
+
+    main(parser.parse_args())
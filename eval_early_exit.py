@@ -0,0 +1,94 @@
+import json
+import time
+
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from model.checkpoint import load_weights
+from model.early_exit import CONFIDENCE_MEASURES, decoder_layers, early_exit_generate
+from utils import load_ids, build_seq2seq, batch_generate_postprocessing
+from eval_quantized import translate, bleu_score
+
+
+def translate_early_exit(model, sources, batch_size, max_len, threshold, confidence, min_layers, eos_token=0,
+                         pad_idx=3):
+    # greedy early exit decoding of length sorted batches, returns the translations in input order, the decoding time
+    # and the summed statistics of early_exit_generate
+    order = np.argsort([len(src) for src in sources])
+    translations = [None] * len(sources)
+    elapsed, stats = 0., dict(steps=0, layers=0, computed=0)
+
+    for start in range(0, len(order), batch_size):
+        indices = order[start:start + batch_size]
+        src = pad_sequence([torch.from_numpy(sources[i]).long() for i in indices], batch_first=True, padding_value=pad_idx)
+        start_tokens = torch.ones((len(indices), 1)).long()
+
+        start_time = time.perf_counter()
+        sample, batch_stats = early_exit_generate(model, src, start_tokens, max_len, mask=src != pad_idx,
+                                                  eos_token=eos_token, threshold=threshold, confidence=confidence,
+                                                  min_layers=min_layers)
+        elapsed += time.perf_counter() - start_time
+
+        for key in stats:
+            stats[key] += batch_stats[key]
+
+        for i, ids in zip(indices, batch_generate_postprocessing(sample, eos_token)):
+            translations[i] = ids
+
+    return translations, elapsed, stats
+
+
+def main(args):
+    '''
+    BLEU and cpu latency of early exit decoding for a range of confidence thresholds, against decoding with every
+    layer, with the average number of decoder layers each step used and the number of (position, layer) pairs computed
+    per step, lazy fills of the keys / values included.
+    '''
+    torch.set_num_threads(args.threads)
+
+    with open('dataset/nl/wmt17_en_de/vocabulary.json', 'r') as f:
+        vocabulary = json.load(f)
+
+    X_test = load_ids(args.src)[:args.num_sentences]
+    Y_test = load_ids(args.tgt)[:args.num_sentences]
+
+    model = build_seq2seq(len(vocabulary))
+    load_weights(model, args.checkpoint)
+    model.eval()
+
+    depth = len(decoder_layers(model.decoder.net.attn_layers))
+
+    full, full_time = translate(model, X_test, args.batch_size, args.max_len)
+    full_bleu = bleu_score(full, Y_test, vocabulary)
+    print('all %d layers | bleu = %.2f | %.1f ms / sentence' % (depth, full_bleu, 1000 * full_time / len(X_test)))
+
+    for threshold in args.thresholds:
+        translations, elapsed, stats = translate_early_exit(model, X_test, args.batch_size, args.max_len, threshold,
+                                                            args.confidence, args.min_layers)
+        bleu = bleu_score(translations, Y_test, vocabulary)
+        steps = max(stats['steps'], 1)
+
+        print('%s >= %.2f | bleu = %.2f (%+.2f) | %.1f ms / sentence (%.2fx) | %.2f layers / step | '
+              '%.2f layers computed / step | %.1f%% identical' % (
+                  args.confidence, threshold, bleu, bleu - full_bleu, 1000 * elapsed / len(X_test), full_time / elapsed,
+                  stats['layers'] / steps, stats['computed'] / steps,
+                  100 * np.mean([a == b for a, b in zip(full, translations)])))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='bleu / latency trade-off of early exit decoding')
+    parser.add_argument("--checkpoint", help="model weights", default='output/model_seq2seq.weights')
+    parser.add_argument("--src", help="held-out source ids", default='dataset/nl/wmt17_en_de/valid.en.ids.gz')
+    parser.add_argument("--tgt", help="held-out reference ids", default='dataset/nl/wmt17_en_de/valid.de.ids.gz')
+    parser.add_argument("--confidence", choices=CONFIDENCE_MEASURES, default='softmax')
+    parser.add_argument("--thresholds", type=float, nargs='+', default=[0.99, 0.95, 0.9, 0.8])
+    parser.add_argument("--min_layers", type=int, default=1, help="layers every step runs before it may exit")
+    parser.add_argument("--num_sentences", type=int, default=500)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--max_len", type=int, default=120)
+    parser.add_argument("--threads", type=int, default=4)
+
+    main(parser.parse_args())
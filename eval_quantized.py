@@ -0,0 +1,81 @@
+import json
+import time
+
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+import sacrebleu
+
+from model.checkpoint import load_weights
+from model.quantization import quantize_int8
+from utils import load_ids, build_seq2seq, ids_to_tokens, BPE_to_eval, batch_generate_postprocessing
+
+
+def translate(model, sources, batch_size, max_len, eos_token=0, pad_idx=3):
+    # greedy decoding of length sorted batches, returns the translations in input order and the decoding time
+    order = np.argsort([len(src) for src in sources])
+    translations = [None] * len(sources)
+    elapsed = 0.
+
+    for start in range(0, len(order), batch_size):
+        indices = order[start:start + batch_size]
+        src = pad_sequence([torch.from_numpy(sources[i]).long() for i in indices], batch_first=True, padding_value=pad_idx)
+        start_tokens = torch.ones((len(indices), 1)).long()
+
+        start_time = time.perf_counter()
+        sample = model.generate(src, start_tokens, max_len, mask=src != pad_idx, cache_kv=True, temperature=0.,
+                                eos_token=eos_token)
+        elapsed += time.perf_counter() - start_time
+
+        for i, ids in zip(indices, batch_generate_postprocessing(sample, eos_token)):
+            translations[i] = ids
+
+    return translations, elapsed
+
+
+def bleu_score(translations, references, vocabulary):
+    predicted = [BPE_to_eval(ids_to_tokens(ids, vocabulary)) for ids in translations]
+    target = [BPE_to_eval(ids_to_tokens(ref.tolist()[1:-1], vocabulary)) for ref in references]
+    return sacrebleu.corpus_bleu(predicted, [target]).score
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+
+    with open('dataset/nl/wmt17_en_de/vocabulary.json', 'r') as f:
+        vocabulary = json.load(f)
+
+    X_test = load_ids(args.src)[:args.num_sentences]
+    Y_test = load_ids(args.tgt)[:args.num_sentences]
+
+    model = build_seq2seq(len(vocabulary))
+    load_weights(model, args.checkpoint)
+    model.eval()
+
+    quantized = quantize_int8(model)
+
+    results = dict()
+    for name, m in (('fp32', model), ('int8', quantized)):
+        translations, elapsed = translate(m, X_test, args.batch_size, args.max_len)
+        bleu = bleu_score(translations, Y_test, vocabulary)
+        results[name] = (bleu, elapsed)
+        print('%s | bleu = %.2f | %.1f ms / sentence' % (name, bleu, 1000 * elapsed / len(X_test)))
+
+    (fp32_bleu, fp32_time), (int8_bleu, int8_time) = results['fp32'], results['int8']
+    print('bleu delta = %.2f, speedup = %.2fx' % (int8_bleu - fp32_bleu, fp32_time / int8_time))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='accuracy and cpu latency of the int8 quantized model against fp32')
+    parser.add_argument("--checkpoint", help="model weights", default='output/model_seq2seq.weights')
+    parser.add_argument("--src", help="held-out source ids", default='dataset/nl/wmt17_en_de/valid.en.ids.gz')
+    parser.add_argument("--tgt", help="held-out reference ids", default='dataset/nl/wmt17_en_de/valid.de.ids.gz')
+    parser.add_argument("--num_sentences", type=int, default=500)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--max_len", type=int, default=120)
+    parser.add_argument("--threads", type=int, default=4)
+
+    main(parser.parse_args())
@@ -0,0 +1,78 @@
+import json
+import time
+
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from model.checkpoint import load_weights
+from model.shortlist import Shortlist, shortlist_generate
+from utils import load_ids, build_seq2seq, batch_generate_postprocessing
+from eval_quantized import bleu_score
+
+
+def translate(model, shortlist, sources, batch_size, max_len, eos_token=0, pad_idx=3):
+    # greedy decoding of length sorted batches, with the shortlist or the full vocabulary when it is None
+    order = np.argsort([len(src) for src in sources])
+    translations = [None] * len(sources)
+    elapsed, num_candidates = 0., []
+
+    for start in range(0, len(order), batch_size):
+        indices = order[start:start + batch_size]
+        src = pad_sequence([torch.from_numpy(sources[i]).long() for i in indices], batch_first=True, padding_value=pad_idx)
+        start_tokens = torch.ones((len(indices), 1)).long()
+
+        start_time = time.perf_counter()
+        sample, candidates = shortlist_generate(model, shortlist, src, start_tokens, max_len, mask=src != pad_idx,
+                                                eos_token=eos_token)
+        elapsed += time.perf_counter() - start_time
+        num_candidates.append(candidates)
+
+        for i, ids in zip(indices, batch_generate_postprocessing(sample, eos_token)):
+            translations[i] = ids
+
+    return translations, elapsed, np.mean(num_candidates)
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+
+    with open('dataset/nl/wmt17_en_de/vocabulary.json', 'r') as f:
+        vocabulary = json.load(f)
+
+    X_test = load_ids(args.src)[:args.num_sentences]
+    Y_test = load_ids(args.tgt)[:args.num_sentences]
+
+    model = build_seq2seq(len(vocabulary))
+    load_weights(model, args.checkpoint)
+    model.eval()
+
+    shortlist = Shortlist.load(args.shortlist, max_fraction=args.max_fraction)
+
+    full, full_time, _ = translate(model, None, X_test, args.batch_size, args.max_len)
+    short, short_time, num_candidates = translate(model, shortlist, X_test, args.batch_size, args.max_len)
+
+    full_bleu, short_bleu = bleu_score(full, Y_test, vocabulary), bleu_score(short, Y_test, vocabulary)
+    print('full vocabulary | bleu = %.2f | %.1f ms / sentence' % (full_bleu, 1000 * full_time / len(X_test)))
+    print('shortlist | bleu = %.2f | %.1f ms / sentence | %.0f candidates per batch' % (
+        short_bleu, 1000 * short_time / len(X_test), num_candidates))
+    print('translations identical to the full vocabulary: %.1f%%' % (100 * np.mean([a == b for a, b in zip(full, short)])))
+    print('bleu delta = %.2f, speedup = %.2fx' % (short_bleu - full_bleu, full_time / short_time))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='accuracy and cpu latency of shortlist decoding against the full vocabulary')
+    parser.add_argument("--checkpoint", help="model weights", default='output/model_seq2seq.weights')
+    parser.add_argument("--shortlist", default='output/shortlist.npz')
+    parser.add_argument("--max_fraction", type=float, default=0.5,
+                        help="batches with more candidates than this fraction of the vocabulary use all of it")
+    parser.add_argument("--src", help="held-out source ids", default='dataset/nl/wmt17_en_de/valid.en.ids.gz')
+    parser.add_argument("--tgt", help="held-out reference ids", default='dataset/nl/wmt17_en_de/valid.de.ids.gz')
+    parser.add_argument("--num_sentences", type=int, default=500)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--max_len", type=int, default=120)
+    parser.add_argument("--threads", type=int, default=4)
+
+    main(parser.parse_args())
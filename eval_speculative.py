@@ -0,0 +1,83 @@
+import json
+import time
+
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from model.checkpoint import load_weights
+from model.speculative import build_draft_decoder, speculative_generate
+from utils import load_ids, build_seq2seq
+
+
+def main(args):
+    '''
+    Greedy decoding against speculative decoding with the draft decoder, sentence by sentence as in interactive use:
+    checks the outputs are identical and reports the acceptance rate and the latency of both.
+    '''
+    torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    pad_idx, eos_token = 3, 0
+
+    with open('dataset/nl/wmt17_en_de/vocabulary.json', 'r') as f:
+        vocabulary = json.load(f)
+
+    model = build_seq2seq(len(vocabulary))
+    load_weights(model, args.checkpoint)
+    model.to(device).eval()
+
+    draft = build_draft_decoder(model, depth=args.depth)
+    load_weights(draft, args.draft)
+    draft.to(device).eval()
+
+    X_test = load_ids(args.src)[:args.num_sentences]
+
+    greedy_time, speculative_time = 0., 0.
+    proposed, accepted, passes, num_tokens, mismatches = 0, 0, 0, 0, 0
+
+    for start in range(0, len(X_test), args.batch_size):
+        batch = X_test[start:start + args.batch_size]
+        src = pad_sequence([torch.from_numpy(ids).long() for ids in batch], batch_first=True, padding_value=pad_idx)
+        src = src.to(device)
+        mask = src != pad_idx
+        start_tokens = torch.ones((len(batch), 1)).long().to(device)
+
+        start_time = time.perf_counter()
+        greedy = model.generate(src, start_tokens, args.max_len, mask=mask, cache_kv=True, temperature=0.,
+                                eos_token=eos_token)
+        greedy_time += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        speculative, stats = speculative_generate(model, draft, src, start_tokens, args.max_len, mask=mask,
+                                                  num_speculative=args.num_speculative, eos_token=eos_token)
+        speculative_time += time.perf_counter() - start_time
+
+        mismatches += int(greedy.shape != speculative.shape or not torch.equal(greedy, speculative))
+        proposed += stats['proposed']
+        accepted += stats['accepted']
+        passes += stats['passes']
+        num_tokens += speculative.shape[-1]
+
+    num_batches = int(np.ceil(len(X_test) / args.batch_size))
+    print('batches with outputs different from greedy decoding: %d / %d' % (mismatches, num_batches))
+    print('acceptance rate = %.3f, tokens per decoder pass = %.2f' % (accepted / max(proposed, 1), num_tokens / max(passes, 1)))
+    print('greedy %.1f ms / sentence | speculative %.1f ms / sentence | speedup = %.2fx' % (
+        1000 * greedy_time / len(X_test), 1000 * speculative_time / len(X_test), greedy_time / speculative_time))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='latency and acceptance rate of speculative decoding against greedy decoding')
+    parser.add_argument("--checkpoint", help="model weights", default='output/model_seq2seq.weights')
+    parser.add_argument("--draft", help="draft decoder weights", default='output/draft_seq2seq.weights')
+    parser.add_argument("--depth", type=int, default=2, help="number of layers of the draft decoder")
+    parser.add_argument("--num_speculative", type=int, default=4, help="tokens proposed by the draft per decoder pass")
+    parser.add_argument("--src", help="held-out source ids", default='dataset/nl/wmt17_en_de/valid.en.ids.gz')
+    parser.add_argument("--num_sentences", type=int, default=500)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--max_len", type=int, default=120)
+    parser.add_argument("--device", default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--threads", type=int, default=4)
+
+    main(parser.parse_args())
@@ -0,0 +1,161 @@
+import math
+from itertools import chain
+
+import torch
+from torch.optim import Optimizer
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+
+def dynamic_codebook(signed):
+    # dynamic tree quantization (Dettmers et al., 8-bit optimizers via block-wise quantization): 256 values in [-1, 1]
+    # or [0, 1], spread over 7 decades, with linearly spaced fractions in each and more of them in the decades close to 1
+    values = [0., 1.]
+    fraction_bits = 0 if signed else 1
+
+    for decade in range(7):
+        boundaries = torch.linspace(0.1, 1., 2 ** (decade + fraction_bits) + 1)
+        means = ((boundaries[:-1] + boundaries[1:]) / 2 * 10 ** (decade - 6)).tolist()
+        values += means + ([-mean for mean in means] if signed else [])
+
+    assert len(values) == 256
+    return torch.tensor(sorted(values))
+
+
+class BlockQuantizer():
+    '''
+    Quantizes tensors to uint8 indices into a codebook, after dividing every block of `block_size` consecutive values
+    by its absolute maximum, so one outlier only costs the precision of its own block.
+    '''
+
+    def __init__(self, signed, block_size=256):
+        self.codebook = dynamic_codebook(signed)
+        self.midpoints = (self.codebook[1:] + self.codebook[:-1]) / 2
+        self.block_size = block_size
+
+    def blocks(self, t):
+        flat = t.reshape(-1)
+        padding = -flat.numel() % self.block_size
+        if padding > 0:
+            flat = torch.cat((flat, flat.new_zeros(padding)))
+        return flat.view(-1, self.block_size)
+
+    def quantize(self, t):
+        blocks = self.blocks(t.float())
+        absmax = blocks.abs().amax(dim=-1, keepdim=True).clamp(min=1e-30)
+
+        midpoints = self.midpoints.to(t.device)
+        codes = torch.bucketize(blocks / absmax, midpoints).to(torch.uint8)
+        return codes, absmax.squeeze(-1)
+
+    def dequantize(self, codes, absmax, like):
+        codebook = self.codebook.to(codes.device)
+        blocks = codebook[codes.long()] * absmax.unsqueeze(-1)
+        return blocks.view(-1)[:like.numel()].view_as(like)
+
+
+class AdamW8bit(Optimizer):
+    '''
+    AdamW whose first and second moments are stored as blockwise quantized 8 bit codes, a byte per value plus a float
+    per block of `block_size`, instead of two floats: the optimizer state takes a little over a quarter of the memory
+    of AdamW. The moments of a parameter are dequantized, updated and quantized again at every step. Tensors smaller
+    than `min_8bit_size` (biases, norms) keep float moments, their state is negligible and they are the most sensitive
+    to quantization error. Plain PyTorch, so it runs on cpu as on gpu.
+    '''
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=1e-2, block_size=256,
+                 min_8bit_size=4096):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        super().__init__(params, defaults)
+
+        self.min_8bit_size = min_8bit_size
+        self.exp_avg_quantizer = BlockQuantizer(signed=True, block_size=block_size)
+        self.exp_avg_sq_quantizer = BlockQuantizer(signed=False, block_size=block_size)
+
+    def init_state(self, p):
+        state = self.state[p]
+        state['step'] = 0
+
+        if p.numel() < self.min_8bit_size:
+            state['exp_avg'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+            state['exp_avg_sq'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+            return state
+
+        num_blocks = math.ceil(p.numel() / self.exp_avg_quantizer.block_size)
+        for name in ('exp_avg', 'exp_avg_sq'):
+            state[name + '_codes'] = torch.zeros(num_blocks, self.exp_avg_quantizer.block_size, dtype=torch.uint8,
+                                                 device=p.device)
+            state[name + '_absmax'] = torch.zeros(num_blocks, dtype=torch.float32, device=p.device)
+
+        return state
+
+    def moments(self, p, state):
+        if 'exp_avg' in state:
+            return state['exp_avg'], state['exp_avg_sq']
+
+        exp_avg = self.exp_avg_quantizer.dequantize(state['exp_avg_codes'], state['exp_avg_absmax'], p)
+        exp_avg_sq = self.exp_avg_sq_quantizer.dequantize(state['exp_avg_sq_codes'], state['exp_avg_sq_absmax'], p)
+        return exp_avg, exp_avg_sq
+
+    def store_moments(self, state, exp_avg, exp_avg_sq):
+        if 'exp_avg' in state:
+            return
+
+        state['exp_avg_codes'], state['exp_avg_absmax'] = self.exp_avg_quantizer.quantize(exp_avg)
+        state['exp_avg_sq_codes'], state['exp_avg_sq_absmax'] = self.exp_avg_sq_quantizer.quantize(exp_avg_sq)
+
+    def load_state_dict(self, state_dict):
+        # Optimizer.load_state_dict casts every state tensor to the dtype of its parameter, which would turn the codes
+        # into floats, 4 times their size, until the next step of each parameter. the codes and their scales are set
+        # aside and restored with their own dtypes, only moved to the device of their parameter
+        quantized_keys = ('exp_avg_codes', 'exp_avg_absmax', 'exp_avg_sq_codes', 'exp_avg_sq_absmax')
+
+        state = {index: dict(param_state) for index, param_state in state_dict['state'].items()}
+        quantized = {index: {key: param_state.pop(key) for key in quantized_keys if key in param_state}
+                     for index, param_state in state.items()}
+
+        super().load_state_dict(dict(state_dict, state=state))
+
+        saved_ids = chain.from_iterable(group['params'] for group in state_dict['param_groups'])
+        params = chain.from_iterable(group['params'] for group in self.param_groups)
+        id_map = dict(zip(saved_ids, params))
+
+        for index, tensors in quantized.items():
+            p = id_map[index]
+            self.state[p].update({key: t.to(p.device) for key, t in tensors.items()})
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if exists(closure):
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+
+                grad = p.grad.float()
+                state = self.state[p] if len(self.state[p]) > 0 else self.init_state(p)
+
+                state['step'] += 1
+                bias_correction1 = 1 - beta1 ** state['step']
+                bias_correction2 = 1 - beta2 ** state['step']
+
+                exp_avg, exp_avg_sq = self.moments(p, state)
+                exp_avg.lerp_(grad, 1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                self.store_moments(state, exp_avg, exp_avg_sq)
+
+                p.mul_(1 - group['lr'] * group['weight_decay'])
+
+                denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(group['eps'])
+                p.addcdiv_(exp_avg.to(p.dtype), denom.to(p.dtype), value=-group['lr'] / bias_correction1)
+
+        return loss
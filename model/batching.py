@@ -0,0 +1,414 @@
+from collections import deque
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from einops import rearrange
+from torch import einsum
+
+from model.xtransformer import Intermediates, LayerIntermediates, always, online_softmax_block, max_neg_value
+
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+
+# per slot key / value caches, in the cache object protocol of `Attention`
+
+class SlotKVCache():
+    '''
+    keys / values of one self attention layer for `num_slots` sequences decoded side by side, each at its own position.
+    storage is allocated once for `max_len` positions, and `update` writes the keys / values of the new position of
+    every active slot in place
+    '''
+
+    def __init__(self, num_slots, max_len):
+        self.num_slots = num_slots
+        self.max_len = max_len
+        self.k = None
+        self.v = None
+        self.lengths = torch.zeros(num_slots, dtype=torch.long)
+        self.active = None
+
+    def reset(self, slots):
+        self.lengths[slots.to(self.lengths.device)] = 0
+
+    def update(self, k, v):
+        # k, v: (b h 1 d), one new position for each of the active slots
+        if not exists(self.k):
+            self.k = k.new_zeros((self.num_slots, k.shape[1], self.max_len, k.shape[-1]))
+            self.v = v.new_zeros((self.num_slots, v.shape[1], self.max_len, v.shape[-1]))
+            self.lengths = self.lengths.to(k.device)
+
+        slots = self.active
+        positions = self.lengths[slots]
+
+        self.k[slots, :, positions] = k[:, :, -1]
+        self.v[slots, :, positions] = v[:, :, -1]
+        self.lengths[slots] += 1
+
+        lengths = self.lengths[slots]
+        n = int(lengths.max().item())
+        mask = torch.arange(n, device=k.device) < lengths[:, None]
+        return self.k[slots, :, :n], self.v[slots, :, :n], mask
+
+
+class SlotContextCache():
+    '''
+    keys / values of one cross attention layer, projected once from the encoder output when a sentence is admitted
+    '''
+
+    def __init__(self, attn, num_slots, max_len):
+        self.attn = attn
+        self.num_slots = num_slots
+        self.max_len = max_len
+        self.k = None
+        self.v = None
+        self.mask = None
+        self.active = None
+
+    def fill(self, slots, context, context_mask):
+        k, v = self.attn.project_kv(context)
+
+        if not exists(self.k):
+            self.k = k.new_zeros((self.num_slots, k.shape[1], self.max_len, k.shape[-1]))
+            self.v = v.new_zeros((self.num_slots, v.shape[1], self.max_len, v.shape[-1]))
+            self.mask = torch.zeros((self.num_slots, self.max_len), dtype=torch.bool, device=k.device)
+
+        n = context.shape[1]
+        self.k[slots, :, :n] = k
+        self.v[slots, :, :n] = v
+        self.mask[slots] = False
+        self.mask[slots, :n] = context_mask
+
+    def update(self, k=None, v=None):
+        slots = self.active
+        n = int(self.mask[slots].sum(dim=-1).max().item())
+        return self.k[slots, :, :n], self.v[slots, :, :n], self.mask[slots, :n]
+
+
+# paged key / value cache
+
+class PagedKVPool():
+    '''
+    Keys / values of all the self attention layers of a decoder, for any number of sequences, in a fixed pool of
+    `num_pages` pages of `page_size` positions (as in vLLM). Every sequence has a page table, the list of its pages in
+    order, and takes a page from the free list each time it fills the last one. Pages of finished sequences go back to
+    the free list. Memory is allocated once per layer, at its first write (layers of a pruned model may have different
+    numbers of heads), and never grows or moves, and at most `page_size - 1` positions per sequence are left unused.
+
+    Attention reads the pages in place (`attend`): the new keys / values are written to their page, then every
+    sequence attends to its pages one page at a time, with the running max and sum of online softmax, so the keys /
+    values are never gathered into a contiguous copy.
+    '''
+
+    def __init__(self, num_layers, num_pages, page_size=16):
+        self.num_layers = num_layers
+        self.num_pages = num_pages
+        self.page_size = page_size
+
+        self.k = [None] * num_layers
+        self.v = [None] * num_layers
+
+        self.free_pages = list(range(num_pages))[::-1]
+        self.page_tables = dict()
+        self.lengths = dict()
+
+        # block table and positions of the sequences of the current step
+        self.block_table = None
+        self.positions = None
+
+    def add_sequence(self, seq):
+        self.page_tables[seq] = []
+        self.lengths[seq] = 0
+
+    def free_sequence(self, seq):
+        self.free_pages.extend(reversed(self.page_tables.pop(seq)))
+        self.lengths.pop(seq)
+
+    def pages_needed(self, seqs):
+        # pages to take from the free list for every sequence to store one more position
+        return sum(self.lengths[seq] % self.page_size == 0 for seq in seqs)
+
+    def prepare(self, seqs, device):
+        # reserves the position of the next step of each sequence, and gathers their page tables in a block table
+        assert self.pages_needed(seqs) <= len(self.free_pages), 'out of key / value cache pages'
+
+        for seq in seqs:
+            if self.lengths[seq] % self.page_size == 0:
+                self.page_tables[seq].append(self.free_pages.pop())
+
+        max_pages = max(len(self.page_tables[seq]) for seq in seqs)
+        block_table = [self.page_tables[seq] + [0] * (max_pages - len(self.page_tables[seq])) for seq in seqs]
+
+        self.block_table = torch.tensor(block_table, dtype=torch.long, device=device)
+        self.positions = torch.tensor([self.lengths[seq] for seq in seqs], dtype=torch.long, device=device)
+
+    def commit(self, seqs):
+        for seq in seqs:
+            self.lengths[seq] += 1
+
+    def write(self, layer, k, v):
+        # k, v: (b h 1 d) for the sequences of the current step, written into their pages
+        if self.k[layer] is None:
+            shape = (self.num_pages, k.shape[1], self.page_size, k.shape[-1])
+            self.k[layer] = k.new_zeros(shape)
+            self.v[layer] = v.new_zeros((*shape[:-1], v.shape[-1]))
+
+        positions, block_table = self.positions, self.block_table
+        rows = torch.arange(block_table.shape[0], device=block_table.device)
+        pages, offsets = block_table[rows, positions // self.page_size], positions % self.page_size
+
+        self.k[layer][pages, :, offsets] = k[:, :, -1]
+        self.v[layer][pages, :, offsets] = v[:, :, -1]
+
+    def attend(self, layer, q, k, v, scale):
+        # q: (b h 1 d), attention of the new position of every sequence over all of its positions, page by page
+        self.write(layer, k, v)
+
+        layer_k, layer_v = self.k[layer], self.v[layer]
+        positions, block_table = self.positions, self.block_table
+        dtype, page_positions = q.dtype, torch.arange(self.page_size, device=q.device)
+
+        q = rearrange(q, 'b (g r) i d -> b g r i d', g=layer_k.shape[1])
+        acc, row_max, row_sum = 0., None, 0.
+
+        for page in range(block_table.shape[1]):
+            # the page of every sequence at this index of its page table, page 0 past the end of short tables
+            pages = block_table[:, page]
+            dots = einsum('b g r i d, b g j d -> b g r i j', q, layer_k[pages]).float() * scale
+
+            # positions not written yet, in the last page of a sequence or past the end of its table
+            masked = (page * self.page_size + page_positions) > positions[:, None]
+            dots = dots.masked_fill(rearrange(masked, 'b j -> b 1 1 1 j'), max_neg_value(dots))
+
+            acc, row_max, row_sum = online_softmax_block(dots, layer_v[pages], acc, row_max, row_sum)
+
+        out = (acc / row_sum).type(dtype)
+        return rearrange(out, 'b g r i d -> b (g r) i d')
+
+    def occupancy(self):
+        used_pages = self.num_pages - len(self.free_pages)
+        num_positions = sum(self.lengths.values())
+        return dict(
+            sequences=len(self.page_tables),
+            used_pages=used_pages,
+            total_pages=self.num_pages,
+            page_occupancy=used_pages / self.num_pages,
+            page_fill=num_positions / max(used_pages * self.page_size, 1)
+        )
+
+
+class PagedLayerCache():
+    # one self attention layer of a PagedKVPool, in the cache object protocol of `Attention`
+    def __init__(self, pool, layer):
+        self.pool = pool
+        self.layer = layer
+        self.active = None
+
+    def attend(self, q, k, v, scale):
+        return self.pool.attend(self.layer, q, k, v, scale)
+
+
+# scheduler
+
+class ContinuousBatcher():
+    '''
+    Iteration level scheduling of greedy decoding (as in Orca): the decoder runs one step at a time over up to
+    `num_slots` sequences, new sentences are encoded and admitted into free slots before every step, and a sequence
+    leaves the batch as soon as it produced its eos token. Every slot keeps its own keys / values and position,
+    so sequences of very different lengths decode side by side without padding each other.
+
+    Decoders with absolute or no positional embeddings are supported. Rotary embeddings, position biases (relative,
+    ALiBi, dynamic) and windowed attention assume the positions of the batch to be aligned, and are rejected.
+
+    With `num_pages`, the self attention keys / values live in a PagedKVPool of that many pages instead of a
+    preallocated maximum length per slot. Sentences are only admitted while pages remain for the running ones, and when
+    the pool runs out the most recently admitted sentence is preempted: its pages are freed and it is decoded again
+    from the start later on, which greedy decoding makes exact.
+    '''
+
+    def __init__(self, model, num_slots=64, max_len=120, eos_token=0, sos_token=1, pad_idx=3, num_pages=None,
+                 page_size=16):
+        self.model = model
+        self.net = model.decoder.net
+        self.num_slots = num_slots
+        self.max_len = min(max_len, self.net.max_seq_len)  # tokens generated per sentence, eos included
+        self.eos_token = eos_token
+        self.sos_token = sos_token
+        self.pad_idx = pad_idx
+
+        attn_layers = self.net.attn_layers
+        assert not exists(attn_layers.rotary_pos_emb), 'continuous batching needs per sequence positions, rotary embeddings are not supported'
+        assert not exists(attn_layers.rel_pos), 'continuous batching needs per sequence positions, position biases are not supported'
+
+        num_self_attn_layers = attn_layers.layer_types.count('a')
+        self.pool = PagedKVPool(num_self_attn_layers, num_pages, page_size) if exists(num_pages) else None
+        assert not exists(num_pages) or num_pages * page_size >= min(max_len + 1, self.net.max_seq_len), \
+            'the key / value cache pages must hold at least one sequence of the maximum length'
+
+        max_src_len = model.encoder.max_seq_len
+        self.caches = []
+        for layer_type, (_, block, _) in zip(attn_layers.layer_types, attn_layers.layers):
+            if layer_type == 'a':
+                assert not exists(block.max_attend_past), 'windowed attention is not supported with continuous batching'
+                if exists(self.pool):
+                    self.caches.append(PagedLayerCache(self.pool, sum(isinstance(c, PagedLayerCache) for c in self.caches)))
+                else:
+                    self.caches.append(SlotKVCache(num_slots, self.net.max_seq_len))
+            elif layer_type == 'c':
+                self.caches.append(SlotContextCache(block, num_slots, max_src_len))
+
+        self.pending = deque()
+        self.free = list(range(num_slots))[::-1]
+        self.keys = [None] * num_slots
+        self.sources = [None] * num_slots
+        self.outputs = [None] * num_slots
+        self.admitted = []
+        self.tokens = torch.full((num_slots,), sos_token, dtype=torch.long)
+
+        # occupancy statistics
+        self.num_steps = 0
+        self.num_slot_steps = 0
+        self.num_preemptions = 0
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+    def add(self, src, key=None):
+        # src: source ids of one sentence, results are returned with `key`
+        self.pending.append((key, torch.as_tensor(src, dtype=torch.long)))
+
+    def can_admit(self):
+        if len(self.free) == 0:
+            return False
+
+        # with a paged pool, keep a page per running sentence in reserve, so they can grow without preemption
+        if exists(self.pool):
+            return len(self.pool.free_pages) > len(self.admitted)
+
+        return True
+
+    def has_work(self):
+        return len(self.pending) > 0 or len(self.free) < self.num_slots
+
+    def occupancy(self):
+        return self.num_slot_steps / max(self.num_steps * self.num_slots, 1)
+
+    @torch.no_grad()
+    def admit(self):
+        admitted = []
+        while len(self.pending) > 0 and self.can_admit():
+            key, src = self.pending.popleft()
+            slot = self.free.pop()
+            self.keys[slot], self.sources[slot], self.outputs[slot] = key, src, []
+            self.admitted.append(slot)
+            admitted.append((slot, src[:self.model.encoder.max_seq_len]))
+
+            if exists(self.pool):
+                self.pool.add_sequence(slot)
+
+        if len(admitted) == 0:
+            return
+
+        slots = torch.tensor([slot for slot, _ in admitted], device=self.device)
+        src = pad_sequence([src for _, src in admitted], batch_first=True, padding_value=self.pad_idx).to(self.device)
+        mask = src != self.pad_idx
+
+        context = self.model.encoder(src, mask=mask, return_embeddings=True)
+
+        for cache in self.caches:
+            if isinstance(cache, SlotContextCache):
+                cache.fill(slots, context, mask)
+            elif isinstance(cache, SlotKVCache):
+                cache.reset(slots)
+
+        self.tokens[slots.cpu()] = self.sos_token
+
+    def release(self, slot):
+        self.keys[slot], self.sources[slot], self.outputs[slot] = None, None, None
+        self.admitted.remove(slot)
+        self.free.append(slot)
+
+        if exists(self.pool):
+            self.pool.free_sequence(slot)
+
+    def preempt(self):
+        # the most recently admitted sentence gives its pages back and waits to be decoded again from the start
+        slot = self.admitted[-1]
+        self.pending.appendleft((self.keys[slot], self.sources[slot]))
+        self.release(slot)
+        self.num_preemptions += 1
+
+    @torch.no_grad()
+    def step(self):
+        # admits waiting sentences, runs one decoding step and returns the (key, ids) of the sequences that finished
+        self.admit()
+
+        if exists(self.pool):
+            while len(self.admitted) > 1 and self.pool.pages_needed(self.admitted) > len(self.pool.free_pages):
+                self.preempt()
+
+        active = sorted(set(range(self.num_slots)) - set(self.free))
+        if len(active) == 0:
+            return []
+
+        device = self.device
+
+        if exists(self.pool):
+            self.pool.prepare(active, device)
+        slots = torch.tensor(active, device=device)
+        positions = torch.tensor([len(self.outputs[slot]) for slot in active], device=device)
+
+        for cache in self.caches:
+            cache.active = slots
+
+        # cross attention reads its keys / values from the slot caches, the context is only a placeholder
+        tokens = self.tokens[active].to(device)[:, None]
+        context = torch.empty((len(active), 0, self.net.attn_layers.dim), device=device)
+        cache = LayerIntermediates(hiddens=None, attn_intermediates=[Intermediates(None, None, c) for c in self.caches])
+
+        pos = positions[:, None] if not isinstance(self.net.pos_emb, always) else None
+        logits = self.net(tokens, context=context, cache=cache, pos=pos)
+        samples = logits[:, -1].argmax(dim=-1).tolist()
+
+        if exists(self.pool):
+            self.pool.commit(active)
+
+        self.num_steps += 1
+        self.num_slot_steps += len(active)
+
+        finished = []
+        for slot, token in zip(active, samples):
+            output = self.outputs[slot]
+            done = token == self.eos_token
+
+            if not done:
+                output.append(token)
+                self.tokens[slot] = token
+
+            if done or len(output) >= self.max_len:
+                finished.append((self.keys[slot], output))
+                self.release(slot)
+
+        return finished
+
+    def run(self, sources):
+        # translates an iterable of source ids, yielding (index, ids) in order of completion, ids cut before eos
+        sources = iter(enumerate(sources))
+        exhausted = False
+
+        while True:
+            while not exhausted and len(self.pending) < self.num_slots:
+                item = next(sources, None)
+                if item is None:
+                    exhausted = True
+                    break
+                self.add(item[1], key=item[0])
+
+            if not self.has_work():
+                return
+
+            yield from self.step()
@@ -0,0 +1,370 @@
+import os
+import re
+import json
+import time
+import random
+import signal
+import shutil
+import threading
+
+import numpy as np
+import torch
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+
+def default_dict(val):
+    return val if exists(val) else dict()
+
+
+def tensor_key(t):
+    return (t.device, t.data_ptr(), t.dtype, tuple(t.shape), tuple(t.stride()))
+
+
+def map_tensors(fn, obj, memo=None):
+    # tensors viewing the same memory (tied weights) are mapped once, so they stay shared
+    memo = memo if exists(memo) else dict()
+
+    if torch.is_tensor(obj):
+        if obj.numel() == 0:
+            return fn(obj)
+        key = tensor_key(obj)
+        if key not in memo:
+            memo[key] = fn(obj)
+        return memo[key]
+    if isinstance(obj, dict):
+        return {key: map_tensors(fn, value, memo) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(map_tensors(fn, value, memo) for value in obj)
+    return obj
+
+
+def snapshot(obj):
+    # copy on the tensors' own device, so the training loop can keep updating the originals
+    return map_tensors(lambda t: t.detach().clone(), obj)
+
+
+def to_cpu(obj):
+    return map_tensors(lambda t: t.cpu(), obj)
+
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_synced(obj, path, save_fn=torch.save):
+    with open(path, 'wb') as f:
+        save_fn(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def atomic_save(obj, path, save_fn=torch.save):
+    # write next to the destination, then rename, so readers never see a half written file
+    tmp_path = path + '.tmp'
+    write_synced(obj, tmp_path, save_fn=save_fn)
+    os.replace(tmp_path, path)
+    fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+# flat weights format, for memory mapped loading
+# layout: magic, header length (8 bytes little endian), json header, then the raw tensor bytes
+# the header maps each name to its dtype, shape and byte offset, offsets are aligned so tensors can be viewed in place
+
+FLAT_MAGIC = b'XTFLAT01'
+FLAT_ALIGN = 64
+
+DTYPES = {str(dtype): dtype for dtype in (
+    torch.float64, torch.float32, torch.float16, torch.bfloat16,
+    torch.int64, torch.int32, torch.int16, torch.int8, torch.uint8, torch.bool
+)}
+
+
+def align(offset):
+    return (offset + FLAT_ALIGN - 1) // FLAT_ALIGN * FLAT_ALIGN
+
+
+def tensor_bytes(t):
+    return t.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy()
+
+
+def save_flat_state_dict(state_dict, f):
+    header = dict()
+    tensors = []
+    offset = 0
+
+    # tensors sharing storage (tied weights) are written once
+    seen = dict()
+
+    for name, t in state_dict.items():
+        key = tensor_key(t) if t.numel() > 0 else None
+
+        if key in seen:
+            header[name] = header[seen[key]]
+            continue
+
+        nbytes = t.numel() * t.element_size()
+        header[name] = dict(dtype=str(t.dtype), shape=list(t.shape), offset=offset, nbytes=nbytes)
+        tensors.append((offset, t))
+        offset = align(offset + nbytes)
+
+        if exists(key):
+            seen[key] = name
+
+    header = json.dumps(header).encode('utf-8')
+    data_start = align(len(FLAT_MAGIC) + 8 + len(header))
+
+    f.write(FLAT_MAGIC)
+    f.write(len(header).to_bytes(8, 'little'))
+    f.write(header)
+    f.write(b'\0' * (data_start - f.tell()))
+
+    for tensor_offset, t in tensors:
+        f.write(b'\0' * (data_start + tensor_offset - f.tell()))
+        f.write(tensor_bytes(t).tobytes())
+
+
+def is_flat_file(path):
+    with open(path, 'rb') as f:
+        return f.read(len(FLAT_MAGIC)) == FLAT_MAGIC
+
+
+def load_flat_state_dict(path):
+    # copy on write memory map: tensors are views of the page cache, shared by all processes reading the same file,
+    # and nothing is read from disk before a tensor is actually used
+    buffer = np.memmap(path, dtype=np.uint8, mode='c')
+    assert bytes(buffer[:len(FLAT_MAGIC)]) == FLAT_MAGIC, f'{path} is not a flat weights file'
+
+    header_len = int.from_bytes(bytes(buffer[len(FLAT_MAGIC):len(FLAT_MAGIC) + 8]), 'little')
+    header_start = len(FLAT_MAGIC) + 8
+    header = json.loads(bytes(buffer[header_start:header_start + header_len]).decode('utf-8'))
+    data_start = align(header_start + header_len)
+
+    state_dict = dict()
+    for name, info in header.items():
+        start = data_start + info['offset']
+        data = torch.from_numpy(buffer[start:start + info['nbytes']])
+        state_dict[name] = data.view(DTYPES[info['dtype']]).view(info['shape'])
+
+    return state_dict
+
+
+def adapt_state_dict_keys(state_dict, model):
+    # strip or add the `module.` prefix DistributedDataParallel puts in front of every parameter name
+    prefix = 'module.'
+    model_wrapped = all(key.startswith(prefix) for key in model.state_dict().keys())
+    state_wrapped = all(key.startswith(prefix) for key in state_dict.keys())
+
+    if model_wrapped and not state_wrapped:
+        return {prefix + key: value for key, value in state_dict.items()}
+
+    if state_wrapped and not model_wrapped:
+        return {key[len(prefix):]: value for key, value in state_dict.items()}
+
+    return state_dict
+
+
+def load_state_dict_file(path, map_location='cpu'):
+    if is_flat_file(path):
+        return load_flat_state_dict(path)
+
+    return torch.load(path, map_location=map_location)
+
+
+def load_weights(model, path, strict=True):
+    # parameters are filled straight from the memory mapped file, without unpickling an intermediate copy
+    state_dict = load_state_dict_file(path)
+    state_dict = adapt_state_dict_keys(state_dict, model)
+    return model.load_state_dict(state_dict, strict=strict)
+
+
+# random number generators, so a resumed run draws the same dropouts and layer drops
+
+def rng_state():
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return dict(
+        python=random.getstate(),
+        numpy=(name, keys.tolist(), pos, has_gauss, cached_gaussian),
+        torch=torch.get_rng_state(),
+        cuda=torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []
+    )
+
+
+def set_rng_state(state):
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    random.setstate(state['python'])
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+
+    if torch.cuda.is_available() and len(state['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+# preemption
+
+class PreemptionHandler:
+    '''
+    Records that the job is about to be killed, so the training loop can checkpoint at the next step boundary.
+    SLURM sends SIGUSR1 ahead of the time limit with `#SBATCH --signal`, and SIGTERM on preemption. As launchers do not
+    always forward signals to the workers, a flag file touched after the handler was created counts as a request too.
+    '''
+
+    def __init__(self, signals=(signal.SIGUSR1, signal.SIGTERM), flag_file=None):
+        self.flag_file = flag_file
+        self.start_time = time.time()
+        self.signal_received = False
+
+        for sig in signals:
+            signal.signal(sig, self._handle)
+
+    def _handle(self, signum, frame):
+        self.signal_received = True
+
+    def requested(self):
+        if self.signal_received:
+            return True
+
+        if not exists(self.flag_file) or not os.path.exists(self.flag_file):
+            return False
+
+        return os.path.getmtime(self.flag_file) >= self.start_time
+
+
+# checkpoint manager
+
+class CheckpointManager:
+    '''
+    Saves training checkpoints from the main process only. The state is snapshotted on device in the calling
+    thread, then moved to cpu and written by a background thread, so training resumes as soon as the copy is queued.
+    Every checkpoint is a directory `step_xxxxxxxx` holding the model weights, in the flat memory mappable format, and
+    the training state (optimizer, scheduler, sampler, ...). It is written under a temporary name and renamed once complete, and only the last
+    `keep_last` checkpoints are kept.
+    '''
+
+    model_file = 'model.weights'
+    state_file = 'training_state.pt'
+
+    def __init__(self, directory, keep_last=3, is_main_process=True):
+        self.directory = directory
+        self.keep_last = keep_last
+        self.is_main_process = is_main_process
+
+        self._thread = None
+        self._error = None
+
+        if is_main_process:
+            os.makedirs(directory, exist_ok=True)
+
+    # saving
+
+    def save(self, step, model, **training_state):
+        if not self.is_main_process:
+            return
+
+        # at most one checkpoint in flight, which bounds the extra device memory to one snapshot
+        self.wait()
+
+        state = snapshot(dict(model=model, **training_state))
+        self._start(self._write_checkpoint, step, state)
+
+    def save_files(self, weights=None, files=None):
+        # dictionaries of destination path -> model state dict (flat format) or any other object (pickled)
+        if not self.is_main_process:
+            return
+
+        self.wait()
+        self._start(self._write_files, snapshot(default_dict(weights)), snapshot(default_dict(files)))
+
+    def wait(self):
+        if exists(self._thread):
+            self._thread.join()
+            self._thread = None
+
+        if exists(self._error):
+            error, self._error = self._error, None
+            raise RuntimeError('writing checkpoint failed') from error
+
+    def close(self):
+        self.wait()
+
+    def _start(self, fn, *args):
+        def run():
+            try:
+                fn(*args)
+            except Exception as error:
+                self._error = error
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def _write_files(self, weights, files):
+        for path, state_dict in weights.items():
+            atomic_save(to_cpu(state_dict), path, save_fn=save_flat_state_dict)
+
+        for path, obj in files.items():
+            atomic_save(to_cpu(obj), path)
+
+    def _write_checkpoint(self, step, state):
+        state = to_cpu(state)
+        model = state.pop('model')
+
+        name = 'step_%08d' % step
+        path = os.path.join(self.directory, name)
+        tmp_path = os.path.join(self.directory, '.' + name + '.tmp')
+
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        write_synced(model, os.path.join(tmp_path, self.model_file), save_fn=save_flat_state_dict)
+        write_synced(state, os.path.join(tmp_path, self.state_file))
+
+        fsync_dir(tmp_path)
+
+        # a checkpoint directory for this step can only exist from a previous run, replace it
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+        fsync_dir(self.directory)
+
+        self._prune()
+
+    def _prune(self):
+        if self.keep_last <= 0:
+            return
+
+        for path in self.checkpoints()[:-self.keep_last]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    # loading
+
+    def checkpoints(self):
+        if not os.path.isdir(self.directory):
+            return []
+
+        names = [name for name in os.listdir(self.directory) if re.fullmatch(r'step_\d{8}', name)]
+        return [os.path.join(self.directory, name) for name in sorted(names)]
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if len(checkpoints) > 0 else None
+
+    def model_path(self, path=None):
+        path = path if exists(path) else self.latest()
+        assert exists(path), f'no checkpoint found in {self.directory}'
+        return os.path.join(path, self.model_file)
+
+    def load_model(self, path=None):
+        return load_flat_state_dict(self.model_path(path))
+
+    def load(self, path=None, map_location='cpu'):
+        path = path if exists(path) else self.latest()
+        assert exists(path), f'no checkpoint found in {self.directory}'
+        state = torch.load(os.path.join(path, self.state_file), map_location=map_location)
+        state['model'] = self.load_model(path)
+        return state
@@ -0,0 +1,51 @@
+import torch.distributed as dist
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks, powerSGD_hook
+
+COMM_HOOKS = ('none', 'fp16', 'bf16', 'powersgd')
+
+
+def serialized(hook):
+    # PowerSGD issues the all-reduce of the second factor from a callback, which can race with the collectives of the
+    # next bucket, so processes may issue them in different orders and gloo aborts on the mismatch: on gloo every
+    # bucket finishes before the next one starts
+    def serialized_hook(state, bucket):
+        fut = hook(state, bucket)
+        fut.wait()
+        return fut
+
+    return serialized_hook
+
+
+def register_comm_hook(model, name, powersgd_rank=1, powersgd_start_iter=1000, process_group=None):
+    '''
+    Compresses the gradients DistributedDataParallel `model` all-reduces:
+    - fp16 / bf16: buckets are cast to half precision for the all-reduce and back, half the bytes of fp32
+    - powersgd: the gradient of every matrix is approximated by the product of two rank `powersgd_rank` factors, the
+    only things all-reduced, with error feedback (what the approximation missed is added to the next gradient) and
+    warm started factors. The first `powersgd_start_iter` steps use plain all-reduce, PowerSGD is biased and early
+    training is the most sensitive to it. Vectors (biases, norms) are always all-reduced uncompressed.
+    Returns the PowerSGD state, with the error feedback and the compression statistics, or None.
+    '''
+    if name == 'none':
+        return None
+
+    if name == 'fp16':
+        model.register_comm_hook(process_group, default_hooks.fp16_compress_hook)
+        return None
+
+    if name == 'bf16':
+        model.register_comm_hook(process_group, default_hooks.bf16_compress_hook)
+        return None
+
+    if name == 'powersgd':
+        state = powerSGD_hook.PowerSGDState(process_group=process_group, matrix_approximation_rank=powersgd_rank,
+                                            start_powerSGD_iter=powersgd_start_iter, use_error_feedback=True,
+                                            warm_start=True)
+        hook = powerSGD_hook.powerSGD_hook
+        if dist.get_backend(process_group) == 'gloo':
+            hook = serialized(hook)
+
+        model.register_comm_hook(state, hook)
+        return state
+
+    raise ValueError('unknown communication hook %s, expected one of %s' % (name, ', '.join(COMM_HOOKS)))
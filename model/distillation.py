@@ -0,0 +1,186 @@
+import os
+import json
+
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from utils import PackedCollate, length_batches
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+
+def num_positions(length, max_len):
+    # target positions the training loss predicts for a target sentence: every token after the first, once truncated
+    return max(min(length, max_len) - 1, 0)
+
+
+# teacher store
+# layout of the directory: ids.bin (uint16 when the vocabulary fits, int32 otherwise) and logprobs.bin (float16), both
+# (positions, k) in the order of the corpus, offsets.npy the first row of every sentence (sentences + 1), and
+# meta.json, written last, so an interrupted run leaves no readable store
+
+class TeacherStore():
+    '''
+    Top k token ids and log probabilities of a teacher at every target position of a corpus, memory mapped, indexed
+    like the corpus: the rows of sentence i are offsets[i]:offsets[i + 1]. 4 bytes per entry, 64 bytes per target
+    token with the default k of 16, instead of 4 bytes per vocabulary entry for the full distribution.
+    The files are only mapped on first access, so the store can be handed to DataLoader workers.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+        with open(os.path.join(directory, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+
+        self.offsets = np.load(os.path.join(directory, 'offsets.npy'))
+        self._ids = None
+        self._logprobs = None
+
+    @property
+    def topk(self):
+        return self.meta['topk']
+
+    @property
+    def max_len(self):
+        return self.meta['max_len']
+
+    @property
+    def num_sentences(self):
+        return len(self.offsets) - 1
+
+    def arrays(self):
+        if self._ids is None:
+            shape = (int(self.offsets[-1]), self.topk)
+            self._ids = np.memmap(os.path.join(self.directory, 'ids.bin'), dtype=self.meta['ids_dtype'], mode='r',
+                                  shape=shape)
+            self._logprobs = np.memmap(os.path.join(self.directory, 'logprobs.bin'), dtype=np.float16, mode='r',
+                                       shape=shape)
+        return self._ids, self._logprobs
+
+    def __getstate__(self):
+        return {**self.__dict__, '_ids': None, '_logprobs': None}
+
+    def positions(self, indices):
+        # number of stored positions of each sentence, 0 past the end of the store
+        inside = indices < self.num_sentences
+        counts = np.zeros(len(indices), dtype=np.int64)
+        counts[inside] = self.offsets[indices[inside] + 1] - self.offsets[indices[inside]]
+        return counts
+
+    def gather(self, indices, columns):
+        # (b, columns, k) ids (-1 where nothing is stored) and log probabilities of the sentences `indices`
+        ids, logprobs = self.arrays()
+        counts = self.positions(indices)
+        starts = np.where(indices < self.num_sentences, self.offsets[np.minimum(indices, self.num_sentences - 1)], 0)
+
+        grid = np.arange(columns, dtype=np.int64)
+        valid = grid[None, :] < counts[:, None]
+        rows = (starts[:, None] + grid[None, :])[valid]
+
+        out_ids = np.full((len(indices), columns, self.topk), -1, dtype=np.int64)
+        out_logprobs = np.zeros((len(indices), columns, self.topk), dtype=np.float32)
+        out_ids[valid] = ids[rows]
+        out_logprobs[valid] = logprobs[rows]
+        return out_ids, out_logprobs
+
+
+@torch.no_grad()
+def teacher_topk(model, src, tgt, mask_src, topk):
+    # teacher forced decoder distributions of a batch, as the training loss sees them, reduced to their top k
+    enc = model.encoder(src, mask=mask_src, return_embeddings=True)
+    logits = model.decoder.net(tgt[:, :-1], context=enc, context_mask=mask_src)
+    logprobs, ids = logits.float().log_softmax(dim=-1).topk(topk, dim=-1)
+    return ids, logprobs
+
+
+@torch.no_grad()
+def build_teacher_store(model, X, Y, directory, topk=16, max_len=120, max_batch_tokens=8192, max_batch_size=256,
+                        device='cpu', pad_idx=3, log_every=None):
+    '''
+    Runs the teacher once over the corpus (X, Y), in batches of sentences of similar lengths, and writes the top k of
+    its distribution at every target position to a TeacherStore in `directory`. Sentences are truncated to `max_len`
+    as in PackedTextDataset, so the store lines up with the training batches of the same corpus and max_len.
+    '''
+    assert len(X) == len(Y), 'source and target corpora must be aligned'
+    os.makedirs(directory, exist_ok=True)
+
+    meta_path = os.path.join(directory, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    was_training = model.training
+    model.eval()
+
+    vocab_size = model.decoder.net.token_emb.emb.num_embeddings
+    ids_dtype = 'uint16' if vocab_size <= np.iinfo(np.uint16).max else 'int32'
+
+    counts = np.array([num_positions(len(y), max_len) for y in Y], dtype=np.int64)
+    offsets = np.zeros(len(Y) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    shape = (max(int(offsets[-1]), 1), topk)
+    ids = np.memmap(os.path.join(directory, 'ids.bin'), dtype=ids_dtype, mode='w+', shape=shape)
+    logprobs = np.memmap(os.path.join(directory, 'logprobs.bin'), dtype=np.float16, mode='w+', shape=shape)
+
+    lengths = [max(min(len(x), max_len), min(len(y), max_len)) for x, y in zip(X, Y)]
+    batches = [batch for batch in length_batches(lengths, max_batch_tokens, max_batch_size)
+               if counts[batch].sum() > 0]
+
+    for step, batch in enumerate(batches):
+        src = pad_sequence([torch.as_tensor(X[i][:max_len], dtype=torch.long) for i in batch], batch_first=True,
+                           padding_value=pad_idx).to(device)
+        tgt = pad_sequence([torch.as_tensor(Y[i][:max_len], dtype=torch.long) for i in batch], batch_first=True,
+                           padding_value=pad_idx).to(device)
+
+        batch_ids, batch_logprobs = teacher_topk(model, src, tgt, src != pad_idx, topk)
+        batch_ids, batch_logprobs = batch_ids.cpu().numpy(), batch_logprobs.cpu().numpy()
+
+        for row, i in enumerate(batch):
+            start, end = offsets[i], offsets[i + 1]
+            ids[start:end] = batch_ids[row, :end - start]
+            logprobs[start:end] = batch_logprobs[row, :end - start]
+
+        if exists(log_every) and (step + 1) % log_every == 0:
+            print('teacher: %d / %d batches' % (step + 1, len(batches)), flush=True)
+
+    ids.flush()
+    logprobs.flush()
+    np.save(os.path.join(directory, 'offsets.npy'), offsets)
+
+    with open(meta_path, 'w') as f:
+        json.dump(dict(topk=topk, max_len=max_len, ids_dtype=ids_dtype, num_sentences=len(Y)), f)
+
+    model.train(was_training)
+    return TeacherStore(directory)
+
+
+# student side
+
+class DistillationCollate(PackedCollate):
+    '''
+    PackedCollate batches with the teacher top k of every target position appended, gathered from the memory mapped
+    store in the same vectorized way: (src, tgt, mask_src, teacher_ids, teacher_logprobs), the teacher tensors
+    (b, tgt length - 1, k) aligned with the predicted positions, ids -1 where the teacher has nothing (padding).
+    '''
+
+    def __init__(self, dataset, store, pad_idx):
+        super().__init__(dataset, pad_idx)
+        assert store.max_len == dataset.max_len, 'the teacher store was built with max_len %d, the dataset uses %d' % (
+            store.max_len, dataset.max_len)
+        self.store = store
+
+    def __call__(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        src, tgt, mask = super().__call__(indices)
+
+        expected = np.maximum(self.dataset.tgt[2][indices] - 1, 0)
+        assert (self.store.positions(indices) == expected).all(), 'the teacher store does not line up with the corpus'
+
+        ids, logprobs = self.store.gather(indices, max(tgt.shape[1] - 1, 0))
+        return src, tgt, mask, torch.from_numpy(ids), torch.from_numpy(logprobs)
+
@@ -0,0 +1,201 @@
+import torch
+import torch.nn.functional as F
+
+from model.xtransformer import windowed_decoding, crop_to_window
+
+CONFIDENCE_MEASURES = ('softmax', 'state')
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+
+def decoder_layers(attn_layers):
+    # the sublayers ('a', 'c', 'f') of each decoder layer, a layer ending with its feedforward
+    layers, current = [], []
+    for ind, layer_type in enumerate(attn_layers.layer_types):
+        current.append(ind)
+        if layer_type == 'f':
+            layers.append(current)
+            current = []
+
+    if len(current) > 0:
+        layers.append(current)
+
+    return layers
+
+
+def run_sublayer(attn_layers, ind, x, context, context_mask, cache, start=0):
+    # one step of the loop of AttentionLayers.forward at inference, returns the output and the updated key / value cache.
+    # `start` is the position of the first token of x, windowed caches do not hold every earlier one
+    layer_type = attn_layers.layer_types[ind]
+    (pre_branch_norm, post_branch_norm, post_main_norm), block, residual_fn = attn_layers.layers[ind]
+
+    residual = x
+
+    if exists(pre_branch_norm):
+        x = pre_branch_norm(x)
+
+    cached_kv = None
+
+    if layer_type == 'a':
+        rotary_pos_emb = None
+        if exists(attn_layers.rotary_pos_emb):
+            rotary_pos_emb = attn_layers.rotary_pos_emb(start + x.shape[1], x.device)
+
+        out, inter = block(x, rel_pos=attn_layers.rel_pos, rotary_pos_emb=rotary_pos_emb, cache=cache)
+        cached_kv = inter.cached_kv
+    elif layer_type == 'c':
+        out, inter = block(x, context=context, context_mask=context_mask, cache=cache)
+        cached_kv = inter.cached_kv
+    else:
+        out = block(x)
+
+    if exists(post_branch_norm):
+        out = post_branch_norm(out)
+
+    x = residual_fn(out, residual)
+
+    if exists(post_main_norm):
+        x = post_main_norm(x)
+
+    return x, cached_kv
+
+
+# early exit decoding
+
+@torch.no_grad()
+def early_exit_generate(
+        model,
+        seq_in,
+        seq_out_start,
+        seq_len,
+        mask=None,
+        eos_token=None,
+        threshold=0.9,
+        confidence='softmax',
+        min_layers=1
+):
+    '''
+    Greedy decoding where every step stops at the first decoder layer whose prediction is confident enough, instead of
+    running all of them. The intermediate states are read out with the final norm and output projection of the decoder
+    (the layer dropout of training makes them usable). The confidence of a layer is
+    - softmax: the probability of its best token, the logits of the exit layer give the token
+    - state: the cosine similarity between its output and the output of the previous layer, which needs no projection
+    onto the vocabulary at every layer, only at the exit one
+    A batch exits when all its unfinished sequences are confident.
+
+    The positions that exited early have no keys / values in the layers above their exit. They are filled in lazily:
+    the first later token that goes deeper than them carries them along, and each layer runs on them together with
+    it, from the state they had where they stopped. Every state, and so every key / value, is then exactly the one of
+    the full model on the generated tokens, and positions that never need them (the end of the sentence) never
+    compute them. Past max_seq_len, the last max_seq_len tokens are run again from scratch at every step, as in
+    generate_cached (see crop_to_window).
+
+    Returns the generated tokens and statistics: the number of steps, the layers used summed over steps and the
+    (position, layer) pairs computed, lazy fills included.
+    '''
+    assert confidence in CONFIDENCE_MEASURES, 'confidence must be one of %s' % ', '.join(CONFIDENCE_MEASURES)
+
+    net, pad_value = model.decoder.net, model.decoder.pad_value
+    attn_layers = net.attn_layers
+    assert not (attn_layers.residual_attn or attn_layers.cross_residual_attn), 'residual attention ties every layer to the previous one'
+    assert net.num_memory_tokens == 0, 'memory tokens are not supported'
+
+    was_training = net.training
+    net.eval()
+
+    context = model.encoder(seq_in, mask=mask, return_embeddings=True)
+
+    layers = decoder_layers(attn_layers)
+    depth = len(layers)
+
+    caches = [None] * len(attn_layers.layer_types)
+    # positions every sublayer has run on
+    lengths = [0] * len(attn_layers.layer_types)
+    # states at the input of every layer, of the positions that went through the layer below but not this one
+    pending = [None] * depth
+
+    t = seq_out_start.shape[-1]
+    out = seq_out_start
+    finished = torch.zeros(out.shape[0], dtype=torch.bool, device=out.device)
+
+    stats = dict(steps=0, layers=0, computed=0)
+
+    windowed = windowed_decoding(net)
+
+    def embed(tokens, start):
+        pos = torch.arange(start, start + tokens.shape[1], device=tokens.device)
+        x = net.token_emb(tokens) + net.pos_emb(tokens, pos=pos)
+        return net.project_emb(net.post_emb_norm(x))
+
+    def logits_of(h):
+        return net.to_logits(net.norm(h))
+
+    x = embed(out, 0)
+
+    for _ in range(seq_len):
+        exit_logits = None
+
+        for layer, sublayers in enumerate(layers):
+            if exists(pending[layer]):
+                x = torch.cat((pending[layer], x), dim=1)
+                pending[layer] = None
+
+            previous = x[:, -1]
+
+            for ind in sublayers:
+                x, caches[ind] = run_sublayer(attn_layers, ind, x, context, mask, caches[ind], start=lengths[ind])
+                lengths[ind] += x.shape[1]
+
+            stats['computed'] += x.shape[1]
+
+            if layer == depth - 1 or layer + 1 < min_layers:
+                continue
+
+            h = x[:, -1]
+            if confidence == 'softmax':
+                exit_logits = logits_of(h)
+                confident = exit_logits.softmax(dim=-1).amax(dim=-1) >= threshold
+            else:
+                confident = F.cosine_similarity(h, previous, dim=-1) >= threshold
+
+            if (confident | finished).all():
+                above = pending[layer + 1]
+                pending[layer + 1] = torch.cat((above, x), dim=1) if exists(above) else x
+                break
+
+            exit_logits = None
+
+        stats['steps'] += 1
+        stats['layers'] += layer + 1
+
+        logits = exit_logits if exists(exit_logits) else logits_of(x[:, -1])
+        sample = logits.argmax(dim=-1, keepdim=True)
+
+        out = torch.cat((out, sample), dim=-1)
+
+        if exists(eos_token):
+            is_eos_tokens = (out == eos_token)
+            finished = is_eos_tokens[:, t:].any(dim=-1)
+
+            if finished.all():
+                shifted_is_eos_tokens = F.pad(is_eos_tokens, (1, -1))
+                out = out.masked_fill(shifted_is_eos_tokens.float().cumsum(dim=-1) >= 1, pad_value)
+                break
+
+        tokens, caches = crop_to_window(net, out, caches, windowed)
+
+        if exists(caches):
+            x = embed(sample, out.shape[-1] - 1)
+            continue
+
+        # the window slid, every layer starts over on its tokens
+        caches = [None] * len(attn_layers.layer_types)
+        lengths = [0] * len(attn_layers.layer_types)
+        pending = [None] * depth
+        x = embed(tokens, 0)
+
+    net.train(was_training)
+    return out[:, t:], stats
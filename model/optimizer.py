@@ -1,21 +1,153 @@
-
+import torch
+import torch.distributed as dist
 from torch.optim import AdamW
 
+from model.zero import ZeroAdamW
+from model.adam8bit import AdamW8bit
+
 def separate_weight_decayable_params(params):
-    no_wd_params = set([param for param in params if param.ndim < 2])
-    wd_params = set(params) - no_wd_params
+    # lists in the order of params, so every run and every rank builds the same groups
+    wd_params = [param for param in params if param.ndim >= 2]
+    no_wd_params = [param for param in params if param.ndim < 2]
     return wd_params, no_wd_params
 
-def get_optimizer(params, lr = 3e-4, wd = 1e-1, filter_by_requires_grad = False):
+def flatten_(params):
+    # the parameters and their gradients become views of two flat buffers, one after the other in order
+    ref = params[0]
+    flat = torch.empty(sum(p.numel() for p in params), dtype = ref.dtype, device = ref.device)
+    flat.grad = torch.zeros_like(flat)
+
+    offset = 0
+    for p in params:
+        numel = p.numel()
+        flat[offset:offset + numel].copy_(p.data.reshape(-1))
+        p.data = flat[offset:offset + numel].view_as(p)
+        p.grad = flat.grad[offset:offset + numel].view_as(p)
+        offset += numel
+
+    return flat
+
+class FlatAdamW(AdamW):
+    '''
+    AdamW over one flat buffer per parameter group: the parameters and gradients of the model are views of the buffers,
+    so the update, weight decay included, is a single fused (or foreach) AdamW call per group, and `clip_grad_norm_`
+    is a norm and a multiplication per group instead of a pass over every tensor.
+    Gradients are zeroed in place, never set to None, as the views must stay attached. The model must be on its device
+    before the optimizer is built, moving it afterwards would detach the parameters from the buffers.
+    As with AdamW, parameters that got no gradient since the last zero_grad (a layer skipped by layer dropout) keep their
+    values and moments: a parameter has one once backward accumulated into it, on any process, or its .grad was
+    replaced. Gradients written in place into the views are not seen. Unlike AdamW, the bias correction counts the steps
+    of the whole group, as in ZeroAdamW, so a parameter that skipped steps is corrected slightly less afterwards.
+    '''
+
+    def __init__(self, param_groups, lr = 3e-4, weight_decay = 1e-1, **kwargs):
+        param_groups = [group for group in param_groups if len(group['params']) > 0]
+        self.params = [param for group in param_groups for param in group['params']]
+
+        flat_groups = [{**group, 'params': [flatten_(group['params'])]} for group in param_groups]
+        self.grad_views = [param.grad for param in self.params]
+
+        # flat buffer and range of every parameter, to put back the ones without gradient after the fused step
+        self.segments = []
+        for group, flat_group in zip(param_groups, flat_groups):
+            offset = 0
+            for param in group['params']:
+                self.segments.append((flat_group['params'][0], offset, offset + param.numel()))
+                offset += param.numel()
+
+        device = flat_groups[0]['params'][0].device
+
+        self.has_grad = torch.zeros(len(self.params), device = device)
+        for index, param in enumerate(self.params):
+            param.register_post_accumulate_grad_hook(self.grad_hook(index))
+
+        fused = device.type in ('cuda', 'cpu')
+        super().__init__(flat_groups, lr = lr, weight_decay = weight_decay, fused = fused, foreach = not fused or None, **kwargs)
+
+    def grad_hook(self, index):
+        def hook(param):
+            self.has_grad[index] = 1.
+
+        return hook
+
+    def flat_grads(self):
+        # gradients replaced behind the optimizer's back (model.zero_grad() sets them to None) are put back in the buffers
+        for index, (param, view) in enumerate(zip(self.params, self.grad_views)):
+            if param.grad is view:
+                continue
+
+            if param.grad is None:
+                view.zero_()
+                self.has_grad[index] = 0.
+            else:
+                view.copy_(param.grad)
+                self.has_grad[index] = 1.
+
+            param.grad = view
+
+        return [flat.grad for group in self.param_groups for flat in group['params']]
+
+    @torch.no_grad()
+    def clip_grad_norm_(self, max_norm):
+        grads = self.flat_grads()
+        total_norm = torch.linalg.vector_norm(torch.stack(torch._foreach_norm(grads)))
+
+        clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max = 1.)
+        torch._foreach_mul_(grads, clip_coef)
+        return total_norm
+
+    @torch.no_grad()
+    def step(self, closure = None):
+        self.flat_grads()
+
+        # a parameter used on any process has its gradient reduced to all of them
+        if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+            dist.all_reduce(self.has_grad, op = dist.ReduceOp.MAX)
+
+        skipped = [segment for segment, has_grad in zip(self.segments, self.has_grad.tolist()) if has_grad == 0]
+
+        def saved_tensors(flat):
+            return [flat, *(state for name, state in self.state[flat].items() if name != 'step')]
+
+        saved = [[t[start:end].clone() for t in saved_tensors(flat)] for flat, start, end in skipped]
+
+        loss = super().step(closure)
+
+        for (flat, start, end), values in zip(skipped, saved):
+            for t, value in zip(saved_tensors(flat), values):
+                t[start:end].copy_(value)
+
+        return loss
+
+    def zero_grad(self, set_to_none = False):
+        for grad in self.flat_grads():
+            grad.zero_()
+
+        self.has_grad.zero_()
+
+def get_optimizer(params, lr = 3e-4, wd = 1e-1, filter_by_requires_grad = False, zero = False, shard_gradients = False,
+                  fused = False, eight_bit = False):
+    assert (zero + fused + eight_bit) <= 1, 'zero, fused and eight_bit are different optimizers, pick one'
+
+    params = list(dict.fromkeys(params))
+
     if filter_by_requires_grad:
         params = list(filter(lambda t: t.requires_grad, params))
 
-    params = set(params)
     wd_params, no_wd_params = separate_weight_decayable_params(params)
 
     param_groups = [
-        {'params': list(wd_params)},
-        {'params': list(no_wd_params), 'weight_decay': 0},
+        {'params': wd_params},
+        {'params': no_wd_params, 'weight_decay': 0},
     ]
 
-    return AdamW(param_groups, lr = lr, weight_decay = wd)
\ No newline at end of file
+    if zero:
+        return ZeroAdamW(param_groups, lr = lr, weight_decay = wd, shard_gradients = shard_gradients, param_order = params)
+
+    if fused:
+        return FlatAdamW(param_groups, lr = lr, weight_decay = wd)
+
+    if eight_bit:
+        return AdamW8bit(param_groups, lr = lr, weight_decay = wd)
+
+    return AdamW(param_groups, lr = lr, weight_decay = wd)
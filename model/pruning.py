@@ -0,0 +1,234 @@
+import torch
+from torch import nn
+
+from model.xtransformer import Attention, AttentionLayers, FeedForward, GLU
+from model.checkpoint import load_state_dict_file, adapt_state_dict_keys
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+
+def pruned_linear(linear, rows=None, columns=None):
+    # a smaller copy of a linear layer, with only the given output rows and input columns
+    weight, bias = linear.weight.data, linear.bias.data if exists(linear.bias) else None
+
+    if exists(rows):
+        weight = weight[rows]
+        bias = bias[rows] if exists(bias) else None
+
+    if exists(columns):
+        weight = weight[:, columns]
+
+    pruned = nn.Linear(weight.shape[1], weight.shape[0], bias=exists(bias), device=weight.device, dtype=weight.dtype)
+    pruned.weight.data.copy_(weight)
+    if exists(bias):
+        pruned.bias.data.copy_(bias)
+
+    return pruned
+
+
+def head_indices(heads, dim_head, device):
+    # rows of the projections of the given heads, laid out as (h d)
+    heads = torch.as_tensor(heads, dtype=torch.long, device=device)
+    return (heads[:, None] * dim_head + torch.arange(dim_head, device=device)).reshape(-1)
+
+
+def attention_modules(model):
+    return [(name, module) for name, module in model.named_modules() if isinstance(module, Attention)]
+
+
+def feedforward_modules(model):
+    return [(name, module) for name, module in model.named_modules() if isinstance(module, FeedForward)]
+
+
+def output_linear(attn):
+    return attn.to_out if isinstance(attn.to_out, nn.Linear) else attn.to_out[0]
+
+
+def ff_inner_dim(ff):
+    return ff.ff[-1].in_features
+
+
+# structured pruning
+
+def prune_heads_(attn, keep):
+    # keeps the heads `keep` of an attention block, removing the rows of the others from the query / key / value
+    # projections and their columns from the output projection
+    assert attn.kv_heads == attn.heads, 'heads sharing keys / values in groups are not supported'
+    assert not (attn.talking_heads or attn.head_scale or exists(attn.to_r) or exists(attn.to_v_gate) or
+                attn.num_mem_kv > 0), 'talking heads, head scales, tensor product, gated values and memory key / values are not supported'
+
+    heads = attn.heads
+    to_out = output_linear(attn)
+    dim_head, value_dim_head = attn.to_q.out_features // heads, to_out.in_features // heads
+    device = attn.to_q.weight.device
+
+    qk_rows = head_indices(keep, dim_head, device)
+    v_rows = head_indices(keep, value_dim_head, device)
+
+    attn.to_q = pruned_linear(attn.to_q, rows=qk_rows)
+    attn.to_k = pruned_linear(attn.to_k, rows=qk_rows)
+    if exists(attn.to_v):
+        attn.to_v = pruned_linear(attn.to_v, rows=v_rows)
+
+    if isinstance(attn.to_out, nn.Linear):
+        attn.to_out = pruned_linear(attn.to_out, columns=v_rows)
+    else:
+        attn.to_out[0] = pruned_linear(attn.to_out[0], columns=v_rows)
+
+    attn.heads = attn.kv_heads = len(keep)
+    return attn
+
+
+def prune_neurons_(ff, keep):
+    # keeps the hidden units `keep` of a feedforward block
+    keep = torch.as_tensor(keep, dtype=torch.long, device=ff.ff[-1].weight.device)
+    project_in = ff.ff[0]
+
+    if isinstance(project_in, GLU):
+        inner_dim = project_in.proj.out_features // 2
+        project_in.proj = pruned_linear(project_in.proj, rows=torch.cat((keep, keep + inner_dim)))
+    else:
+        project_in[0] = pruned_linear(project_in[0], rows=keep)
+
+    if isinstance(ff.ff[1], nn.LayerNorm):
+        norm = nn.LayerNorm(len(keep), device=keep.device)
+        norm.weight.data.copy_(ff.ff[1].weight.data[keep])
+        norm.bias.data.copy_(ff.ff[1].bias.data[keep])
+        ff.ff[1] = norm
+
+    ff.ff[-1] = pruned_linear(ff.ff[-1], columns=keep)
+    return ff
+
+
+# importance scores
+
+def importance_scores(model, batches):
+    '''
+    Gradient based importance (Michel et al., Are sixteen heads really better than one?): every head output and every
+    feedforward hidden unit is multiplied by a gate equal to 1, and the importance of a unit is the absolute gradient of
+    the loss with respect to its gate, summed over the batches (src, tgt, mask_src) - the first order estimate of how
+    much the loss changes when it is removed. Head scores are normalized by their l2 norm within each layer.
+    Returns {module name: scores} for attention heads and for feedforward units.
+    '''
+    was_training = model.training
+    model.eval()
+
+    gates, hooks = dict(), []
+
+    def gate_hook(gate, group_size):
+        def hook(module, inputs):
+            x = inputs[0]
+            x = x.unflatten(-1, (gate.shape[0], group_size)) * gate[:, None]
+            return (x.flatten(-2), *inputs[1:])
+        return hook
+
+    for name, attn in attention_modules(model):
+        gate = torch.ones(attn.heads, device=attn.to_q.weight.device, requires_grad=True)
+        hooks.append(attn.to_out.register_forward_pre_hook(gate_hook(gate, output_linear(attn).in_features // attn.heads)))
+        gates[name] = gate
+
+    for name, ff in feedforward_modules(model):
+        gate = torch.ones(ff_inner_dim(ff), device=ff.ff[-1].weight.device, requires_grad=True)
+        hooks.append(ff.ff[-1].register_forward_pre_hook(gate_hook(gate, 1)))
+        gates[name] = gate
+
+    names = list(gates.keys())
+    scores = {name: torch.zeros_like(gate) for name, gate in gates.items()}
+
+    for src, tgt, mask_src in batches:
+        loss = model(src, tgt, mask_src=mask_src)
+        grads = torch.autograd.grad(loss, [gates[name] for name in names], allow_unused=True)
+
+        for name, grad in zip(names, grads):
+            if exists(grad):
+                scores[name] += grad.abs()
+
+    for hook in hooks:
+        hook.remove()
+
+    model.train(was_training)
+
+    head_scores = {name: scores[name] / scores[name].norm().clamp(min=1e-12) for name, _ in attention_modules(model)}
+    neuron_scores = {name: scores[name] for name, _ in feedforward_modules(model)}
+    return head_scores, neuron_scores
+
+
+def prune_(model, head_scores, neuron_scores, head_fraction=0.25, neuron_fraction=0., min_heads=1):
+    '''
+    Removes the `head_fraction` least important heads of the whole model, ranked together so layers end up with
+    different numbers of heads (keeping at least `min_heads` per layer), and the `neuron_fraction` least important
+    hidden units of every feedforward block. Returns the number of heads kept per attention block and of hidden units
+    kept per feedforward block.
+    '''
+    # position biases (relative, ALiBi, dynamic) are shared by all the attention blocks of a stack, with one bias per
+    # head of the original count, they cannot follow heads pruned differently in every block
+    assert not any(exists(layers.rel_pos) for layers in model.modules() if isinstance(layers, AttentionLayers)), \
+        'models with relative, ALiBi or dynamic position biases cannot be pruned'
+
+    attns, ffs = dict(attention_modules(model)), dict(feedforward_modules(model))
+
+    ranked = sorted((score.item(), name, head) for name, scores in head_scores.items() for head, score in enumerate(scores))
+    num_pruned = int(head_fraction * len(ranked))
+
+    remaining = {name: attns[name].heads for name in head_scores}
+    pruned = {name: set() for name in head_scores}
+
+    for _, name, head in ranked:
+        if num_pruned == 0:
+            break
+
+        if remaining[name] <= min_heads:
+            continue
+
+        pruned[name].add(head)
+        remaining[name] -= 1
+        num_pruned -= 1
+
+    for name, attn in attns.items():
+        keep = [head for head in range(attn.heads) if head not in pruned.get(name, ())]
+        if len(keep) < attn.heads:
+            prune_heads_(attn, keep)
+
+    for name, scores in neuron_scores.items():
+        num_keep = len(scores) - int(neuron_fraction * len(scores))
+        if num_keep < len(scores):
+            keep = scores.topk(num_keep).indices.sort().values
+            prune_neurons_(ffs[name], keep)
+
+    return structure(model)
+
+
+def structure(model):
+    return dict(
+        heads={name: attn.heads for name, attn in attention_modules(model)},
+        ff_dims={name: ff_inner_dim(ff) for name, ff in feedforward_modules(model)}
+    )
+
+
+# loading pruned weights
+
+def resize_to_state_dict_(model, state_dict):
+    # shrinks the attention and feedforward blocks of a freshly built model to the shapes of pruned weights, which
+    # record the number of heads and hidden units of every block
+    for name, attn in attention_modules(model):
+        dim_head = attn.to_q.out_features // attn.heads
+        heads = state_dict[name + '.to_q.weight'].shape[0] // dim_head
+        if heads < attn.heads:
+            prune_heads_(attn, list(range(heads)))
+
+    for name, ff in feedforward_modules(model):
+        inner_dim = state_dict['%s.ff.%d.weight' % (name, len(ff.ff) - 1)].shape[1]
+        if inner_dim < ff_inner_dim(ff):
+            prune_neurons_(ff, list(range(inner_dim)))
+
+    return model
+
+
+def load_pruned_weights(model, path, strict=True):
+    # as load_weights, for weights saved after pruning
+    state_dict = adapt_state_dict_keys(load_state_dict_file(path), model)
+    resize_to_state_dict_(model, state_dict)
+    return model.load_state_dict(state_dict, strict=strict)
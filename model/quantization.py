@@ -0,0 +1,54 @@
+import copy
+
+import torch
+from torch import nn
+
+from model.xtransformer import Attention, FeedForward, TransformerWrapper
+
+try:
+    from torch.ao.quantization import quantize_dynamic, per_channel_dynamic_qconfig
+except ImportError:
+    from torch.quantization import quantize_dynamic, per_channel_dynamic_qconfig
+
+
+def untie_output_projection_(model):
+    # a tied output projection is a plain matmul with the embedding, give it its own linear layer so it can be quantized
+    for module in model.modules():
+        if not isinstance(module, TransformerWrapper) or isinstance(module.to_logits, nn.Module):
+            continue
+
+        weight = module.token_emb.emb.weight
+        to_logits = nn.Linear(weight.shape[1], weight.shape[0], bias=False)
+        to_logits.weight.data.copy_(weight.data)
+        module.to_logits = to_logits
+
+    return model
+
+
+def quantizable_linears(model):
+    # linear layers of the attention and feedforward blocks, and the output projections
+    names = set()
+
+    for name, module in model.named_modules():
+        prefix = name + '.' if name else ''
+
+        if isinstance(module, (Attention, FeedForward)):
+            names.update(prefix + sub_name for sub_name, sub in module.named_modules() if isinstance(sub, nn.Linear))
+
+        if isinstance(module, TransformerWrapper) and isinstance(module.to_logits, nn.Linear):
+            names.add(prefix + 'to_logits')
+
+    return names
+
+
+def quantize_int8(model):
+    '''
+    Returns a copy of the model for cpu inference, with the linear layers of attention, feedforward and output projection
+    replaced by int8 dynamically quantized ones: weights are quantized per output channel ahead of time, activations
+    per batch on the fly. Embeddings, layer norms and softmax stay in float.
+    '''
+    model = copy.deepcopy(model).cpu().eval()
+    untie_output_projection_(model)
+
+    qconfig_spec = {name: per_channel_dynamic_qconfig for name in quantizable_linears(model)}
+    return quantize_dynamic(model, qconfig_spec, dtype=torch.qint8)
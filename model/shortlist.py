@@ -0,0 +1,179 @@
+import hashlib
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from model.xtransformer import cached_decoding
+
+NUM_SPECIAL_TOKENS = 4  # eos, sos, unk, pad
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+
+def merge_counts(parts):
+    # sums the counts of identical codes over a list of (sorted unique codes, counts)
+    codes = np.concatenate([codes for codes, _ in parts])
+    counts = np.concatenate([counts for _, counts in parts])
+
+    order = np.argsort(codes, kind='stable')
+    codes, counts = codes[order], counts[order]
+    codes, starts = np.unique(codes, return_index=True)
+    return codes, np.add.reduceat(counts, starts)
+
+
+# building the shortlist from the parallel corpus
+
+def build_shortlist(sources, targets, vocab_size, topk=50, num_frequent=1000, chunk_size=10000):
+    '''
+    Counts, for every source token, the sentence pairs where each target token co-occurs with it, and keeps the `topk`
+    target tokens seen most often with it. The `num_frequent` most frequent target tokens (punctuation, articles, ...)
+    co-occur with everything and are candidates for every sentence anyway, so they are left out of the per token lists.
+    Returns the lists in compressed sparse rows (the candidates of source token s are indices[indptr[s]:indptr[s + 1]])
+    and the frequent tokens.
+    '''
+    parts, merged = [], None
+    target_counts = np.zeros(vocab_size, dtype=np.int64)
+
+    for start in range(0, len(sources), chunk_size):
+        codes = []
+        for src, tgt in zip(sources[start:start + chunk_size], targets[start:start + chunk_size]):
+            src, tgt = np.unique(src), np.unique(tgt)
+            codes.append((src[:, None].astype(np.int64) * vocab_size + tgt[None, :]).reshape(-1))
+            target_counts[tgt] += 1
+
+        parts.append(np.unique(np.concatenate(codes), return_counts=True))
+
+        # pairs are merged in groups, so each merge sorts a bounded number of new codes
+        if len(parts) == 16:
+            merged = merge_counts(parts + ([merged] if exists(merged) else []))
+            parts = []
+
+    if len(parts) > 0:
+        merged = merge_counts(parts + ([merged] if exists(merged) else []))
+
+    codes, counts = merged
+    source_ids, target_ids = codes // vocab_size, codes % vocab_size
+
+    frequent = np.argsort(-target_counts, kind='stable')[:num_frequent]
+    frequent = np.union1d(frequent, np.arange(NUM_SPECIAL_TOKENS))
+
+    keep = ~np.isin(target_ids, frequent)
+    source_ids, target_ids, counts = source_ids[keep], target_ids[keep], counts[keep]
+
+    # rank of every target token among the ones of its source token, by decreasing count
+    order = np.lexsort((-counts, source_ids))
+    source_ids, target_ids = source_ids[order], target_ids[order]
+    group_starts = np.searchsorted(source_ids, source_ids, side='left')
+    keep = np.arange(len(source_ids)) - group_starts < topk
+    source_ids, target_ids = source_ids[keep], target_ids[keep]
+
+    indptr = np.zeros(vocab_size + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(source_ids, minlength=vocab_size))
+
+    return dict(indptr=indptr, indices=target_ids.astype(np.int32), frequent=frequent.astype(np.int32))
+
+
+# decoding with the shortlist
+
+class Shortlist():
+    '''
+    Candidate target tokens of a batch: the union of the lists of its source tokens, the frequent tokens and the special
+    ones. When the union covers more than `max_fraction` of the vocabulary, the projection onto it would not save much
+    and decoding falls back to the full vocabulary.
+    '''
+
+    def __init__(self, indptr, indices, frequent, max_fraction=0.5):
+        self.indptr = indptr
+        self.indices = indices
+        self.frequent = frequent
+        self.max_fraction = max_fraction
+        self._fingerprint = None
+
+    @classmethod
+    def load(cls, path, max_fraction=0.5):
+        data = np.load(path)
+        return cls(data['indptr'], data['indices'], data['frequent'], max_fraction=max_fraction)
+
+    def save(self, path):
+        np.savez(path, indptr=self.indptr, indices=self.indices, frequent=self.frequent)
+
+    def fingerprint(self):
+        # hash of the lists and of the fallback threshold, which together decide the candidates of every batch.
+        # computed once, the lists are not modified after loading
+        if self._fingerprint is None:
+            h = hashlib.blake2b(digest_size=16)
+            for array in (self.indptr, self.indices, self.frequent):
+                h.update(np.ascontiguousarray(array, dtype=np.int64).tobytes())
+            h.update(repr(self.max_fraction).encode('utf-8'))
+            self._fingerprint = h.hexdigest()
+
+        return self._fingerprint
+
+    @property
+    def vocab_size(self):
+        return len(self.indptr) - 1
+
+    def candidates(self, src):
+        # sorted candidate ids of a batch of source ids, or None for the full vocabulary
+        tokens = np.unique(src.cpu().numpy())
+        tokens = tokens[(tokens >= 0) & (tokens < self.vocab_size)]
+
+        lists = [self.indices[self.indptr[token]:self.indptr[token + 1]] for token in tokens.tolist()]
+        candidates = np.unique(np.concatenate([self.frequent, *lists]))
+
+        if len(candidates) > self.max_fraction * self.vocab_size:
+            return None
+
+        return torch.from_numpy(candidates.astype(np.int64)).to(src.device)
+
+
+def output_projection(net):
+    # weight and bias of the output projection of a decoder, tied, linear or dynamically quantized
+    to_logits = net.to_logits
+
+    if isinstance(to_logits, nn.Linear):
+        return to_logits.weight, to_logits.bias
+
+    if callable(getattr(to_logits, 'weight', None)):
+        return to_logits.weight().dequantize(), to_logits.bias()
+
+    return net.token_emb.emb.weight, None
+
+
+@torch.no_grad()
+def shortlist_generate(model, shortlist, seq_in, seq_out_start, seq_len, mask=None, eos_token=None):
+    '''
+    Greedy decoding with the key / value cache, as `model.generate(..., cache_kv=True, temperature=0.)`, where the
+    output projection and the argmax are only computed over the candidate tokens of the batch. The output is the same
+    as greedy decoding whenever the best token is in the shortlist.
+    Returns the generated tokens and the number of candidate tokens (the vocabulary size on fallback).
+    '''
+    net, pad_value = model.decoder.net, model.decoder.pad_value
+    was_training = net.training
+    net.eval()
+
+    context = model.encoder(seq_in, mask=mask, return_embeddings=True)
+
+    weight, bias = output_projection(net)
+    candidates = shortlist.candidates(seq_in) if exists(shortlist) else None
+
+    if exists(candidates):
+        weight = weight[candidates]
+        bias = bias[candidates] if exists(bias) else None
+
+    def sample(hiddens):
+        sample = F.linear(hiddens, weight, bias).argmax(dim=-1, keepdim=True)
+        return candidates[sample] if exists(candidates) else sample
+
+    out = seq_out_start
+    for out in cached_decoding(net, seq_out_start, seq_len, sample, context=context, context_mask=mask,
+                               return_embeddings=True, eos_token=eos_token, pad_value=pad_value):
+        pass
+
+    net.train(was_training)
+    return out[:, seq_out_start.shape[-1]:], weight.shape[0]
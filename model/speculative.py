@@ -0,0 +1,157 @@
+import torch
+import torch.nn.functional as F
+
+from model.xtransformer import TransformerWrapper, Decoder, windowed_decoding, cache_capacity, crop_to_window
+
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+
+def truncate_cache(net, cache, length):
+    # keep the keys / values of the first `length` positions in the self attention layers of the cache returned by
+    # `net`, the cross attention ones only depend on the encoder output and are kept whole
+    attn_layer_types = [layer_type for layer_type in net.attn_layers.layer_types if layer_type in ('a', 'c')]
+    drop = cache.cache_length - length
+
+    attn_intermediates = []
+    for layer_type, inter in zip(attn_layer_types, cache.attn_intermediates):
+        if layer_type == 'a' and drop > 0:
+            inter = inter._replace(cached_kv=tuple(t[..., :t.shape[-2] - drop, :] for t in inter.cached_kv))
+        attn_intermediates.append(inter)
+
+    return cache._replace(attn_intermediates=attn_intermediates, cache_length=min(length, cache.cache_length))
+
+
+# draft decoder
+
+def build_draft_decoder(model, depth=2, heads=8):
+    '''
+    Small decoder cross attending to the encoder output of `model`, to propose tokens for speculative decoding.
+    It has the dimension and vocabulary of the main decoder, and starts from its token embedding and output projection.
+    '''
+    decoder = model.decoder.net
+
+    num_tokens = decoder.token_emb.emb.num_embeddings
+
+    draft = TransformerWrapper(
+        num_tokens=num_tokens,
+        max_seq_len=decoder.max_seq_len,
+        attn_layers=Decoder(dim=decoder.attn_layers.dim, depth=depth, heads=heads, cross_attend=True)
+    )
+
+    draft.token_emb.load_state_dict(decoder.token_emb.state_dict())
+    if isinstance(decoder.to_logits, torch.nn.Module) and isinstance(draft.to_logits, torch.nn.Module):
+        draft.to_logits.load_state_dict(decoder.to_logits.state_dict())
+
+    return draft
+
+
+# speculative decoding
+
+@torch.no_grad()
+def speculative_generate(
+        model,
+        draft,
+        seq_in,
+        seq_out_start,
+        seq_len,
+        mask=None,
+        num_speculative=4,
+        eos_token=None
+):
+    '''
+    Greedy decoding where the draft decoder proposes `num_speculative` tokens, one at a time, and the main decoder
+    scores them all in a single pass. The longest prefix the main decoder agrees with is kept, for every sequence of the
+    batch, followed by the main decoder's own next token, so the output is exactly the one of
+    `model.generate(..., cache_kv=True, temperature=0.)`. Both decoders keep a key / value cache, cut back to the
+    accepted tokens after every pass. Proposals stop where a cache would evict or recompute keys (see
+    `cache_capacity`), from there the main decoder goes on alone, cropping to its window as generate_cached does.
+
+    Returns the generated tokens and a dictionary of statistics: acceptance rate of the proposed tokens, and
+    tokens generated per pass of the main decoder.
+    '''
+    net, pad_value = model.decoder.net, model.decoder.pad_value
+    was_training, draft_was_training = net.training, draft.training
+    net.eval()
+    draft.eval()
+
+    context = model.encoder(seq_in, mask=mask, return_embeddings=True)
+    decode_kwargs = dict(context=context, context_mask=mask, return_intermediates=True)
+
+    # the proposals are only checked while both caches hold every key: cutting a cache back to the accepted tokens
+    # after keys were evicted from a window would lose some, and past max_seq_len the main decoder recomputes its
+    # window at every step as generate_cached does. from there on, every pass decodes a single token
+    windowed = windowed_decoding(net)
+    capacity = min(cache_capacity(net), cache_capacity(draft))
+
+    t = seq_out_start.shape[-1]
+    out = seq_out_start
+    cache, draft_cache = None, None
+    proposed, accepted, passes = 0, 0, 0
+
+    # the main decoder cache always covers all but the last token of `out`
+
+    while out.shape[-1] - t < seq_len:
+        length = out.shape[-1]
+        num_draft = max(min(num_speculative, seq_len - (length - t) - 1, capacity - length), 0)
+
+        # draft proposes
+
+        x = out
+        for _ in range(num_draft):
+            logits, draft_cache = draft(x, cache=draft_cache, **decode_kwargs)
+            x = torch.cat((x, logits[:, -1].argmax(dim=-1, keepdim=True)), dim=-1)
+
+        proposals = x[:, length:]
+
+        # main decoder verifies, the logits of the last num_draft + 1 positions predict the proposals and the next token
+
+        x, cache = crop_to_window(net, x, cache, windowed)
+        logits, cache = net(x, cache=cache, **decode_kwargs)
+        verified = logits[:, -(num_draft + 1):].argmax(dim=-1)
+
+        agree = (verified[:, :num_draft] == proposals).long().cumprod(dim=-1)
+        num_accepted = int(agree.sum(dim=-1).min().item()) if num_draft > 0 else 0
+
+        out = torch.cat((out, verified[:, :num_accepted + 1]), dim=-1)
+
+        cache = truncate_cache(net, cache, out.shape[-1] - 1)
+        if exists(draft_cache):
+            draft_cache = truncate_cache(draft, draft_cache, out.shape[-1] - 1)
+
+        proposed += num_draft
+        accepted += num_accepted
+        passes += 1
+
+        if exists(eos_token) and (out[:, t:] == eos_token).any(dim=-1).all():
+            break
+
+    out = out[:, t:t + seq_len]
+
+    # same stopping as greedy decoding: at the step every sequence has produced an eos, with what follows them padded
+
+    if exists(eos_token):
+        is_eos_tokens = out == eos_token
+
+        if is_eos_tokens.any(dim=-1).all():
+            first_eos = is_eos_tokens.float().argmax(dim=-1)
+            out = out[:, :int(first_eos.max().item()) + 1]
+
+            shifted_is_eos_tokens = F.pad(is_eos_tokens[:, :out.shape[-1]], (1, -1))
+            out = out.masked_fill(shifted_is_eos_tokens.float().cumsum(dim=-1) >= 1, pad_value)
+
+    net.train(was_training)
+    draft.train(draft_was_training)
+
+    stats = dict(
+        acceptance_rate=accepted / max(proposed, 1),
+        tokens_per_pass=out.shape[-1] / max(passes, 1),
+        proposed=proposed,
+        accepted=accepted,
+        passes=passes
+    )
+
+    return out, stats
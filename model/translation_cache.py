@@ -0,0 +1,239 @@
+import os
+import json
+import hashlib
+from itertools import chain
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from model.checkpoint import tensor_bytes
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+
+def packed_params(model):
+    # packed weights of dynamically quantized modules, script objects that are neither parameters nor buffers
+    return [module._packed_params for module in model.modules()
+            if isinstance(getattr(module, '_packed_params', None), torch.ScriptObject)]
+
+
+def weights_version(model):
+    # changes whenever a parameter or buffer is replaced or updated in place (optimizer steps, load_state_dict, ...),
+    # or a packed quantized weight is replaced (set_weight_bias, load_state_dict), which is the only way to change one.
+    # the packed weights are held by the version itself, so their ids cannot be reused by new ones meanwhile
+    tensors = tuple((t.data_ptr(), t._version) for t in chain(model.parameters(), model.buffers()))
+    return tensors + tuple((id(packed), packed) for packed in packed_params(model))
+
+
+def flat_values(value):
+    if isinstance(value, (list, tuple)):
+        return [v for item in value for v in flat_values(item)]
+    return [value]
+
+
+def model_fingerprint(model):
+    # hash of the names, shapes and values of everything in the state dict, packed quantized weights included
+    h = hashlib.blake2b(digest_size=16)
+
+    for name, value in model.state_dict().items():
+        h.update(name.encode('utf-8'))
+
+        for v in flat_values(value):
+            if not torch.is_tensor(v):
+                h.update(repr(v).encode('utf-8'))
+                continue
+
+            if v.is_quantized:
+                v = v.dequantize()
+
+            h.update(('%s%s' % (v.dtype, tuple(v.shape))).encode('utf-8'))
+            h.update(tensor_bytes(v))
+
+    return h.hexdigest()
+
+
+def translation_key(ids, decode_config, fingerprint):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(np.asarray(ids, dtype=np.int64).tobytes())
+    h.update(json.dumps(decode_config, sort_keys=True).encode('utf-8'))
+    h.update(fingerprint.encode('utf-8'))
+    return h.digest()
+
+
+# on disk tier
+# layout: records appended one after the other, each the 16 byte key, the number of ids (4 bytes little endian) and
+# the ids as int32. the index of the records is rebuilt by scanning the memory mapped file when it is opened
+
+KEY_BYTES = 16
+HEADER_BYTES = KEY_BYTES + 4
+
+
+class DiskTier():
+    '''
+    Translations of one checkpoint in an append only file of `directory`, named after the checkpoint fingerprint, so
+    the entries of other weights are never read. Lookups are views of a read only memory map of the file, remapped
+    once it has grown. A record cut short by a crash is ignored and overwritten. Only one process should write to a
+    given directory.
+    '''
+
+    def __init__(self, directory, fingerprint):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, fingerprint + '.bin')
+
+        self.index = dict()
+        self.buffer = None
+        self.size = 0
+
+        if os.path.exists(self.path):
+            self.scan()
+
+        self.file = open(self.path, 'ab')
+        self.file.truncate(self.size)
+
+    def remap(self):
+        self.buffer = np.memmap(self.path, dtype=np.uint8, mode='r') if os.path.getsize(self.path) > 0 else None
+
+    def scan(self):
+        self.remap()
+        total = 0 if self.buffer is None else len(self.buffer)
+        offset = 0
+
+        while offset + HEADER_BYTES <= total:
+            key = bytes(self.buffer[offset:offset + KEY_BYTES])
+            length = int.from_bytes(bytes(self.buffer[offset + KEY_BYTES:offset + HEADER_BYTES]), 'little')
+            end = offset + HEADER_BYTES + 4 * length
+            if end > total:
+                break
+
+            self.index[key] = (offset + HEADER_BYTES, length)
+            offset = end
+
+        self.size = offset
+
+    def get(self, key):
+        if key not in self.index:
+            return None
+
+        start, length = self.index[key]
+        if self.buffer is None or len(self.buffer) < start + 4 * length:
+            self.remap()
+
+        return self.buffer[start:start + 4 * length].view(np.int32).tolist()
+
+    def put(self, key, ids):
+        if key in self.index:
+            return
+
+        record = key + len(ids).to_bytes(4, 'little') + np.asarray(ids, dtype=np.int32).tobytes()
+        self.file.write(record)
+        self.file.flush()
+
+        self.index[key] = (self.size + HEADER_BYTES, len(ids))
+        self.size += len(record)
+
+    def close(self):
+        self.file.close()
+        self.buffer = None
+
+
+# cache
+
+class TranslationCache():
+    '''
+    Translations keyed by a hash of the source ids, the decoding configuration and a fingerprint of the model weights,
+    in a bounded in memory LRU tier and, with `directory`, an on disk tier behind it. The fingerprint is recomputed
+    whenever a parameter is updated or replaced, which drops the in memory entries and moves the disk tier to the
+    file of the new weights, so stale translations are never returned.
+    '''
+
+    def __init__(self, model, max_entries=100000, directory=None):
+        self.model = model
+        self.max_entries = max_entries
+        self.directory = directory
+
+        self.entries = OrderedDict()
+        self.disk = None
+        self.version = None
+        self.fingerprint = None
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        self.check_weights()
+
+    def check_weights(self):
+        version = weights_version(self.model)
+        if version == self.version:
+            return
+
+        fingerprint = model_fingerprint(self.model)
+        self.version = version
+
+        if fingerprint == self.fingerprint:
+            return
+
+        if exists(self.fingerprint):
+            self.invalidations += 1
+
+        self.fingerprint = fingerprint
+        self.entries.clear()
+
+        if exists(self.disk):
+            self.disk.close()
+
+        self.disk = DiskTier(self.directory, fingerprint) if exists(self.directory) else None
+
+    def key(self, ids, decode_config):
+        return translation_key(ids, decode_config, self.fingerprint)
+
+    def get(self, ids, decode_config):
+        self.check_weights()
+        key = self.key(ids, decode_config)
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return list(self.entries[key])
+
+        out = self.disk.get(key) if exists(self.disk) else None
+
+        if exists(out):
+            self.disk_hits += 1
+            self.remember(key, out)
+            return out
+
+        self.misses += 1
+        return None
+
+    def put(self, ids, decode_config, out):
+        self.check_weights()
+        key = self.key(ids, decode_config)
+        self.remember(key, out)
+
+        if exists(self.disk):
+            self.disk.put(key, out)
+
+    def remember(self, key, out):
+        self.entries[key] = tuple(out)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return dict(
+            entries=len(self.entries),
+            disk_entries=len(self.disk.index) if exists(self.disk) else 0,
+            hits=self.hits,
+            disk_hits=self.disk_hits,
+            misses=self.misses,
+            hit_rate=(self.hits + self.disk_hits) / max(lookups, 1),
+            invalidations=self.invalidations
+        )
@@ -4,6 +4,7 @@ from random import random
 import torch
 from torch import nn, einsum
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from functools import partial, wraps
 from inspect import isfunction
@@ -20,13 +21,15 @@ DEFAULT_DIM_HEAD = 64
 
 Intermediates = namedtuple('Intermediates', [
     'pre_softmax_attn',
-    'post_softmax_attn'
-])
+    'post_softmax_attn',
+    'cached_kv'
+], defaults=(None,))
 
 LayerIntermediates = namedtuple('Intermediates', [
     'hiddens',
-    'attn_intermediates'
-])
+    'attn_intermediates',
+    'cache_length'
+], defaults=(0,))
 
 
 # helpers
@@ -55,6 +58,14 @@ def maybe(fn):
     return inner
 
 
+def top_k(logits, thres=0.9):
+    k = math.ceil((1 - thres) * logits.shape[-1])
+    val, ind = torch.topk(logits, k)
+    probs = torch.full_like(logits, float('-inf'))
+    probs.scatter_(1, ind, val)
+    return probs
+
+
 class always():
     def __init__(self, val):
         self.val = val
@@ -183,6 +194,25 @@ def dropout_seq(seq, mask, dropout):
     return seq, mask
 
 
+# knowledge distillation from the top k of a teacher distribution, see model/distillation.py
+
+def distillation_loss(logits, target, teacher_ids, teacher_logprobs, alpha=0.5, ignore_index=-100):
+    '''
+    (1 - alpha) * cross entropy with the reference tokens + alpha * cross entropy with the teacher distribution, its top
+    k renormalized, averaged over the positions the teacher has entries for.
+    '''
+    nll = F.cross_entropy(logits.transpose(1, 2), target, ignore_index=ignore_index)
+
+    valid = teacher_ids >= 0
+    teacher_probs = teacher_logprobs.float().masked_fill(~valid, -1e4).softmax(dim=-1) * valid
+
+    student_logprobs = logits.float().log_softmax(dim=-1).gather(-1, teacher_ids.clamp(min=0))
+    kd = -(teacher_probs * student_logprobs).sum(dim=-1)
+    kd = kd.sum() / valid.any(dim=-1).sum().clamp(min=1)
+
+    return (1 - alpha) * nll + alpha * kd
+
+
 # activations
 
 class ReluSquared(nn.Module):
@@ -267,6 +297,14 @@ class RelativePositionBias(nn.Module):
         bias = rearrange(values, 'i j h -> h i j')
         return qk_dots + (bias * self.scale)
 
+    def block_bias(self, q_pos, k_pos, heads=None, dtype=None):
+        # (h i j) bias between the queries at q_pos and the keys at k_pos, for attention computed a block at a time
+        rel_pos = k_pos[None, :] - q_pos[:, None]
+        rp_bucket = self._relative_position_bucket(rel_pos, causal=self.causal, num_buckets=self.num_buckets,
+                                                   max_distance=self.max_distance)
+        values = self.relative_attention_bias(rp_bucket)
+        return rearrange(values, 'i j h -> h i j') * self.scale
+
 
 class DynamicPositionBias(nn.Module):
     def __init__(self, dim, *, heads, depth, log_distance=False, norm=False):
@@ -292,28 +330,29 @@ class DynamicPositionBias(nn.Module):
         self.mlp.append(nn.Linear(dim, heads))
 
     def forward(self, qk_dots):
-        n, device, dtype = qk_dots.shape[-1], qk_dots.device, qk_dots.dtype
+        i, j, device, dtype = *qk_dots.shape[-2:], qk_dots.device, qk_dots.dtype
+
+        # the queries are the last i positions, fewer than the keys when decoding with a key / value cache
+        q_pos = torch.arange(j - i, j, device=device)
+        k_pos = torch.arange(j, device=device)
+        return qk_dots + self.block_bias(q_pos, k_pos, dtype=dtype)
 
-        # get the (n x n) matrix of distances
-        seq_arange = torch.arange(n, device=device)
-        context_arange = torch.arange(n, device=device)
-        indices = rearrange(seq_arange, 'i -> i 1') - rearrange(context_arange, 'j -> 1 j')
-        indices += (n - 1)
+    def block_bias(self, q_pos, k_pos, heads=None, dtype=None):
+        # only the distances occurring between q_pos and k_pos go through the MLP
+        dist = q_pos[:, None] - k_pos[None, :]
+        min_dist, max_dist = dist.min().item(), dist.max().item()
 
-        # input to continuous positions MLP
-        pos = torch.arange(-n + 1, n, device=device, dtype=dtype)
+        pos = torch.arange(min_dist, max_dist + 1, device=dist.device, dtype=default(dtype, torch.float32))
         pos = rearrange(pos, '... -> ... 1')
 
         if self.log_distance:
-            pos = torch.sign(pos) * torch.log(pos.abs() + 1)  # log of distance is sign(rel_pos) * log(abs(rel_pos) + 1)
+            pos = torch.sign(pos) * torch.log(pos.abs() + 1)
 
         for layer in self.mlp:
             pos = layer(pos)
 
-        # get position biases
-        bias = pos[indices]
-        bias = rearrange(bias, 'i j h -> h i j')
-        return qk_dots + bias
+        bias = pos[dist - min_dist]
+        return rearrange(bias, 'i j h -> h i j')
 
 
 class AlibiPositionalBias(nn.Module):
@@ -348,17 +387,23 @@ class AlibiPositionalBias(nn.Module):
     def forward(self, qk_dots):
         h, i, j, device = *qk_dots.shape[-3:], qk_dots.device
 
-        if exists(self.bias) and self.bias.shape[-1] >= j:
-            return qk_dots + self.bias[..., :i, :j]
+        # the bias is kept square, the queries are its last i rows, fewer than the keys with a key / value cache
+        if not (exists(self.bias) and self.bias.shape[-1] >= j):
+            bias = self.get_bias(j, j, device)
+            bias = bias * self.slopes
 
-        bias = self.get_bias(i, j, device)
-        bias = bias * self.slopes
+            num_heads_unalibied = h - bias.shape[0]
+            bias = pad_at_dim(bias, (0, num_heads_unalibied), dim=0)
+            self.register_buffer('bias', bias, persistent=False)
+
+        return qk_dots + self.bias[..., j - i:j, :j]
 
-        num_heads_unalibied = h - bias.shape[0]
-        bias = pad_at_dim(bias, (0, num_heads_unalibied), dim=0)
-        self.register_buffer('bias', bias, persistent=False)
+    def block_slopes(self, heads):
+        return pad_at_dim(self.slopes, (0, heads - self.slopes.shape[0]), dim=0)
 
-        return qk_dots + self.bias
+    def block_bias(self, q_pos, k_pos, heads=None, dtype=None):
+        bias = -torch.abs(rearrange(k_pos, 'j -> 1 1 j') - rearrange(q_pos, 'i -> 1 i 1'))
+        return bias * self.block_slopes(default(heads, self.heads))
 
 
 class LearnedAlibiPositionalBias(AlibiPositionalBias):
@@ -373,17 +418,20 @@ class LearnedAlibiPositionalBias(AlibiPositionalBias):
         def get_slopes(param):
             return pad_at_dim(param.exp(), (0, h - param.shape[0]), dim=-2)
 
-        if exists(self.bias) and self.bias.shape[-1] >= j:
-            bias = self.bias[..., :i, :j]
-        else:
-            bias = self.get_bias(i, j, device)
-            self.register_buffer('bias', bias, persistent=False)
+        if not (exists(self.bias) and self.bias.shape[-1] >= j):
+            self.register_buffer('bias', self.get_bias(j, j, device), persistent=False)
+
+        bias = self.bias[..., j - i:j, :j]
 
         slopes = get_slopes(self.learned_logslopes)
         bias = bias * slopes
 
         return qk_dots + bias
 
+    def block_slopes(self, heads):
+        slopes = self.learned_logslopes.exp()
+        return pad_at_dim(slopes, (0, heads - slopes.shape[0]), dim=0)
+
 
 class RotaryEmbedding(nn.Module):
     def __init__(
@@ -599,6 +647,143 @@ class FeedForward(nn.Module):
         return self.ff(x)
 
 
+# sparse topk attention
+
+def gather_rows(t, indices):
+    # t: (b g j d), indices: (b g ... t) into j -> (b g ... t d)
+    b, g, j, d = t.shape
+    offsets = torch.arange(b * g, device=t.device) * j
+    offsets = offsets.reshape(b, g, *((1,) * (indices.ndim - 2)))
+    return t.reshape(-1, d)[indices + offsets]
+
+
+def scatter_add_rows_(t, indices, values):
+    # inverse of gather_rows, accumulating the values of repeated indices
+    b, g, j, d = t.shape
+    offsets = torch.arange(b * g, device=t.device) * j
+    offsets = offsets.reshape(b, g, *((1,) * (indices.ndim - 2)))
+    t.view(-1, d).index_add_(0, (indices + offsets).reshape(-1), values.reshape(-1, d).type(t.dtype))
+
+
+class SparseTopkAttend(torch.autograd.Function):
+    '''
+    attention of each query over its selected keys only
+    q: (b g r i d), k / v: (b g j d), indices / valid / dropout_keep: (b g r i t)
+    the selected keys and values are gathered a chunk of queries at a time, in the forward and again in the backward,
+    so only the indices and the (i x t) attention weights are kept for backward
+    '''
+
+    @staticmethod
+    def forward(ctx, q, k, v, indices, valid, dropout_keep, scale, chunk_size):
+        q, k, v = map(lambda t: t.contiguous(), (q, k, v))
+        i = q.shape[-2]
+        out, attn = [], []
+
+        for start in range(0, i, chunk_size):
+            rows = slice(start, start + chunk_size)
+            chunk_indices = indices[..., rows, :]
+
+            dots = einsum('b g r i d, b g r i t d -> b g r i t', q[..., rows, :], gather_rows(k, chunk_indices)) * scale
+            dots = dots.masked_fill(~valid[..., rows, :], max_neg_value(dots))
+            chunk_attn = dots.softmax(dim=-1, dtype=torch.promote_types(dots.dtype, torch.float32)).type(dots.dtype)
+            attn.append(chunk_attn)
+
+            if exists(dropout_keep):
+                chunk_attn = chunk_attn * dropout_keep[..., rows, :]
+
+            out.append(einsum('b g r i t, b g r i t d -> b g r i d', chunk_attn, gather_rows(v, chunk_indices)))
+
+        attn = torch.cat(attn, dim=-2)
+
+        ctx.save_for_backward(q, k, v, indices, attn, dropout_keep)
+        ctx.scale = scale
+        ctx.chunk_size = chunk_size
+        return torch.cat(out, dim=-2)
+
+    @staticmethod
+    def backward(ctx, dout):
+        q, k, v, indices, attn, dropout_keep = ctx.saved_tensors
+        scale, chunk_size, i = ctx.scale, ctx.chunk_size, q.shape[-2]
+
+        dq = torch.zeros_like(q)
+        dk = torch.zeros(k.shape, dtype=torch.float32, device=k.device)
+        dv = torch.zeros(v.shape, dtype=torch.float32, device=v.device)
+
+        for start in range(0, i, chunk_size):
+            rows = slice(start, start + chunk_size)
+            chunk_indices = indices[..., rows, :]
+            k_top, v_top = gather_rows(k, chunk_indices), gather_rows(v, chunk_indices)
+            p, do = attn[..., rows, :], dout[..., rows, :]
+
+            p_dropped = p * dropout_keep[..., rows, :] if exists(dropout_keep) else p
+
+            scatter_add_rows_(dv, chunk_indices, einsum('b g r i t, b g r i d -> b g r i t d', p_dropped, do))
+
+            dp = einsum('b g r i d, b g r i t d -> b g r i t', do, v_top)
+
+            if exists(dropout_keep):
+                dp = dp * dropout_keep[..., rows, :]
+
+            ds = p * (dp - (dp * p).sum(dim=-1, keepdim=True))
+
+            dq[..., rows, :] = einsum('b g r i t, b g r i t d -> b g r i d', ds, k_top) * scale
+            scatter_add_rows_(dk, chunk_indices, einsum('b g r i t, b g r i d -> b g r i t d', ds, q[..., rows, :]) * scale)
+
+        return dq, dk.type(k.dtype), dv.type(v.dtype), None, None, None, None, None
+
+
+# residual attention logits, kept as the queries / keys they are made of
+
+class ResidualLogits():
+    '''
+    pre softmax attention logits of residual attention (realformer), as a sum of terms computed block by block on demand,
+    so chunked attention can pass them from layer to layer without materializing the (b h i j) matrix.
+    a term is either a (b h i j) tensor, or the (grouped) queries and keys whose scaled dot products it is
+    '''
+
+    def __init__(self, terms):
+        self.terms = terms
+
+    def block(self, rows=slice(None), cols=slice(None)):
+        out = 0.
+        for term in self.terms:
+            if torch.is_tensor(term):
+                out = out + term[..., rows, cols]
+                continue
+
+            q, k, scale = term
+            dots = einsum('b g r i d, b g j d -> b g r i j', q[..., rows, :], k[..., cols, :]) * scale
+            out = out + rearrange(dots, 'b g r i j -> b (g r) i j')
+        return out
+
+
+def residual_logits_block(prev_attn, rows=slice(None), cols=slice(None)):
+    if isinstance(prev_attn, ResidualLogits):
+        return prev_attn.block(rows, cols)
+    return prev_attn[..., rows, cols]
+
+
+# online softmax, attention over one block of keys at a time with a running max and sum
+
+def online_softmax_block(dots, v, acc, row_max, row_sum, dropout=None):
+    # adds the (b g r i j) scores `dots` of a block of keys, and their values, to the running output, max and sum.
+    # start from acc = 0., row_max = None, row_sum = 0., the attention output is acc / row_sum after the last block
+    block_max = dots.amax(dim=-1, keepdim=True)
+    new_max = block_max if row_max is None else torch.maximum(row_max, block_max)
+    correction = (row_max - new_max).exp() if row_max is not None else 0.
+
+    weights = (dots - new_max).exp()
+    row_sum = row_sum * correction + weights.sum(dim=-1, keepdim=True)
+
+    # dropping the unnormalized weights from the numerator only, same as dropping the softmax output
+    if exists(dropout):
+        weights = dropout(weights)
+
+    block_out = einsum('b g r i j, b g j d -> b g r i d', weights.type(v.dtype), v)
+    acc = acc * correction + block_out.type(row_sum.dtype)
+    return acc, new_max, row_sum
+
+
 # attention.
 
 class Attention(nn.Module):
@@ -621,9 +806,12 @@ class Attention(nn.Module):
             qk_norm_groups=1,
             qk_norm_scale=10,
             one_kv_head=False,
+            kv_heads=None,  # grouped query attention, https://arxiv.org/abs/2305.13245
             shared_kv=False,
             value_dim_head=None,
-            tensor_product=False  # https://arxiv.org/abs/2208.06061
+            tensor_product=False,  # https://arxiv.org/abs/2208.06061
+            flash=False,
+            chunk_size=None
     ):
         super().__init__()
         self.scale = dim_head ** -0.5
@@ -632,15 +820,16 @@ class Attention(nn.Module):
         self.causal = causal
         self.max_attend_past = max_attend_past
 
-        value_dim_head = default(value_dim_head, dim_head)
-        q_dim = k_dim = dim_head * heads
-        v_dim = out_dim = value_dim_head * heads
+        # number of key / value heads, each shared by a group of heads // kv_heads query heads
+        kv_heads = 1 if one_kv_head else default(kv_heads, heads)
+        assert 1 <= kv_heads <= heads and (heads % kv_heads) == 0, 'number of key / value heads must divide the number of heads'
+        self.kv_heads = kv_heads
 
-        self.one_kv_head = one_kv_head
-        if one_kv_head:
-            k_dim = dim_head
-            v_dim = value_dim_head
-            out_dim = v_dim * heads
+        value_dim_head = default(value_dim_head, dim_head)
+        q_dim = dim_head * heads
+        k_dim = dim_head * kv_heads
+        v_dim = value_dim_head * kv_heads
+        out_dim = value_dim_head * heads
 
         self.to_q = nn.Linear(dim, q_dim, bias=False)
         self.to_k = nn.Linear(dim, k_dim, bias=False)
@@ -651,7 +840,7 @@ class Attention(nn.Module):
         self.to_v = nn.Linear(dim, v_dim, bias=False) if not shared_kv else None
 
         # relations projection from tp-attention
-        self.to_r = nn.Linear(dim, v_dim, bias=False) if tensor_product else None
+        self.to_r = nn.Linear(dim, out_dim, bias=False) if tensor_product else None
 
         # dropout
         self.dropout = nn.Dropout(dropout)
@@ -684,17 +873,26 @@ class Attention(nn.Module):
         if head_scale:
             self.head_scale_params = nn.Parameter(torch.ones(1, heads, 1, 1))
 
-        # explicit topk sparse attention
+        # explicit topk sparse attention, queries only attend to their top k keys
         self.sparse_topk = sparse_topk
+        self.sparse_topk_chunk_size = 128
 
         # attention softmax function
         self.attn_fn = partial(F.softmax, dtype=torch.float32) if not qk_norm else F.softmax
 
+        # fused attention, used whenever no bias or attention map needs to be materialized
+        assert not (flash and not hasattr(F, 'scaled_dot_product_attention')), 'fused attention requires pytorch 2.0 or above'
+        assert not (flash and (talking_heads or exists(sparse_topk) or exists(max_attend_past))), 'fused attention is not compatible with talking heads, sparse topk or max attend past'
+        self.flash = flash
+
+        # chunked attention with online softmax, for the biased variants fused attention cannot run
+        self.chunk_size = chunk_size
+
         # add memory key / values
         self.num_mem_kv = num_mem_kv
         if num_mem_kv > 0:
-            self.mem_k = nn.Parameter(torch.randn(heads, num_mem_kv, dim_head))
-            self.mem_v = nn.Parameter(torch.randn(heads, num_mem_kv, dim_head))
+            self.mem_k = nn.Parameter(torch.randn(kv_heads, num_mem_kv, dim_head))
+            self.mem_v = nn.Parameter(torch.randn(kv_heads, num_mem_kv, value_dim_head))
 
         # attention on attention
         self.attn_on_attn = on_attn
@@ -715,9 +913,10 @@ class Attention(nn.Module):
             rel_pos=None,
             rotary_pos_emb=None,
             prev_attn=None,
-            mem=None
+            mem=None,
+            cache=None
     ):
-        b, n, _, h, talking_heads, head_scale, scale, device, has_context = *x.shape, self.heads, self.talking_heads, self.head_scale, self.scale, x.device, exists(
+        b, n, _, h, kv_h, talking_heads, head_scale, scale, device, has_context = *x.shape, self.heads, self.kv_heads, self.talking_heads, self.head_scale, self.scale, x.device, exists(
             context)
         kv_input = default(context, x)
 
@@ -731,14 +930,21 @@ class Attention(nn.Module):
             v_input = torch.cat((mem, v_input), dim=-2)
 
         q = self.to_q(q_input)
-        k = self.to_k(k_input)
-        v = self.to_v(v_input) if exists(self.to_v) else k
         r = self.to_r(r_input) if exists(self.to_r) else None
+        q, r = map(lambda t: maybe(rearrange)(t, 'b n (h d) -> b h n d', h=h), (q, r))
+
+        # the keys / values of the context do not change while decoding, they are computed once and then read from the cache
 
-        q = rearrange(q, 'b n (h d) -> b h n d', h=h)
+        # cache objects (model/batching.py) keep the keys / values of every sequence in their own storage: `update` takes
+        # the new ones (ignored by caches of the context) and returns all of them, with the mask of the filled positions,
+        # or `attend` takes the queries too and returns the attention output
+        cache_object = hasattr(cache, 'update') or hasattr(cache, 'attend')
+        cache_mask = None
 
-        if not self.one_kv_head:
-            k, v, r = map(lambda t: maybe(rearrange)(t, 'b n (h d) -> b h n d', h=h), (k, v, r))
+        if has_context and exists(cache):
+            k, v = cache if not cache_object else (None, None)
+        else:
+            k, v = self.project_kv(k_input, v_input)
 
         if exists(rotary_pos_emb) and not has_context:
             freqs, xpos_scale = rotary_pos_emb
@@ -751,8 +957,43 @@ class Attention(nn.Module):
                              ((ql, q_xpos_scale), (kl, k_xpos_scale), (vl, k_xpos_scale)))
             q, k, v = map(lambda t: torch.cat(t, dim=-1), ((ql, qr), (kl, kr), (vl, vr)))
 
+        # paged caches attend over their pages themselves, one page at a time, without gathering the keys / values of
+        # every sequence into a contiguous copy
+        if hasattr(cache, 'attend'):
+            assert not (talking_heads or self.qk_norm or self.num_mem_kv > 0 or exists(self.sparse_topk) or exists(rel_pos) or exists(prev_attn) or exists(attn_mask)), \
+                'paged attention only supports plain softmax attention'
+            out = cache.attend(q, k, v, scale)
+            intermediates = Intermediates(
+                pre_softmax_attn=None,
+                post_softmax_attn=None,
+                cached_kv=cache
+            )
+            return self.to_output(out, x, r, mask=mask), intermediates
+
+        if cache_object:
+            k, v, cache_mask = cache.update(k, v)
+        elif exists(cache) and not has_context:
+            cached_k, cached_v = cache
+            k = torch.cat((cached_k, k), dim=-2)
+            v = torch.cat((cached_v, v), dim=-2)
+
+        cached_kv = (k, v) if not cache_object else cache
+
+        # with a window, keys older than max_attend_past can never be attended to again, evict them from the cache
+        is_local = self.causal and exists(self.max_attend_past) and not has_context
+
+        if is_local and not self.training and not cache_object:
+            cached_kv = tuple(t[..., max(t.shape[-2] - self.max_attend_past, 0):, :] for t in cached_kv)
+
         input_mask = default(context_mask, mask)
 
+        if exists(cache_mask):
+            input_mask = cache_mask
+
+        # the mask of the whole sequence, for keys read from a rolling cache
+        if exists(input_mask) and input_mask.shape[-1] > k.shape[-2]:
+            input_mask = input_mask[..., -k.shape[-2]:]
+
         if self.num_mem_kv > 0:
             mem_k, mem_v = map(lambda t: repeat(t, 'h n d -> b h n d', b=b), (self.mem_k, self.mem_v))
             k = torch.cat((mem_k, k), dim=-2)
@@ -766,14 +1007,65 @@ class Attention(nn.Module):
             q, k = map(qk_l2norm, (q, k))
             scale = self.qk_norm_scale
 
-        kv_einsum_eq = 'b h j d' if not self.one_kv_head else 'b j d'
+        if is_local and not talking_heads and not exists(self.sparse_topk) and self.num_mem_kv == 0 and not exists(rel_pos) and not exists(prev_attn) and not exists(attn_mask):
+            out = self.local_attn(q, k, v, scale, mask=input_mask)
+            intermediates = Intermediates(
+                pre_softmax_attn=None,
+                post_softmax_attn=None,
+                cached_kv=cached_kv
+            )
+            return self.to_output(out, x, r, mask=mask), intermediates
+
+        use_sparse_topk = exists(self.sparse_topk) and self.sparse_topk < k.shape[-2]
+
+        if use_sparse_topk and not talking_heads and not exists(rel_pos) and not exists(prev_attn):
+            out = self.sparse_topk_attn(q, k, v, scale, mask=input_mask, attn_mask=attn_mask)
+            intermediates = Intermediates(
+                pre_softmax_attn=None,
+                post_softmax_attn=None,
+                cached_kv=cached_kv
+            )
+            return self.to_output(out, x, r, mask=mask), intermediates
+
+        if self.flash and not exists(rel_pos) and not exists(prev_attn):
+            out = self.flash_attn(q, k, v, scale=scale, mask=input_mask, attn_mask=attn_mask)
+            intermediates = Intermediates(
+                pre_softmax_attn=None,
+                post_softmax_attn=None,
+                cached_kv=cached_kv
+            )
+            return self.to_output(out, x, r, mask=mask), intermediates
+
+        if exists(self.chunk_size) and not talking_heads and not use_sparse_topk and (not exists(rel_pos) or hasattr(rel_pos, 'block_bias')):
+            out = self.chunked_attn(q, k, v, scale, mask=input_mask, attn_mask=attn_mask, rel_pos=rel_pos, prev_attn=prev_attn)
 
-        dots = einsum(f'b h i d, {kv_einsum_eq} -> b h i j', q, k) * scale
+            # the logits passed on to the next layer by residual attention stay as queries and keys
+            residual_terms = []
+            if isinstance(prev_attn, ResidualLogits):
+                residual_terms = prev_attn.terms
+            elif exists(prev_attn):
+                residual_terms = [prev_attn]
+
+            pre_softmax_attn = ResidualLogits([*residual_terms, (rearrange(q, 'b (g r) i d -> b g r i d', g=kv_h), k, scale)])
+
+            intermediates = Intermediates(
+                pre_softmax_attn=pre_softmax_attn,
+                post_softmax_attn=None,
+                cached_kv=cached_kv
+            )
+            return self.to_output(out, x, r, mask=mask), intermediates
+
+        # query heads are grouped by the key / value head they share
+
+        q = rearrange(q, 'b (g r) i d -> b g r i d', g=kv_h)
+
+        dots = einsum('b g r i d, b g j d -> b g r i j', q, k) * scale
+        dots = rearrange(dots, 'b g r i j -> b (g r) i j')
 
         mask_value = max_neg_value(dots)
 
         if exists(prev_attn):
-            dots = dots + prev_attn
+            dots = dots + residual_logits_block(prev_attn)
 
         pre_softmax_attn = dots.clone()
 
@@ -830,13 +1122,231 @@ class Attention(nn.Module):
         if talking_heads:
             attn = self.post_softmax_talking_heads(attn)
 
-        out = einsum(f'b h i j, {kv_einsum_eq} -> b h i d', attn, v)
+        attn = rearrange(attn, 'b (g r) i j -> b g r i j', g=kv_h)
+        out = einsum('b g r i j, b g j d -> b g r i d', attn, v)
+        out = rearrange(out, 'b g r i d -> b (g r) i d')
+
+        intermediates = Intermediates(
+            pre_softmax_attn=pre_softmax_attn,
+            post_softmax_attn=post_softmax_attn,
+            cached_kv=cached_kv
+        )
+
+        return self.to_output(out, x, r, mask=mask), intermediates
+
+    def project_kv(self, k_input, v_input=None):
+        v_input = default(v_input, k_input)
+        k = self.to_k(k_input)
+        v = self.to_v(v_input) if exists(self.to_v) else k
+        return tuple(rearrange(t, 'b n (h d) -> b h n d', h=self.kv_heads) for t in (k, v))
+
+    def local_attn(self, q, k, v, scale, mask=None):
+        # causal attention within max_attend_past, in blocks the size of the window: each block of queries only scores
+        # its own and the previous block of keys, so the cost is linear in the sequence length
+        i, j, kv_h, window, device = q.shape[-2], k.shape[-2], self.kv_heads, self.max_attend_past, q.device
+        block = max(window, 1)
+
+        # keys before the window of the first query are never attended to
+        start = max(j - i - window, 0)
+        k, v = k[..., start:, :], v[..., start:, :]
+        mask = mask[..., start:] if exists(mask) else None
+        j -= start
+
+        # the queries are the last i positions. pad on the left up to a whole number of blocks, plus one block of keys
+        # for the first block to look back at
+        pad = (-j) % block
+        q = pad_at_dim(q, (pad + j - i, 0), dim=-2)
+        k, v = map(lambda t: pad_at_dim(t, (pad + block, 0), dim=-2), (k, v))
+
+        key_valid = torch.arange(k.shape[-2], device=device) >= (pad + block)
+        key_valid = rearrange(key_valid, 'j -> 1 j')
+
+        if exists(mask):
+            key_valid = key_valid & pad_at_dim(mask, (pad + block, 0), dim=-1, value=False)
+
+        def look_back(t):
+            # (..., (n + 1) w, d) -> (..., n, 2 w, d), the previous and current block of keys of every query block
+            t = rearrange(t, '... (n w) d -> ... n w d', w=block)
+            return torch.cat((t[..., :-1, :, :], t[..., 1:, :, :]), dim=-2)
+
+        k, v = map(look_back, (k, v))
+        key_valid = look_back(rearrange(key_valid, 'b j -> b j 1'))
+        key_valid = rearrange(key_valid, 'b n j 1 -> b 1 1 n 1 j')
+
+        # distance from query s to key t of the same window is block + s - t
+        dist = block + rearrange(torch.arange(block, device=device), 'i -> i 1') - torch.arange(2 * block, device=device)
+        masked = ~key_valid | (dist < 0) | (dist > window)
+
+        q = rearrange(q, 'b (g r) (n w) d -> b g r n w d', g=kv_h, w=block)
+
+        dots = einsum('b g r n i d, b g n j d -> b g r n i j', q, k) * scale
+        dots = dots.masked_fill(masked, max_neg_value(dots))
+
+        attn = self.attn_fn(dots, dim=-1).type(dots.dtype)
+        attn = self.dropout(attn)
+
+        out = einsum('b g r n i j, b g n j d -> b g r n i d', attn, v)
+        out = rearrange(out, 'b g r n w d -> b (g r) (n w) d')
+        return out[..., -i:, :]
 
+    def chunked_attn(self, q, k, v, scale, mask=None, attn_mask=None, rel_pos=None, prev_attn=None):
+        '''
+        attention a (chunk x chunk) block of scores at a time, with a running max and sum over the key blocks (online
+        softmax). position biases and residual logits are computed per block, and each chunk of queries is recomputed in
+        backward instead of storing its scores, so memory grows linearly with the sequence length
+        '''
+        i, j, h, kv_h, chunk_size, device = q.shape[-2], k.shape[-2], self.heads, self.kv_heads, self.chunk_size, q.device
+        dtype = q.dtype
+        q_pos, k_pos = torch.arange(j - i, j, device=device), torch.arange(j, device=device)
+
+        q = rearrange(q, 'b (g r) i d -> b g r i d', g=kv_h)
+
+        def attend_rows(q_rows, k, v, rows):
+            acc, row_max, row_sum = 0., None, 0.
+
+            for start in range(0, j, chunk_size):
+                cols = slice(start, start + chunk_size)
+
+                dots = einsum('b g r i d, b g j d -> b g r i j', q_rows, k[..., cols, :]) * scale
+
+                if exists(prev_attn):
+                    dots = dots + rearrange(residual_logits_block(prev_attn, rows, cols), 'b (g r) i j -> b g r i j', g=kv_h)
+
+                if exists(rel_pos):
+                    bias = rel_pos.block_bias(q_pos[rows], k_pos[cols], heads=h, dtype=dots.dtype)
+                    dots = dots + rearrange(bias, '(g r) i j -> g r i j', g=kv_h)
+
+                if not self.qk_norm:
+                    dots = dots.float()
+
+                masked = self.masked_positions(rows, i, j, mask=mask, attn_mask=attn_mask, device=device, cols=cols)
+                dots = dots.masked_fill(masked, max_neg_value(dots))
+
+                acc, row_max, row_sum = online_softmax_block(dots, v[..., cols, :], acc, row_max, row_sum,
+                                                             dropout=self.dropout)
+
+            return (acc / row_sum).type(dtype)
+
+        out = []
+        for start in range(0, i, chunk_size):
+            rows = slice(start, start + chunk_size)
+
+            if torch.is_grad_enabled() and any(t.requires_grad for t in (q, k, v)):
+                out.append(checkpoint(attend_rows, q[..., rows, :], k, v, rows, use_reentrant=False))
+            else:
+                out.append(attend_rows(q[..., rows, :], k, v, rows))
+
+        out = torch.cat(out, dim=-2)
+        return rearrange(out, 'b g r i d -> b (g r) i d')
+
+    def masked_positions(self, rows, i, j, mask=None, attn_mask=None, device=None, cols=slice(None)):
+        # boolean (b g r rows cols) mask, broadcastable, of the keys in cols (a slice of the j keys) each query in rows
+        # (a slice of the i queries) may not see
+        h, kv_h = self.heads, self.kv_heads
+        q_pos = torch.arange(j - i, j, device=device)[rows]
+        k_pos = torch.arange(j, device=device)[cols]
+
+        masked = torch.zeros((1, 1, 1, 1, 1), dtype=torch.bool, device=device)
+
+        if exists(mask):
+            masked = masked | ~rearrange(mask[..., cols], 'b j -> b 1 1 1 j')
+
+        if exists(attn_mask):
+            assert 2 <= attn_mask.ndim <= 4, 'attention mask must have greater than 2 dimensions but less than or equal to 4'
+            if attn_mask.ndim == 2:
+                attn_mask = rearrange(attn_mask, 'i j -> 1 1 i j')
+            elif attn_mask.ndim == 3:
+                attn_mask = rearrange(attn_mask, 'h i j -> 1 h i j')
+
+            if attn_mask.shape[1] == h:
+                attn_mask = rearrange(attn_mask, 'b (g r) i j -> b g r i j', g=kv_h)
+            else:
+                attn_mask = rearrange(attn_mask, 'b h i j -> b h 1 i j')
+
+            masked = masked | ~attn_mask[..., rows, cols]
+
+        if exists(self.max_attend_past):
+            masked = masked | ((q_pos[:, None] - k_pos[None, :]) > self.max_attend_past)
+
+        if self.causal:
+            masked = masked | (k_pos[None, :] > q_pos[:, None])
+
+        return masked
+
+    def sparse_topk_attn(self, q, k, v, scale, mask=None, attn_mask=None):
+        i, j, kv_h, topk, chunk_size, device = q.shape[-2], k.shape[-2], self.kv_heads, self.sparse_topk, self.sparse_topk_chunk_size, q.device
+
+        q = rearrange(q, 'b (g r) i d -> b g r i d', g=kv_h)
+
+        # select the top k keys of each query, a chunk of queries at a time and outside of autograd,
+        # so the full attention matrix is never held in memory
+
+        indices, valid = [], []
+
+        with torch.no_grad():
+            for start in range(0, i, chunk_size):
+                rows = slice(start, start + chunk_size)
+                dots = einsum('b g r i d, b g j d -> b g r i j', q[..., rows, :], k) * scale
+
+                mask_value = max_neg_value(dots)
+                dots = dots.masked_fill(self.masked_positions(rows, i, j, mask=mask, attn_mask=attn_mask, device=device), mask_value)
+
+                top, top_indices = dots.topk(topk, dim=-1)
+                indices.append(top_indices)
+                valid.append(top > mask_value)
+
+        indices, valid = map(partial(torch.cat, dim=-2), (indices, valid))
+
+        dropout_keep = None
+        if self.training and self.dropout.p > 0.:
+            keep_prob = 1. - self.dropout.p
+            dropout_keep = (torch.rand(indices.shape, device=device) < keep_prob).type(q.dtype) / keep_prob
+
+        out = SparseTopkAttend.apply(q, k, v, indices, valid, dropout_keep, scale, chunk_size)
+        return rearrange(out, 'b g r i d -> b (g r) i d')
+
+    def flash_attn(self, q, k, v, scale, mask=None, attn_mask=None):
+        h, i, j, device = q.shape[1], q.shape[-2], k.shape[-2], q.device
+
+        # the fused kernel expects as many key / value heads as query heads
+        if self.kv_heads < h:
+            k, v = map(lambda t: repeat(t, 'b g j d -> b (g r) j d', r=h // self.kv_heads), (k, v))
+
+        # the kernel scales by dim_head ** -0.5, fold any other scale (cosine sim attention) into the queries
+        q = q * (scale * q.shape[-1] ** 0.5)
+
+        keep_mask = None
+
+        if exists(mask):
+            keep_mask = rearrange(mask, 'b j -> b 1 1 j')
+
+        if exists(attn_mask):
+            assert 2 <= attn_mask.ndim <= 4, 'attention mask must have greater than 2 dimensions but less than or equal to 4'
+            if attn_mask.ndim == 2:
+                attn_mask = rearrange(attn_mask, 'i j -> 1 1 i j')
+            elif attn_mask.ndim == 3:
+                attn_mask = rearrange(attn_mask, 'h i j -> 1 h i j')
+            keep_mask = attn_mask if not exists(keep_mask) else (keep_mask & attn_mask)
+
+        is_causal = self.causal and not exists(keep_mask) and i == j
+
+        if self.causal and not is_causal:
+            causal_mask = torch.ones((i, j), dtype=torch.bool, device=device).triu(j - i + 1)
+            keep_mask = ~causal_mask if not exists(keep_mask) else (keep_mask & ~causal_mask)
+
+        return F.scaled_dot_product_attention(
+            q, k, v,
+            attn_mask=keep_mask,
+            dropout_p=self.dropout.p if self.training else 0.,
+            is_causal=is_causal
+        )
+
+    def to_output(self, out, x, r=None, mask=None):
         if exists(r):
             # https://arxiv.org/abs/2208.06061 proposes to add a residual for better gradients
             out = out * r + out
 
-        if head_scale:
+        if self.head_scale:
             out = out * self.head_scale_params
 
         out = rearrange(out, 'b h n d -> b n (h d)')
@@ -845,18 +1355,34 @@ class Attention(nn.Module):
             gates = self.to_v_gate(x)
             out = out * gates.sigmoid()
 
-        intermediates = Intermediates(
-            pre_softmax_attn=pre_softmax_attn,
-            post_softmax_attn=post_softmax_attn
-        )
-
         out = self.to_out(out)
 
         if exists(mask):
             mask = rearrange(mask, 'b n -> b n 1')
             out = out.masked_fill(~mask, 0.)
 
-        return out, intermediates
+        return out
+
+
+def convert_to_grouped_kv(state_dict, heads, kv_heads, dim_head=DEFAULT_DIM_HEAD):
+    # converts the key / value projections of a multi-head attention checkpoint to kv_heads heads, each the mean
+    # of the heads in its group, as in https://arxiv.org/abs/2305.13245 - load into a model built with attn_kv_heads = kv_heads
+    # projections already at kv_heads heads are kept as they are, so converting twice changes nothing
+    assert (heads % kv_heads) == 0, 'number of key / value heads must divide the number of heads'
+    group = heads // kv_heads
+
+    converted = dict()
+    for name, t in state_dict.items():
+        if name.endswith(('.to_k.weight', '.to_v.weight')) and t.shape[0] != kv_heads * dim_head:
+            assert t.shape[0] == heads * dim_head, '%s has %d rows, expected %d heads of dimension %d' % (
+                name, t.shape[0], heads, dim_head)
+            t = reduce(t, '(g r d) i -> (g d) i', 'mean', g=kv_heads, r=group)
+        elif name.endswith(('.mem_k', '.mem_v')) and t.shape[0] == heads:
+            t = reduce(t, '(g r) n d -> g n d', 'mean', g=kv_heads)
+
+        converted[name] = t
+
+    return converted
 
 
 class AttentionLayers(nn.Module):
@@ -910,6 +1436,9 @@ class AttentionLayers(nn.Module):
 
         dim_head = attn_kwargs.get('dim_head', DEFAULT_DIM_HEAD)
 
+        assert not (attn_kwargs.get('flash', False) and (residual_attn or cross_residual_attn)), 'residual attention needs the attention logits, which fused attention does not materialize'
+        assert not (exists(attn_kwargs.get('sparse_topk', None)) and (residual_attn or cross_residual_attn)), 'residual attention needs the full attention logits, which sparse topk attention does not materialize'
+
         self.dim = dim
         self.depth = depth
         self.layers = nn.ModuleList([])
@@ -1065,7 +1594,8 @@ class AttentionLayers(nn.Module):
             attn_mask=None,
             self_attn_context_mask=None,
             mems=None,
-            return_hiddens=False
+            return_hiddens=False,
+            cache=None
     ):
         assert not (self.cross_attend ^ exists(context)), 'context must be passed in if cross_attend is set to True'
 
@@ -1076,9 +1606,19 @@ class AttentionLayers(nn.Module):
 
         mems = mems.copy() if exists(mems) else [None] * self.num_attn_layers
 
+        # key / value cache from the previous call, x only holds the positions after the cached ones
+
+        cache_length = 0
+        attn_cache = iter([])
+
+        if exists(cache):
+            assert not self.training, 'key / value caching is only supported at inference'
+            cache_length = cache.cache_length
+            attn_cache = iter([inter.cached_kv for inter in cache.attn_intermediates])
+
         rotary_pos_emb = None
         if exists(self.rotary_pos_emb):
-            max_rotary_emb_length = max(list(map(lambda m: (m.shape[1] if exists(m) else 0) + x.shape[1], mems)))
+            max_rotary_emb_length = max(list(map(lambda m: (m.shape[1] if exists(m) else 0) + x.shape[1], mems))) + cache_length
             rotary_pos_emb = self.rotary_pos_emb(max_rotary_emb_length, x.device)
 
         for ind, (layer_type, (norm, block, residual_fn), layer_dropout) in enumerate(
@@ -1097,6 +1637,9 @@ class AttentionLayers(nn.Module):
                 if self.training and self.cross_attn_tokens_dropout > 0.:
                     context, context_mask = dropout_seq(context, context_mask, self.cross_attn_tokens_dropout)
 
+            if layer_type in ('a', 'c'):
+                layer_cache = next(attn_cache, None)
+
             residual = x
 
             pre_branch_norm, post_branch_norm, post_main_norm = norm
@@ -1107,9 +1650,10 @@ class AttentionLayers(nn.Module):
             if layer_type == 'a':
                 out, inter = block(x, mask=mask, context_mask=self_attn_context_mask, attn_mask=attn_mask,
                                    rel_pos=self.rel_pos, rotary_pos_emb=rotary_pos_emb, prev_attn=prev_attn,
-                                   mem=layer_mem)
+                                   mem=layer_mem, cache=layer_cache)
             elif layer_type == 'c':
-                out, inter = block(x, context=context, mask=mask, context_mask=context_mask, prev_attn=prev_cross_attn)
+                out, inter = block(x, context=context, mask=mask, context_mask=context_mask, prev_attn=prev_cross_attn,
+                                   cache=layer_cache)
             elif layer_type == 'f':
                 out = block(x)
 
@@ -1132,7 +1676,8 @@ class AttentionLayers(nn.Module):
         if return_hiddens:
             intermediates = LayerIntermediates(
                 hiddens=hiddens,
-                attn_intermediates=intermediates
+                attn_intermediates=intermediates,
+                cache_length=cache_length + x.shape[1]
             )
 
             return x, intermediates
@@ -1286,10 +1831,11 @@ class TransformerWrapper(nn.Module):
             mems=None,
             pos=None,
             prepend_embeds=None,
+            cache=None,
             **kwargs
     ):
         b, n, device, num_mem, emb_frac_gradient = *x.shape, x.device, self.num_memory_tokens, self.emb_frac_gradient
-        return_hiddens = return_mems | return_attn
+        return_hiddens = return_mems | return_attn | return_intermediates
 
         # absolute positional embedding
 
@@ -1334,6 +1880,19 @@ class TransformerWrapper(nn.Module):
             mems_l, mems_r = mems[:self.shift_mem_down], mems[self.shift_mem_down:]
             mems = [*mems_r, *mems_l]
 
+        # with a key / value cache (return_intermediates of the previous call), only the new positions are computed
+
+        if exists(cache):
+            cache_length = cache.cache_length
+            x = x[:, cache_length:]
+            num_mem = max(num_mem - cache_length, 0)
+
+            if exists(mask):
+                kwargs = {'self_attn_context_mask': mask, **kwargs}
+                mask = mask[:, cache_length:]
+
+            kwargs = {**kwargs, 'cache': cache}
+
         if return_hiddens:
             x, intermediates = self.attn_layers(x, mask=mask, mems=mems, return_hiddens=True, **kwargs)
         else:
@@ -1436,6 +1995,69 @@ class ContinuousTransformerWrapper(nn.Module):
         return out
 
 
+# decoding with the key / value cache, shared by generate_cached and the decoding functions of model/
+
+def self_attentions(net):
+    attn_layers = net.attn_layers
+    return [block for layer_type, (_, block, _) in zip(attn_layers.layer_types, attn_layers.layers)
+            if layer_type == 'a']
+
+
+def windowed_decoding(net):
+    # self attention layers with max_attend_past only keep their window of keys in the cache. when all of them have
+    # one and there are no absolute positions, nothing moves once the sequence is longer than max_seq_len, and
+    # decoding goes on past it with a bounded cache
+    return isinstance(net.pos_emb, always) and all(exists(attn.max_attend_past) for attn in self_attentions(net))
+
+
+def cache_capacity(net):
+    # positions the cache of `net` holds before keys are evicted from a window, or recomputed past max_seq_len
+    windows = [attn.max_attend_past for attn in self_attentions(net) if exists(attn.max_attend_past)]
+    return min(windows + ([net.max_seq_len] if not windowed_decoding(net) else []), default=float('inf'))
+
+
+def crop_to_window(net, out, cache, windowed):
+    # the tokens to run the decoder on and the cache to start from. past the maximum sequence length the window
+    # slides and every position moves, the last max_seq_len tokens are recomputed from scratch
+    if not windowed and out.shape[-1] > net.max_seq_len:
+        return out[:, -net.max_seq_len:], None
+
+    return out, cache
+
+
+def cached_decoding(net, start_tokens, seq_len, sample_fn, context=None, context_mask=None, return_embeddings=False,
+                    eos_token=None, pad_value=0):
+    '''
+    The decoding loop with the key / value cache, shared by generate_cached and the decoding functions of model/ and
+    serve.py: every step runs the decoder on the newest token only (the last max_seq_len ones past it, see
+    crop_to_window), and `sample_fn` turns its output at the last position, the logits or with `return_embeddings`
+    the final states, into the next tokens (b, 1).
+    Yields the tokens after every step. With `eos_token`, stops at the step every sequence has produced one, with
+    what follows it replaced by `pad_value`.
+    '''
+    windowed = windowed_decoding(net)
+    out, cache = start_tokens, None
+
+    for _ in range(seq_len):
+        x, cache = crop_to_window(net, out, cache, windowed)
+
+        hiddens, cache = net(x, context=context, context_mask=context_mask, cache=cache, return_intermediates=True,
+                             return_embeddings=return_embeddings)
+        out = torch.cat((out, sample_fn(hiddens[:, -1])), dim=-1)
+
+        if exists(eos_token):
+            is_eos_tokens = (out == eos_token)
+
+            if is_eos_tokens.any(dim=-1).all():
+                # mask out everything after the eos tokens
+                shifted_is_eos_tokens = F.pad(is_eos_tokens, (1, -1))
+                mask = shifted_is_eos_tokens.float().cumsum(dim=-1) >= 1
+                yield out.masked_fill(mask, pad_value)
+                return
+
+        yield out
+
+
 class XTransformer(nn.Module):
     def __init__(
             self,
@@ -1492,11 +2114,48 @@ class XTransformer(nn.Module):
         self.decoder = AutoregressiveWrapper(self.decoder, ignore_index=ignore_index, pad_value=pad_value)
 
     @torch.no_grad()
-    def generate(self, seq_in, seq_out_start, seq_len, mask=None, attn_mask=None, **kwargs):
+    def generate(self, seq_in, seq_out_start, seq_len, mask=None, attn_mask=None, cache_kv=False, **kwargs):
         encodings = self.encoder(seq_in, mask=mask, attn_mask=attn_mask, return_embeddings=True)
+
+        if cache_kv:
+            return self.generate_cached(encodings, seq_out_start, seq_len, context_mask=mask, **kwargs)
+
         return self.decoder.generate(seq_out_start, seq_len, context=encodings, context_mask=mask, **kwargs)
 
-    def forward(self, src, tgt, mask_src=None, attn_mask=None, src_prepend_embeds=None):
+    @torch.no_grad()
+    def generate_cached(
+            self,
+            context,
+            start_tokens,
+            seq_len,
+            context_mask=None,
+            eos_token=None,
+            temperature=1.,
+            filter_thres=0.9
+    ):
+        # same decoding as the autoregressive wrapper, but each step only runs the decoder on the newest token,
+        # reading the keys / values of the previous ones from the cache. temperature 0 decodes greedily
+        net, pad_value = self.decoder.net, self.decoder.pad_value
+
+        was_training = net.training
+        net.eval()
+
+        def sample(logits):
+            if temperature == 0.:
+                return logits.argmax(dim=-1, keepdim=True)
+
+            probs = F.softmax(top_k(logits, thres=filter_thres) / temperature, dim=-1)
+            return torch.multinomial(probs, 1)
+
+        out = start_tokens
+        for out in cached_decoding(net, start_tokens, seq_len, sample, context=context, context_mask=context_mask,
+                                   eos_token=eos_token, pad_value=pad_value):
+            pass
+
+        net.train(was_training)
+        return out[:, start_tokens.shape[-1]:]
+
+    def forward(self, src, tgt, mask_src=None, attn_mask=None, src_prepend_embeds=None, teacher=None, distill_alpha=0.5):
 
         if exists(src_prepend_embeds) and exists(mask_src):
             mask_src = pad_at_dim(mask_src, (src_prepend_embeds.shape[-2], 0), dim=-1, value=True)
@@ -1507,5 +2166,11 @@ class XTransformer(nn.Module):
         if self.training and self.cross_attn_tokens_dropout > 0:
             enc, mask = dropout_seq(enc, mask_src, self.cross_attn_tokens_dropout)
 
+        if exists(teacher):
+            # (teacher ids, teacher log probabilities) of every target position, from a DistillationCollate
+            logits = self.decoder.net(tgt[:, :-1], context=enc, context_mask=mask_src)
+            return distillation_loss(logits, tgt[:, 1:], *teacher, alpha=distill_alpha,
+                                     ignore_index=self.decoder.ignore_index)
+
         out = self.decoder(tgt, context=enc, context_mask=mask_src)
         return out
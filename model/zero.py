@@ -0,0 +1,348 @@
+import math
+
+import torch
+import torch.distributed as dist
+from torch.optim import Optimizer
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+
+# flat, partitioned parameters
+
+class FlatBuckets():
+    '''
+    The parameters of one optimizer group laid out, in order, in a single flat buffer they are views of. The buffer is
+    cut into buckets of about `bucket_numel` elements, each padded to a multiple of the world size, and every rank owns
+    the same fraction of every bucket: its shard. Gradients are reduced and parameters gathered bucket by bucket, and
+    the optimizer states only exist for the shard.
+    '''
+
+    def __init__(self, params, bucket_numel, world_size, rank):
+        self.params = params
+        self.world_size = world_size
+        self.rank = rank
+
+        # bucket boundaries, a parameter larger than bucket_numel gets a bucket of its own
+
+        groups, current, current_numel = [], [], 0
+        for p in params:
+            if len(current) > 0 and current_numel + p.numel() > bucket_numel:
+                groups.append(current)
+                current, current_numel = [], 0
+            current.append(p)
+            current_numel += p.numel()
+
+        if len(current) > 0:
+            groups.append(current)
+
+        self.buckets = []
+        self.bucket_of = dict()
+        start = 0
+
+        for index, bucket_params in enumerate(groups):
+            numel = sum(p.numel() for p in bucket_params)
+            size = math.ceil(numel / world_size) * world_size
+            self.buckets.append(dict(params=bucket_params, start=start, size=size, shard_size=size // world_size))
+
+            for p in bucket_params:
+                self.bucket_of[p] = index
+
+            start += size
+
+        ref = params[0]
+        self.buffer = torch.zeros(start, dtype=ref.dtype, device=ref.device)
+
+        # parameters become views of the buffer, padded offsets are kept to move between layouts
+
+        self.offsets = []
+        for bucket in self.buckets:
+            offset = bucket['start']
+            for p in bucket['params']:
+                self.offsets.append(offset)
+                view = self.buffer[offset:offset + p.numel()].view_as(p)
+                view.copy_(p.data)
+                p.data = view
+                offset += p.numel()
+
+        self.param_shards = [self.shard_view(self.buffer, bucket) for bucket in self.buckets]
+        self.grad_shards = [torch.zeros_like(shard) for shard in self.param_shards]
+        self.exp_avg = [torch.zeros_like(shard) for shard in self.param_shards]
+        self.exp_avg_sq = [torch.zeros_like(shard) for shard in self.param_shards]
+
+        # parts of the parameters falling in the shard: (param, start in param, end in param, bucket, start in shard)
+
+        self.segments = []
+        index = 0
+        for bucket_index, bucket in enumerate(self.buckets):
+            shard_start = bucket['start'] + self.rank * bucket['shard_size']
+            shard_end = shard_start + bucket['shard_size']
+
+            for p in bucket['params']:
+                offset = self.offsets[index]
+                index += 1
+
+                start, end = max(offset, shard_start), min(offset + p.numel(), shard_end)
+                if start < end:
+                    self.segments.append((p, start - offset, end - offset, bucket_index, start - shard_start))
+
+        # when gradients are sharded: gradients received per bucket during the backward pass
+        self.num_ready = [0] * len(self.buckets)
+
+        # parameters that got a gradient during the step, as AdamW leaves the other ones untouched
+        self.index_of = {p: index for index, p in enumerate(params)}
+        self.has_grad = torch.zeros(len(params), device=ref.device)
+
+    @property
+    def numel(self):
+        return sum(p.numel() for p in self.params)
+
+    def shard_view(self, t, bucket):
+        start = bucket['start'] + self.rank * bucket['shard_size']
+        return t[start:start + bucket['shard_size']]
+
+    def bucket_grads(self, bucket):
+        flat = self.buffer.new_zeros(bucket['size'])
+        offset = 0
+        for p in bucket['params']:
+            if exists(p.grad):
+                flat[offset:offset + p.numel()] = p.grad.reshape(-1)
+            offset += p.numel()
+        return flat
+
+    # layouts
+
+    def gather_shards(self, shards):
+        # full, unpadded flat tensor in parameter order, from the shards of every rank (collective)
+        padded = []
+        for shard in shards:
+            parts = [torch.empty_like(shard) for _ in range(self.world_size)]
+            dist.all_gather(parts, shard.contiguous())
+            padded.append(torch.cat(parts))
+        padded = torch.cat(padded)
+
+        return torch.cat([padded[offset:offset + p.numel()] for offset, p in zip(self.offsets, self.params)])
+
+    def split_shards(self, full):
+        # shards of this rank, from a full unpadded flat tensor in parameter order
+        assert full.numel() == self.numel, 'optimizer state does not match the parameters'
+        padded = self.buffer.new_zeros(self.buffer.shape)
+
+        start = 0
+        for offset, p in zip(self.offsets, self.params):
+            padded[offset:offset + p.numel()] = full[start:start + p.numel()]
+            start += p.numel()
+
+        return [self.shard_view(padded, bucket).clone() for bucket in self.buckets]
+
+
+# sharded AdamW
+
+class ZeroAdamW(Optimizer):
+    '''
+    AdamW with its states partitioned across the ranks of the default process group, as stage 1 of ZeRO (Rajbhandari
+    et al., 2020): every rank updates its shard of the parameters, which are then all-gathered. The exponential averages
+    take 2 / world_size of the parameter memory instead of twice the parameter memory.
+
+    With `shard_gradients` (stage 2), the model must not all-reduce its gradients itself (run the backward pass under
+    DistributedDataParallel's no_sync): gradients are reduce-scattered bucket by bucket during the backward pass, then
+    freed, so only the shard of the reduced gradients is kept. The buckets of all groups are reduced in one fixed
+    sequence, from the last parameters of `param_order` (model.parameters(), by default the parameters of the groups
+    one after the other) to the first, each as soon as it and the ones before it in the sequence are complete.
+    Parameters a process did not use (layer dropout) hold the sequence back until the end of its backward pass, when the
+    remaining buckets are reduced, so all processes still issue the same collectives in the same order. The gloo
+    backend has no reduce-scatter, an all-reduce is used there instead.
+
+    Gradients are only complete in the shards, clip them with `clip_grad_norm_` of the optimizer. `state_dict` is
+    collective and returns the full states, in the order of the parameters, so checkpoints can be resumed with any
+    number of processes.
+    '''
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=1e-2, shard_gradients=False,
+                 bucket_numel=2 ** 24, param_order=None):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        super().__init__(params, defaults)
+
+        self.world_size = dist.get_world_size()
+        self.rank = dist.get_rank()
+        self.shard_gradients = shard_gradients
+        self.has_reduce_scatter = dist.get_backend() != 'gloo'
+
+        self.flat = [FlatBuckets(group['params'], bucket_numel, self.world_size, self.rank) for group in self.param_groups]
+        self.num_steps = 0
+        self.gradients_collected = False
+
+        # sequence in which buckets are reduced when gradients are sharded, and the position in it of the next one
+        param_order = list(param_order) if exists(param_order) else [p for flat in self.flat for p in flat.params]
+        position = {p: index for index, p in enumerate(param_order)}
+        self.reduce_order = sorted(((flat, index) for flat in self.flat for index in range(len(flat.buckets))),
+                                   key=lambda bucket: max(position[p] for p in bucket[0].buckets[bucket[1]]['params']),
+                                   reverse=True)
+        self.next_reduce = 0
+
+        if shard_gradients:
+            for flat in self.flat:
+                for p in flat.params:
+                    p.register_post_accumulate_grad_hook(self.grad_hook(flat))
+
+    # gradients
+
+    def grad_hook(self, flat):
+        def hook(p):
+            flat.num_ready[flat.bucket_of[p]] += 1
+            flat.has_grad[flat.index_of[p]] = 1.
+
+            while self.next_reduce < len(self.reduce_order):
+                next_flat, index = self.reduce_order[self.next_reduce]
+                if next_flat.num_ready[index] < len(next_flat.buckets[index]['params']):
+                    break
+                self.reduce_bucket(next_flat, index)
+
+        return hook
+
+    def reduce_bucket(self, flat, index):
+        bucket = flat.buckets[index]
+        grads = flat.bucket_grads(bucket)
+
+        if self.has_reduce_scatter:
+            shard = torch.empty_like(flat.grad_shards[index])
+            dist.reduce_scatter_tensor(shard, grads)
+        else:
+            dist.all_reduce(grads)
+            shard = grads.chunk(self.world_size)[self.rank]
+
+        flat.grad_shards[index].add_(shard, alpha=1 / self.world_size)
+
+        for p in bucket['params']:
+            p.grad = None
+
+        flat.num_ready[index] = 0
+        self.next_reduce += 1
+
+    def collect_gradients(self):
+        # gradient shards of the current step, once per step
+        if self.gradients_collected:
+            return
+
+        if self.shard_gradients:
+            # buckets left over by the backward pass, with parameters that got no gradient
+            while self.next_reduce < len(self.reduce_order):
+                self.reduce_bucket(*self.reduce_order[self.next_reduce])
+
+            self.next_reduce = 0
+
+        for flat in self.flat:
+            if self.shard_gradients:
+                continue
+
+            # gradients were all-reduced by DistributedDataParallel, only the parts of the shard are kept
+            for shard in flat.grad_shards:
+                shard.zero_()
+
+            for index, p in enumerate(flat.params):
+                flat.has_grad[index] = float(exists(p.grad))
+
+            for p, start, end, bucket_index, shard_start in flat.segments:
+                if exists(p.grad):
+                    flat.grad_shards[bucket_index][shard_start:shard_start + end - start] = p.grad.reshape(-1)[start:end]
+
+        for flat in self.flat:
+            dist.all_reduce(flat.has_grad, op=dist.ReduceOp.MAX)
+
+        self.gradients_collected = True
+
+    @torch.no_grad()
+    def clip_grad_norm_(self, max_norm):
+        self.collect_gradients()
+
+        grads = [shard for flat in self.flat for shard in flat.grad_shards]
+        norm_sq = torch.stack([g.float().pow(2).sum() for g in grads]).sum()
+        dist.all_reduce(norm_sq)
+        total_norm = norm_sq.sqrt()
+
+        clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.)
+        torch._foreach_mul_(grads, clip_coef)
+        return total_norm
+
+    def zero_grad(self, set_to_none=True):
+        super().zero_grad(set_to_none=set_to_none)
+
+        for flat in self.flat:
+            for shard in flat.grad_shards:
+                shard.zero_()
+
+    # update
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = closure() if exists(closure) else None
+
+        self.collect_gradients()
+        self.num_steps += 1
+
+        for group, flat in zip(self.param_groups, self.flat):
+            lr, (beta1, beta2), eps, weight_decay = group['lr'], group['betas'], group['eps'], group['weight_decay']
+            params, grads, exp_avg, exp_avg_sq = flat.param_shards, flat.grad_shards, flat.exp_avg, flat.exp_avg_sq
+
+            # parameters without gradient on any process keep their values and states
+            skipped = [segment for segment in flat.segments if flat.has_grad[flat.index_of[segment[0]]] == 0]
+            saved = [[t[bucket_index][shard_start:shard_start + end - start].clone() for t in (params, exp_avg, exp_avg_sq)]
+                     for _, start, end, bucket_index, shard_start in skipped]
+
+            bias_correction1 = 1 - beta1 ** self.num_steps
+            bias_correction2 = 1 - beta2 ** self.num_steps
+
+            if weight_decay != 0:
+                torch._foreach_mul_(params, 1 - lr * weight_decay)
+
+            torch._foreach_lerp_(exp_avg, grads, 1 - beta1)
+            torch._foreach_mul_(exp_avg_sq, beta2)
+            torch._foreach_addcmul_(exp_avg_sq, grads, grads, value=1 - beta2)
+
+            denom = torch._foreach_sqrt(exp_avg_sq)
+            torch._foreach_div_(denom, math.sqrt(bias_correction2))
+            torch._foreach_add_(denom, eps)
+            torch._foreach_addcdiv_(params, exp_avg, denom, value=-lr / bias_correction1)
+
+            for (_, start, end, bucket_index, shard_start), values in zip(skipped, saved):
+                for t, value in zip((params, exp_avg, exp_avg_sq), values):
+                    t[bucket_index][shard_start:shard_start + end - start] = value
+
+            # every rank gets the updated shards of the others
+            for bucket, shard in zip(flat.buckets, params):
+                parts = list(flat.buffer[bucket['start']:bucket['start'] + bucket['size']].chunk(self.world_size))
+                dist.all_gather(parts, shard.clone())
+
+            for shard in grads:
+                shard.zero_()
+            flat.has_grad.zero_()
+
+        self.gradients_collected = False
+        return loss
+
+    # checkpointing
+
+    def state_dict(self):
+        # collective, every rank must call it
+        param_groups = [{key: value for key, value in group.items() if key != 'params'} for group in self.param_groups]
+
+        return dict(
+            step=self.num_steps,
+            exp_avg=[flat.gather_shards(flat.exp_avg).cpu() for flat in self.flat],
+            exp_avg_sq=[flat.gather_shards(flat.exp_avg_sq).cpu() for flat in self.flat],
+            param_groups=param_groups
+        )
+
+    def load_state_dict(self, state_dict):
+        assert len(state_dict['exp_avg']) == len(self.flat), 'optimizer state does not match the parameter groups'
+        self.num_steps = state_dict['step']
+
+        for group, saved_group in zip(self.param_groups, state_dict['param_groups']):
+            group.update(saved_group)
+
+        for flat, exp_avg, exp_avg_sq in zip(self.flat, state_dict['exp_avg'], state_dict['exp_avg_sq']):
+            device = flat.buffer.device
+            flat.exp_avg = flat.split_shards(exp_avg.to(device))
+            flat.exp_avg_sq = flat.split_shards(exp_avg_sq.to(device))
@@ -0,0 +1,339 @@
+import json
+import queue
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from model.batching import ContinuousBatcher
+from model.checkpoint import load_weights
+from model.quantization import quantize_int8
+from model.xtransformer import cached_decoding
+from model.translation_cache import TranslationCache
+from utils import build_seq2seq, ids_to_tokens, BPE_to_eval
+
+SOS_TOKEN, EOS_TOKEN, UNK_TOKEN, PAD_IDX = 1, 0, 2, 3
+
+
+@torch.no_grad()
+def stream_greedy(model, src, max_len, eos_token=EOS_TOKEN, pad_idx=PAD_IDX):
+    '''
+    Greedy decoding of a batch with the key / value cache, yielding (row, ids) for every sequence as soon as it produced
+    its eos token, instead of once the longest one is done. The ids stop before the eos token, and are those of
+    `model.generate(..., cache_kv=True, temperature=0.)`.
+    '''
+    mask = src != pad_idx
+    context = model.encoder(src, mask=mask, return_embeddings=True)
+
+    out = torch.ones((src.shape[0], 1), dtype=torch.long, device=src.device) * SOS_TOKEN
+    done = torch.zeros(src.shape[0], dtype=torch.bool, device=src.device)
+
+    def greedy(logits):
+        return logits.argmax(dim=-1, keepdim=True)
+
+    for out in cached_decoding(model.decoder.net, out, max_len, greedy, context=context, context_mask=mask):
+        finished = (out[:, -1] == eos_token) & ~done
+        done |= finished
+
+        for row in finished.nonzero()[:, 0].tolist():
+            yield row, out[row, 1:-1].tolist()
+
+        if done.all():
+            return
+
+    for row in (~done).nonzero()[:, 0].tolist():
+        yield row, out[row, 1:].tolist()
+
+
+class Request():
+    def __init__(self, ids, future, arrival):
+        self.ids = ids
+        self.future = future
+        self.arrival = arrival
+
+
+class TranslationServer():
+    '''
+    Local HTTP / JSON translation service. Sentences are queued as they come in and grouped into batches, closed when
+    the padded batch would exceed `max_batch_tokens` source tokens or `max_wait` seconds after its first sentence
+    arrived. Batches are translated one at a time on a worker thread, so the event loop keeps accepting requests, and
+    every sentence is answered as soon as its own translation is finished.
+    With `continuous_slots`, batches are replaced by continuous batching (model/batching.py): the worker thread decodes
+    one step at a time and sentences join the running batch at the next step. `kv_pages` further keeps its self
+    attention keys / values in a pool of pages of `page_size` positions, allocated as the sequences grow.
+
+    POST /translate  {"ids": [1, ..., 0]} (source ids, as in the dataset files) or {"tokens": ["BPE", "tokens"]}
+                     -> {"ids": [...], "tokens": [...], "text": "...", "latency_ms": ...}
+    GET  /stats      -> number of sentences and batches translated, key / value cache page usage when paged, and
+                        translation cache hits and misses
+    Repeated sentences are answered from `cache` (model/translation_cache.py) when one is given, without being queued.
+    '''
+
+    def __init__(self, model, vocabulary, max_len=120, max_batch_tokens=4096, max_batch_size=64, max_wait=0.01,
+                 continuous_slots=None, kv_pages=None, page_size=16, cache=None):
+        self.model = model
+        self.vocabulary = vocabulary
+        self.max_len = max_len
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cache = cache
+        self.decode_config = dict(decoding='greedy', max_len=max_len)
+
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # translation cache lookups and writes (which touch the disk tier) run off the event loop, on a thread of their
+        # own, so they are never queued behind the batch being decoded and the cache is only used by one thread
+        self.cache_executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.pending = None
+
+        self.continuous_slots = continuous_slots
+        self.kv_pages = kv_pages
+        self.page_size = page_size
+        self.requests = queue.Queue()
+        self.kv_cache_stats = None
+
+        self.num_sentences = 0
+        self.num_batches = 0
+
+    # batching
+
+    def batch_fits(self, batch, request):
+        longest = max(len(request.ids), *(len(r.ids) for r in batch))
+        return len(batch) < self.max_batch_size and (len(batch) + 1) * longest <= self.max_batch_tokens
+
+    async def next_batch(self):
+        loop = asyncio.get_running_loop()
+
+        first = self.pending if self.pending is not None else await self.queue.get()
+        self.pending = None
+
+        batch = [first]
+        deadline = first.arrival + self.max_wait
+
+        while True:
+            # sentences already waiting are taken at once, the deadline only bounds waiting for new ones
+            if self.queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                request = self.queue.get_nowait()
+
+            if not self.batch_fits(batch, request):
+                self.pending = request
+                break
+
+            batch.append(request)
+
+        return batch
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = await self.next_batch()
+            await loop.run_in_executor(self.executor, self.translate_batch, batch, loop)
+
+    def translate_batch(self, batch, loop):
+        # worker thread: results are handed back to the event loop one sentence at a time
+        try:
+            src = pad_sequence([torch.tensor(r.ids, dtype=torch.long) for r in batch], batch_first=True,
+                               padding_value=PAD_IDX)
+
+            for row, ids in stream_greedy(self.model, src, self.max_len):
+                loop.call_soon_threadsafe(self.resolve, batch[row].future, ids)
+
+            self.num_batches += 1
+            self.num_sentences += len(batch)
+
+        except Exception as error:
+            for request in batch:
+                loop.call_soon_threadsafe(self.reject, request.future, error)
+
+    def continuous_batcher(self):
+        return ContinuousBatcher(self.model, num_slots=self.continuous_slots, max_len=self.max_len,
+                                 num_pages=self.kv_pages, page_size=self.page_size)
+
+    def continuous_worker(self, loop):
+        batcher = self.continuous_batcher()
+
+        while True:
+            # waits for sentences only when nothing is being decoded
+            try:
+                block = not batcher.has_work()
+                while True:
+                    request = self.requests.get(block=block)
+                    batcher.add(request.ids, key=request)
+                    block = False
+            except queue.Empty:
+                pass
+
+            try:
+                for request, ids in batcher.step():
+                    loop.call_soon_threadsafe(self.resolve, request.future, ids)
+                    self.num_sentences += 1
+
+                self.num_batches = batcher.num_steps
+                if batcher.pool is not None:
+                    self.kv_cache_stats = dict(batcher.pool.occupancy(), preemptions=batcher.num_preemptions)
+
+            except Exception as error:
+                in_flight = [key for key in batcher.keys if key is not None] + [key for key, _ in batcher.pending]
+                for request in in_flight:
+                    loop.call_soon_threadsafe(self.reject, request.future, error)
+
+                batcher = self.continuous_batcher()
+
+    @staticmethod
+    def resolve(future, ids):
+        if not future.done():
+            future.set_result(ids)
+
+    @staticmethod
+    def reject(future, error):
+        if not future.done():
+            future.set_exception(error)
+
+    # http
+
+    async def translate(self, payload):
+        loop = asyncio.get_running_loop()
+
+        if 'ids' in payload:
+            ids = [int(i) for i in payload['ids']]
+        else:
+            ids = [SOS_TOKEN] + [self.vocabulary.get(token, UNK_TOKEN) for token in payload['tokens']] + [EOS_TOKEN]
+
+        ids = ids[:self.model.encoder.max_seq_len]
+        request = Request(ids, loop.create_future(), loop.time())
+
+        out = None
+        if self.cache is not None:
+            out = await loop.run_in_executor(self.cache_executor, self.cache.get, ids, self.decode_config)
+
+        if out is None:
+            if self.continuous_slots:
+                self.requests.put(request)
+            else:
+                await self.queue.put(request)
+
+            out = await request.future
+
+            if self.cache is not None:
+                await loop.run_in_executor(self.cache_executor, self.cache.put, ids, self.decode_config, out)
+
+        tokens = ids_to_tokens(out, self.vocabulary)
+
+        return dict(ids=out, tokens=tokens, text=BPE_to_eval(tokens),
+                    latency_ms=1000 * (loop.time() - request.arrival))
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = dict()
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            if len(request_line) < 2:
+                status, response = 400, dict(error='bad request')
+            elif request_line[:2] == ['POST', '/translate']:
+                status, response = 200, await self.translate(json.loads(body))
+            elif request_line[:2] == ['GET', '/stats']:
+                status, response = 200, dict(sentences=self.num_sentences, batches=self.num_batches,
+                                             queued=self.queue.qsize())
+                if self.kv_cache_stats is not None:
+                    response['kv_cache'] = self.kv_cache_stats
+                if self.cache is not None:
+                    response['translation_cache'] = self.cache.stats()
+            else:
+                status, response = 404, dict(error='not found')
+
+        except (ValueError, KeyError, TypeError) as error:
+            status, response = 400, dict(error=str(error))
+        except Exception as error:
+            status, response = 500, dict(error=str(error))
+
+        body = json.dumps(response).encode('utf-8')
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+        writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+                     % (status, reason.encode('latin-1'), len(body)) + body)
+
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self.batcher())
+
+        if self.continuous_slots:
+            threading.Thread(target=self.continuous_worker, args=(asyncio.get_running_loop(),), daemon=True).start()
+
+        server = await asyncio.start_server(self.handle, host, port)
+        print('serving on http://%s:%d' % (host, port))
+
+        async with server:
+            try:
+                await server.serve_forever()
+            finally:
+                batcher.cancel()
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+
+    with open('dataset/nl/wmt17_en_de/vocabulary.json', 'r') as f:
+        vocabulary = json.load(f)
+
+    model = build_seq2seq(len(vocabulary))
+    load_weights(model, args.checkpoint)
+    model.eval()
+
+    if args.int8:
+        model = quantize_int8(model)
+
+    cache = TranslationCache(model, args.cache_entries, args.cache_dir) if args.cache_entries > 0 else None
+
+    server = TranslationServer(model, vocabulary, max_len=args.max_len, max_batch_tokens=args.max_batch_tokens,
+                               max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000,
+                               continuous_slots=args.continuous_slots, kv_pages=args.kv_pages,
+                               page_size=args.page_size, cache=cache)
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='local batched translation server')
+    parser.add_argument("--checkpoint", help="model weights", default='output/model_seq2seq.weights')
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_len", type=int, default=120)
+    parser.add_argument("--max_batch_tokens", type=int, default=4096, help="padded source tokens per batch")
+    parser.add_argument("--max_batch_size", type=int, default=64)
+    parser.add_argument("--max_wait_ms", type=float, default=10., help="longest a sentence waits for its batch to fill")
+    parser.add_argument("--continuous_slots", type=int, default=None,
+                        help="continuous batching over this many sequences instead of request batches")
+    parser.add_argument("--kv_pages", type=int, default=None,
+                        help="with --continuous_slots, paged key / value cache of this many pages")
+    parser.add_argument("--page_size", type=int, default=16, help="positions per key / value cache page")
+    parser.add_argument("--cache_entries", type=int, default=0, help="translations kept in memory, 0 disables the cache")
+    parser.add_argument("--cache_dir", default=None, help="on disk translation cache, behind the in memory one")
+    parser.add_argument("--int8", action='store_true', help="int8 dynamically quantized linear layers")
+    parser.add_argument("--threads", type=int, default=4)
+
+    main(parser.parse_args())
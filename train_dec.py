@@ -1,6 +1,6 @@
-from x_transformers import TransformerWrapper, Decoder
-from x_transformers.autoregressive_wrapper import AutoregressiveWrapper
+from model.xtransformer import TransformerWrapper, Decoder, AutoregressiveWrapper
 
+import math
 import random
 import tqdm
 import gzip
@@ -21,6 +21,15 @@ GENERATE_EVERY  = 500
 GENERATE_LENGTH = 1024
 SEQ_LEN = 1024
 
+# transformer-xl style segment recurrence: the corpus is read as BATCH_SIZE contiguous streams, every batch continues
+# the previous one and also attends to the (detached) hidden states of its last MAX_MEM_LEN positions, so the context
+# grows past the segment length without attending over longer windows. relative positions replace absolute ones
+
+RECURRENT = False
+SEGMENT_LEN = 512
+MAX_MEM_LEN = 512
+VALIDATE_DOCUMENT_LEN = 65536
+
 # helpers
 
 def cycle(loader):
@@ -34,12 +43,39 @@ def decode_token(token):
 def decode_tokens(tokens):
     return ''.join(list(map(decode_token, tokens)))
 
+def segment_loss(net, seq, mems = None):
+    logits, mems = net(seq[:, :-1], mems = mems, return_mems = True)
+    loss = F.cross_entropy(logits.transpose(1, 2), seq[:, 1:])
+    return loss, mems
+
+def cycle_segments(stream):
+    # yields each segment with whether the streams start over there, where the memories must be reset
+    while True:
+        for index in range(len(stream)):
+            yield stream[index].cuda(), index == 0
+
+@torch.no_grad()
+def evaluate_document(net, document, seq_len):
+    # loss per token over a whole document, scored segment after segment with the memories of the previous ones:
+    # every segment attends to at most seq_len + max_mem_len positions, whatever the length of the document
+    document = document.long().cuda()[None]
+    num_tokens = document.shape[-1] - 1
+
+    total_loss, mems = 0., None
+    for start in range(0, num_tokens, seq_len):
+        seq = document[:, start: start + seq_len + 1]
+        logits, mems = net(seq[:, :-1], mems = mems, return_mems = True)
+        total_loss += F.cross_entropy(logits.transpose(1, 2), seq[:, 1:], reduction = 'sum').item()
+
+    return total_loss / num_tokens
+
 # instantiate GPT-like decoder model
 
 model = TransformerWrapper(
     num_tokens = 256,
     max_seq_len = SEQ_LEN,
-    attn_layers = Decoder(dim = 512, depth = 6, heads = 8)
+    max_mem_len = MAX_MEM_LEN if RECURRENT else 0,
+    attn_layers = Decoder(dim = 512, depth = 6, heads = 8, rel_pos_bias = RECURRENT)
 )
 
 model = AutoregressiveWrapper(model)
@@ -66,11 +102,31 @@ class TextSamplerDataset(Dataset):
     def __len__(self):
         return self.data.size(0) // self.seq_len
 
+class SegmentStream():
+    # the data cut into batch_size contiguous rows, read one segment at a time. consecutive segments overlap by one
+    # token, the last target of a segment being the first input of the next one
+    def __init__(self, data, batch_size, seq_len):
+        row_len = (data.size(0) - 1) // batch_size
+        self.rows = torch.stack([data[i * row_len: (i + 1) * row_len + 1] for i in range(batch_size)])
+        self.seq_len = seq_len
+        self.num_segments = row_len // seq_len
+
+    def __getitem__(self, index):
+        start = index * self.seq_len
+        return self.rows[:, start: start + self.seq_len + 1].long()
+
+    def __len__(self):
+        return self.num_segments
+
 train_dataset = TextSamplerDataset(data_train, SEQ_LEN)
 val_dataset   = TextSamplerDataset(data_val, SEQ_LEN)
 train_loader  = cycle(DataLoader(train_dataset, batch_size = BATCH_SIZE))
 val_loader    = cycle(DataLoader(val_dataset, batch_size = BATCH_SIZE))
 
+if RECURRENT:
+    train_segments = cycle_segments(SegmentStream(data_train, BATCH_SIZE, SEGMENT_LEN))
+    mems = None
+
 # optimizer
 
 optim = torch.optim.Adam(model.parameters(), lr=LEARNING_RATE)
@@ -81,7 +137,11 @@ for i in tqdm.tqdm(range(NUM_BATCHES), mininterval=10., desc='training'):
     model.train()
 
     for __ in range(GRADIENT_ACCUMULATE_EVERY):
-        loss = model(next(train_loader))
+        if RECURRENT:
+            seq, is_start = next(train_segments)
+            loss, mems = segment_loss(model.net, seq, mems = None if is_start else mems)
+        else:
+            loss = model(next(train_loader))
         loss.backward()
 
     print(f'training loss: {loss.item()}')
@@ -91,9 +151,13 @@ for i in tqdm.tqdm(range(NUM_BATCHES), mininterval=10., desc='training'):
 
     if i % VALIDATE_EVERY == 0:
         model.eval()
-        with torch.no_grad():
-            loss = model(next(val_loader))
-            print(f'validation loss: {loss.item()}')
+        if RECURRENT:
+            loss = evaluate_document(model.net, data_val[:VALIDATE_DOCUMENT_LEN], SEGMENT_LEN)
+            print(f'validation loss: {loss}, bits per byte: {loss / math.log(2)}')
+        else:
+            with torch.no_grad():
+                loss = model(next(val_loader))
+                print(f'validation loss: {loss.item()}')
 
     if i % GENERATE_EVERY == 0:
         model.eval()
@@ -0,0 +1,88 @@
+import json
+import time
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+from model.checkpoint import load_weights, atomic_save, save_flat_state_dict
+from model.speculative import build_draft_decoder
+from utils import load_ids, build_seq2seq, PackedTextDataset, PackedCollate, epoch_time, count_parameters
+
+
+def main(args):
+    '''
+    Trains the draft decoder used by speculative decoding to imitate the frozen translation model: on the training
+    references, the draft's next token distribution is fit to the main decoder's one, as the draft is only useful if it
+    proposes the tokens greedy decoding of the main model would pick.
+    '''
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    pad_idx = 3
+
+    with open('dataset/nl/wmt17_en_de/vocabulary.json', 'r') as f:
+        vocabulary = json.load(f)
+
+    model = build_seq2seq(len(vocabulary))
+    load_weights(model, args.checkpoint)
+    model.to(device).eval().requires_grad_(False)
+
+    draft = build_draft_decoder(model, depth=args.depth).to(device)
+    print('number of draft parameters:', count_parameters(draft))
+
+    X_train = load_ids('dataset/nl/wmt17_en_de/train.en.ids.gz')
+    Y_train = load_ids('dataset/nl/wmt17_en_de/train.de.ids.gz')
+
+    train_dataset = PackedTextDataset(X_train, Y_train, args.max_len)
+    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, num_workers=4, shuffle=True,
+                              pin_memory=True, collate_fn=PackedCollate(train_dataset, pad_idx=pad_idx))
+
+    optimizer = torch.optim.Adam(draft.parameters(), lr=args.lr)
+
+    for epoch in range(args.epochs):
+        start_time = time.time()
+        draft.train()
+        report_loss, countdown = 0., 0
+
+        for src, tgt, mask_src in train_loader:
+            src, tgt, mask_src = src.to(device), tgt.to(device), mask_src.to(device)
+            tgt_in = tgt[:, :-1]
+
+            with torch.no_grad():
+                context = model.encoder(src, mask=mask_src, return_embeddings=True)
+                teacher_logits = model.decoder.net(tgt_in, context=context, context_mask=mask_src)
+
+            logits = draft(tgt_in, context=context, context_mask=mask_src)
+
+            # distillation on the positions of the reference, padding excluded
+            kl = F.kl_div(F.log_softmax(logits, dim=-1), F.log_softmax(teacher_logits, dim=-1), log_target=True,
+                          reduction='none').sum(dim=-1)
+            positions = tgt_in != pad_idx
+            loss = (kl * positions).sum() / positions.sum()
+
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(draft.parameters(), 1.)
+            optimizer.step()
+            optimizer.zero_grad()
+
+            report_loss += loss.item()
+            countdown += 1
+
+        epoch_mins, epoch_secs = epoch_time(start_time, time.time())
+        print('[EPOCH %d] kl_train=%.5f | %dm %ds' % (epoch, report_loss / countdown, epoch_mins, epoch_secs))
+
+        atomic_save(draft.state_dict(), args.output, save_fn=save_flat_state_dict)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='distill the draft decoder for speculative decoding')
+    parser.add_argument("--checkpoint", help="weights of the translation model", default='output/model_seq2seq.weights')
+    parser.add_argument("--output", help="draft decoder weights", default='output/draft_seq2seq.weights')
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--batch_size", type=int, default=128)
+    parser.add_argument("--lr", type=float, default=1e-4)
+    parser.add_argument("--max_len", type=int, default=120)
+
+    main(parser.parse_args())
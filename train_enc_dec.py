@@ -7,11 +7,12 @@ import time
 
 from transformers.optimization import get_constant_schedule_with_warmup
 from model.optimizer import get_optimizer
+from model.distillation import TeacherStore, DistillationCollate
 
 import torch
 from torch.utils.data import DataLoader
 
-from utils import TextSamplerDataset, MyCollate, BPE_to_eval, ids_to_tokens, epoch_time
+from utils import TextSamplerDataset, PackedTextDataset, PackedCollate, BPE_to_eval, ids_to_tokens, epoch_time
 
 from model.xtransformer import XTransformer
 
@@ -38,6 +39,8 @@ def main():
     DEC_SEQ_LEN = 100
     MAX_LEN = 100
     WARMUP_STEP = 50
+    TEACHER_STORE = None  # directory of teacher top k built by distill_teacher.py on the same corpus and MAX_LEN
+    DISTILL_ALPHA = 0.5
 
     # instantiate model
 
@@ -84,9 +87,13 @@ def main():
         Y_dev = Y_dev[0:20]
 
 
-    train_dataset = TextSamplerDataset(X_dev, Y_dev, MAX_LEN)
+    train_dataset = PackedTextDataset(X_dev, Y_dev, MAX_LEN)
+    if TEACHER_STORE is not None:
+        train_collate = DistillationCollate(train_dataset, TeacherStore(TEACHER_STORE), pad_idx=3)
+    else:
+        train_collate = PackedCollate(train_dataset, pad_idx=3)
     train_loader  = DataLoader(train_dataset, batch_size = BATCH_SIZE, num_workers=0, shuffle=True,
-                           pin_memory=True, collate_fn=MyCollate(pad_idx=3))
+                           pin_memory=True, collate_fn=train_collate)
     dev_dataset = TextSamplerDataset(X_dev, Y_dev, MAX_LEN)
     dev_loader  = DataLoader(dev_dataset, batch_size=1, num_workers=0)
 
@@ -103,11 +110,9 @@ def main():
 
         start_time = time.time()
 
-        for src, tgt in train_loader:
+        for src, tgt, mask_src, *teacher in train_loader:
 
-            mask_src = src != 3
-
-            loss = model(src, tgt.type(torch.LongTensor), mask_src=mask_src)
+            loss = model(src, tgt, mask_src=mask_src, teacher=tuple(teacher) or None, distill_alpha=DISTILL_ALPHA)
 
             loss.backward()
 
@@ -1,25 +1,29 @@
+import os
 import gzip
 import numpy as np
 import tqdm
 import json
 import time
 import datetime
+import contextlib
 
 from transformers.optimization import get_constant_schedule_with_warmup
 from model.optimizer import get_optimizer
+from model.comm_hooks import COMM_HOOKS, register_comm_hook
+from model.checkpoint import CheckpointManager, PreemptionHandler, load_weights, rng_state, set_rng_state
+from model.distillation import TeacherStore, DistillationCollate
 
 import torch
 from torch.utils.data import DataLoader
 
-from utils import TextSamplerDataset, MyCollate, ids_to_tokens, BPE_to_eval, epoch_time, count_parameters, mpp_generate_postprocessing
-
-from model.xtransformer import XTransformer
+from utils import build_seq2seq, TextSamplerDataset, PackedTextDataset, PackedCollate, ResumableRandomSampler, ids_to_tokens, BPE_to_eval, epoch_time, count_parameters, mpp_generate_postprocessing
 
 from accelerate import Accelerator, DistributedDataParallelKwargs, InitProcessGroupKwargs
+from accelerate.utils import gather_object
 
 import sacrebleu
 
-def main(finetuning):
+def main(finetuning, resume=False, comm_hook='none', powersgd_rank=1, powersgd_start_iter=1000, finetune_weights=None):
 
     ddp_kwargs_1 = DistributedDataParallelKwargs(find_unused_parameters=True)
     ddp_kwargs_2 = InitProcessGroupKwargs(timeout=datetime.timedelta(seconds=5400))
@@ -39,24 +43,21 @@ def main(finetuning):
     BATCH_SIZE = 156
     LEARNING_RATE = 1e-4
     GENERATE_EVERY  = 1
-    ENC_SEQ_LEN = 120
-    DEC_SEQ_LEN = 120
+    SEQ_LEN = 120  # of the encoder and of the decoder
     MAX_LEN = 120
     WARMUP_STEP = 4000
-
-    model = XTransformer(
-        dim = 512,
-        tie_token_embeds = True,
-        return_tgt_loss = True,
-        enc_num_tokens=NUM_TOKENS,
-        enc_depth = 6,
-        enc_heads = 8,
-        enc_max_seq_len = ENC_SEQ_LEN,
-        dec_num_tokens = NUM_TOKENS,
-        dec_depth = 6,
-        dec_heads = 8,
-        dec_max_seq_len = DEC_SEQ_LEN
-    )
+    KEEP_LAST_CHECKPOINTS = 3
+    CHECK_PREEMPTION_EVERY = 50
+    PREEMPTION_FLAG_FILE = 'output/preempt.flag'
+    ZERO = False  # optimizer states partitioned across processes (model/zero.py)
+    SHARD_GRADIENTS = False  # with ZERO, gradients are reduce-scattered and partitioned too
+    FUSED_OPTIMIZER = False  # without ZERO, AdamW over flat parameter and gradient buffers (model/optimizer.py)
+    EIGHT_BIT_OPTIMIZER = False  # AdamW with blockwise quantized 8 bit moments (model/adam8bit.py)
+    TEACHER_STORE = None  # directory of teacher top k built by distill_teacher.py, to train a distilled student
+    DISTILL_ALPHA = 0.5  # weight of the teacher in the distillation loss
+
+    # the configuration shared with the tools that load its weights
+    model = build_seq2seq(NUM_TOKENS, max_seq_len=SEQ_LEN)
 
     print('number of parameters:', count_parameters(model))
 
@@ -85,9 +86,14 @@ def main(finetuning):
         Y_dev = [np.array([int(x) for x in line.split()]) for line in Y_dev]
 
 
-    train_dataset = TextSamplerDataset(X_train, Y_train, MAX_LEN)
-    train_loader  = DataLoader(train_dataset, batch_size = BATCH_SIZE, num_workers=4, shuffle=True,
-                           pin_memory=True, collate_fn=MyCollate(pad_idx=3))
+    train_dataset = PackedTextDataset(X_train, Y_train, MAX_LEN)
+    train_sampler = ResumableRandomSampler(train_dataset)
+    if TEACHER_STORE is not None:
+        train_collate = DistillationCollate(train_dataset, TeacherStore(TEACHER_STORE), pad_idx=3)
+    else:
+        train_collate = PackedCollate(train_dataset, pad_idx=3)
+    train_loader  = DataLoader(train_dataset, batch_size = BATCH_SIZE, num_workers=4, sampler=train_sampler,
+                           pin_memory=True, collate_fn=train_collate)
     dev_dataset = TextSamplerDataset(X_dev, Y_dev, MAX_LEN)
     dev_loader  = DataLoader(dev_dataset, batch_size=1)
 
@@ -114,46 +120,115 @@ def main(finetuning):
 
 
     # optimizer
-    optimizer = get_optimizer(model.parameters(), LEARNING_RATE, wd=0.01)
+    if ZERO or FUSED_OPTIMIZER:
+        # both optimizers make the parameters views of their flat buffers, they must be on their device first
+        model.to(accelerator.device)
+
+    optimizer = get_optimizer(model.parameters(), LEARNING_RATE, wd=0.01, zero=ZERO, shard_gradients=SHARD_GRADIENTS,
+                              fused=FUSED_OPTIMIZER, eight_bit=EIGHT_BIT_OPTIMIZER)
+    flat_optimizer = optimizer if ZERO or FUSED_OPTIMIZER else None
     scheduler = get_constant_schedule_with_warmup(optimizer, num_warmup_steps=WARMUP_STEP)
 
+    checkpoints = CheckpointManager('output/checkpoints', keep_last=KEEP_LAST_CHECKPOINTS,
+                                    is_main_process=accelerator.is_main_process)
+
+    preemption = PreemptionHandler(flag_file=PREEMPTION_FLAG_FILE)
+
+    resume_state = None
+    if resume and checkpoints.latest() is not None:
+        print('resume from', checkpoints.latest())
+        resume_state = checkpoints.load()
+        model.load_state_dict(resume_state['model'])
+    elif finetuning:
+        # runs from before the flat weights format saved their best model to the pickled .pt file, which
+        # load_weights reads as well
+        if finetune_weights is None:
+            finetune_weights = 'output/model_seq2seq.weights'
+            if not os.path.exists(finetune_weights):
+                finetune_weights = 'output/model_seq2seq.pt'
+
+        print('finetune from', finetune_weights)
+        load_weights(model, finetune_weights)
+
     model, optimizer, train_loader, dev_loader = accelerator.prepare(model, optimizer, train_loader, dev_loader)
 
-    if finetuning:
-        print('finetune')
-        model.load_state_dict(
-            torch.load(
-                'output/model_seq2seq.pt',
-            ),
-        )
+    # gradient compression of the DistributedDataParallel all-reduce, which sharded gradients bypass
+    if comm_hook != 'none' and accelerator.num_processes > 1:
+        assert not SHARD_GRADIENTS, 'the sharded optimizer reduces the gradients itself, there is no all-reduce to compress'
+        register_comm_hook(model, comm_hook, powersgd_rank=powersgd_rank, powersgd_start_iter=powersgd_start_iter)
 
     report_loss = 0.
     best_bleu = 0
+    step = 0
+
+    if resume_state is not None:
+        optimizer.load_state_dict(resume_state['optimizer'])
+        scheduler.load_state_dict(resume_state['scheduler'])
+        train_sampler.load_state_dict(resume_state['sampler'])
+        step = resume_state['step']
+        best_bleu = resume_state['best_bleu']
+
+        rng_states = resume_state['rng']
+        same_world = len(rng_states) == accelerator.num_processes
+        set_rng_state(rng_states[accelerator.process_index] if same_world else rng_states[0])
+
+        del resume_state
+
+    def save_checkpoint(num_consumed=0):
+        # collective: every process hands in its random state, the main process writes
+        checkpoints.save(
+            step,
+            model=accelerator.unwrap_model(model).state_dict(),
+            optimizer=optimizer.state_dict(),
+            scheduler=scheduler.state_dict(),
+            sampler=train_sampler.state_dict(num_consumed),
+            rng=gather_object([rng_state()]),
+            step=step,
+            best_bleu=best_bleu
+        )
+
+    def preemption_requested():
+        # processes may see the signal at different steps, they all stop at the first step any of them saw it
+        requested = torch.tensor([float(preemption.requested())], device=accelerator.device)
+        return accelerator.gather(requested).sum().item() > 0
 
     # training
-    for i in tqdm.tqdm(range(EPOCHS), desc='training'):
+    for i in tqdm.tqdm(range(train_sampler.epoch, EPOCHS), desc='training'):
         start_time = time.time()
         model.train()
 
         countdown = 0
 
-        for src, tgt in train_loader:
-
-            mask_src = src != 3
+        for src, tgt, mask_src, *teacher in train_loader:
 
             countdown += 1
 
-            loss = model(src, tgt.type(torch.LongTensor), mask_src=mask_src)
-
-            accelerator.backward(loss)
+            # with sharded gradients the optimizer reduces them, not DistributedDataParallel, which prepares its
+            # all-reduce in the forward pass: no_sync covers the forward pass as well as the backward one
+            with accelerator.no_sync(model) if SHARD_GRADIENTS else contextlib.nullcontext():
+                # with a teacher store, the batches carry the teacher top k of every target position
+                loss = model(src, tgt, mask_src=mask_src, teacher=tuple(teacher) or None, distill_alpha=DISTILL_ALPHA)
+                accelerator.backward(loss)
 
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 0.01)
+            if flat_optimizer is not None:
+                flat_optimizer.clip_grad_norm_(0.01)
+            else:
+                torch.nn.utils.clip_grad_norm_(model.parameters(), 0.01)
 
             report_loss += loss.item()
 
             optimizer.step()
             optimizer.zero_grad()
             scheduler.step()
+            step += 1
+
+            if step % CHECK_PREEMPTION_EVERY == 0 and preemption_requested():
+                # save where this epoch stopped, the resumed run skips the batches already seen
+                print('[Epoch %d] preempted at step %d' % (i, step))
+                save_checkpoint(num_consumed=countdown * BATCH_SIZE * accelerator.num_processes)
+                checkpoints.close()
+                accelerator.wait_for_everyone()
+                return False
 
         print('[Epoch %d] epoch elapsed %ds' % (i, time.time() - start_time))
 
@@ -163,11 +238,7 @@ def main(finetuning):
 
         report_loss = 0
 
-        torch.save(model.state_dict(),
-                   'output/model_seq2seq_each_epoch.pt'
-                   )
-
-        torch.save(optimizer.state_dict(), 'output/optim_seq2seq_each_epoch.bin')
+        train_sampler.seek(i + 1)
 
         if i != 0 and i % GENERATE_EVERY == 0:
 
@@ -202,11 +273,17 @@ def main(finetuning):
 
             if bleu > best_bleu:
                 best_bleu = bleu
-                torch.save(model.state_dict(),
-                           'output/model_seq2seq.pt'
-                           )
+                checkpoints.save_files(
+                    weights={'output/model_seq2seq.weights': accelerator.unwrap_model(model).state_dict()},
+                    # the sharded state dict is collective, and the bleu of every process may differ
+                    files={'output/optim_seq2seq.bin': optimizer.state_dict()} if not ZERO else None
+                )
 
-                torch.save(optimizer.state_dict(), 'output/optim_seq2seq.bin')
+        # after the evaluation, so a resumed run knows the best bleu of this epoch
+        save_checkpoint()
+
+    checkpoints.close()
+    return True
 
 
 def test():
@@ -224,8 +301,7 @@ def test():
     NUM_TOKENS = len(reverse_vocab.keys())
 
     # constants
-    ENC_SEQ_LEN = 120
-    DEC_SEQ_LEN = 120
+    SEQ_LEN = 120  # of the encoder and of the decoder
     MAX_LEN = 120 * 2
 
 
@@ -244,27 +320,11 @@ def test():
     test_dataset = TextSamplerDataset(X_dev, Y_dev, MAX_LEN)
     test_loader  = DataLoader(test_dataset, batch_size=1)
 
-    model = XTransformer(
-        dim=512,
-        tie_token_embeds=True,
-        return_tgt_loss=True,
-        enc_num_tokens=NUM_TOKENS,
-        enc_depth=6,
-        enc_heads=8,
-        enc_max_seq_len=ENC_SEQ_LEN,
-        dec_num_tokens=NUM_TOKENS,
-        dec_depth=6,
-        dec_heads=8,
-        dec_max_seq_len=DEC_SEQ_LEN
-    )
+    model = build_seq2seq(NUM_TOKENS, max_seq_len=SEQ_LEN)
 
-    model, test_loader = accelerator.prepare(model, test_loader)
+    load_weights(model, CheckpointManager('output/checkpoints').model_path())
 
-    model.load_state_dict(
-        torch.load(
-            'output/model_seq2seq_each_epoch.pt',
-        ),
-    )
+    model, test_loader = accelerator.prepare(model, test_loader)
 
     model.eval()
     target = []
@@ -303,6 +363,13 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--train", help="train the model", action="store", default=False)
     parser.add_argument("--test", help="test the model", action="store", default=False)
+    parser.add_argument("--resume", help="resume training from the latest checkpoint", action="store", default="False")
+    parser.add_argument("--finetune_weights", help="weights to finetune from, a .weights or a legacy .pt file",
+                        default=None)
+    parser.add_argument("--comm_hook", help="gradient compression of the all-reduce", choices=COMM_HOOKS, default='none')
+    parser.add_argument("--powersgd_rank", help="rank of the PowerSGD approximation", type=int, default=1)
+    parser.add_argument("--powersgd_start_iter", help="steps of uncompressed all-reduce before PowerSGD", type=int,
+                        default=1000)
 
     args = parser.parse_args()
 
@@ -310,9 +377,13 @@ if __name__ == '__main__':
     is_training = args.train
     is_testing = args.test
 
+    finished = True
+
     if eval(is_training):
         print("training mode")
-        main(finetuning=False)
-    if eval(is_testing):
+        finished = main(finetuning=args.finetune_weights is not None, resume=eval(args.resume),
+                        comm_hook=args.comm_hook, powersgd_rank=args.powersgd_rank,
+                        powersgd_start_iter=args.powersgd_start_iter, finetune_weights=args.finetune_weights)
+    if eval(is_testing) and finished:
         print("testing mode")
         test()
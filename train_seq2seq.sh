@@ -20,6 +20,10 @@
 
 #SBATCH --constraint=v100-32g
 
+#SBATCH --signal=B:USR1@600
+
+#SBATCH --requeue
+
 
 module purge
 module load anaconda-py3/2019.03
@@ -29,4 +33,21 @@ nvidia-smi
 # This will create a config file on your server
 
 
-srun accelerate launch --multi_gpu train_enc_dec_mp.py --train=True --test=True
\ No newline at end of file
+# ten minutes before the time limit SLURM signals this script, which asks the trainer to checkpoint through a flag
+# file (accelerate launch does not forward USR1 to its workers) and requeues the job, which then resumes mid-epoch
+PREEMPTION_FLAG_FILE=output/preempt.flag
+mkdir -p output
+rm -f $PREEMPTION_FLAG_FILE
+trap 'touch $PREEMPTION_FLAG_FILE' USR1
+
+# gradient compression of the all-reduce between the GPUs: none, fp16, bf16 or powersgd
+COMM_HOOK=${COMM_HOOK:-none}
+
+srun accelerate launch --multi_gpu train_enc_dec_mp.py --train=True --test=True --resume=True --comm_hook=$COMM_HOOK &
+wait
+# wait returns early when the trap fires, keep waiting for the checkpoint to be written
+wait
+
+if [ -f $PREEMPTION_FLAG_FILE ]; then
+    scontrol requeue $SLURM_JOB_ID
+fi
\ No newline at end of file
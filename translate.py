@@ -0,0 +1,166 @@
+import sys
+import gzip
+import json
+import time
+from itertools import islice
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from model.checkpoint import load_weights
+from model.quantization import quantize_int8
+from model.translation_cache import TranslationCache
+from model.shortlist import Shortlist, shortlist_generate
+from utils import build_seq2seq, ids_to_tokens, BPE_to_eval, batch_generate_postprocessing, length_batches
+
+SOS_TOKEN, EOS_TOKEN, UNK_TOKEN, PAD_IDX = 1, 0, 2, 3
+
+
+def open_text(path, mode='rt'):
+    if path == '-':
+        return sys.stdin if 'r' in mode else sys.stdout
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def parse_line(line, input_format, vocabulary):
+    # source ids, with sos / eos, of a line of ids (as in the dataset files) or of BPE tokens
+    if input_format == 'ids':
+        ids = [int(x) for x in line.split()]
+        if len(ids) > 0 and ids[0] != SOS_TOKEN:
+            ids = [SOS_TOKEN] + ids + [EOS_TOKEN]
+        return ids
+
+    tokens = line.split()
+    if len(tokens) == 0:
+        return []
+    return [SOS_TOKEN] + [vocabulary.get(token, UNK_TOKEN) for token in tokens] + [EOS_TOKEN]
+
+
+def format_line(ids, output_format, vocabulary):
+    if output_format == 'ids':
+        return ' '.join(map(str, ids))
+
+    tokens = ids_to_tokens(ids, vocabulary)
+    return ' '.join(tokens) if output_format == 'bpe' else BPE_to_eval(tokens)
+
+
+@torch.no_grad()
+def translate_window(model, sources, max_len, max_batch_tokens, max_batch_size, device, cache=None, shortlist=None):
+    # greedy translations of a window of sentences, decoded in length sorted batches and returned in input order.
+    # with a cache, only the sentences it does not hold are decoded
+    # the shortlist is identified by its contents, a rebuilt one never serves the entries of the previous one
+    decode_config = dict(decoding='greedy', max_len=max_len,
+                         shortlist=shortlist.fingerprint() if shortlist is not None else None)
+    translations = [[] for _ in sources]
+    lengths = [len(src) for src in sources]
+    nonempty = [i for i, length in enumerate(lengths) if length > 0]
+
+    if cache is not None:
+        missing = []
+        for i in nonempty:
+            out = cache.get(sources[i], decode_config)
+            if out is None:
+                missing.append(i)
+            else:
+                translations[i] = out
+        nonempty = missing
+
+    for batch in length_batches([lengths[i] for i in nonempty], max_batch_tokens, max_batch_size):
+        indices = [nonempty[i] for i in batch]
+        src = pad_sequence([torch.tensor(sources[i], dtype=torch.long) for i in indices], batch_first=True,
+                           padding_value=PAD_IDX).to(device)
+        start_tokens = torch.full((len(indices), 1), SOS_TOKEN, dtype=torch.long, device=device)
+
+        if shortlist is not None:
+            sample, _ = shortlist_generate(model, shortlist, src, start_tokens, max_len, mask=src != PAD_IDX,
+                                           eos_token=EOS_TOKEN)
+        else:
+            sample = model.generate(src, start_tokens, max_len, mask=src != PAD_IDX, cache_kv=True, temperature=0.,
+                                    eos_token=EOS_TOKEN)
+
+        for i, ids in zip(indices, batch_generate_postprocessing(sample, EOS_TOKEN)):
+            translations[i] = ids
+
+            if cache is not None:
+                cache.put(sources[i], decode_config, ids)
+
+    return translations
+
+
+def main(args):
+    '''
+    Translates a stream of sentences, one per line, from a file or stdin to stdout. Lines are read `window` at a time,
+    sorted by length inside the window and decoded in batches of at most `max_batch_tokens` padded source tokens, and
+    the translations of the window are written in input order before the next one is read, so memory does not grow
+    with the input and output starts after the first window. Empty lines give empty translations.
+    '''
+    torch.set_num_threads(args.threads)
+
+    # dynamically quantized layers only run on the cpu, the batches must be built there too
+    if args.int8 and args.device != 'cpu':
+        print('--int8 decodes on the cpu, ignoring --device %s' % args.device, file=sys.stderr)
+        args.device = 'cpu'
+
+    device = torch.device(args.device)
+
+    with open('dataset/nl/wmt17_en_de/vocabulary.json', 'r') as f:
+        vocabulary = json.load(f)
+
+    model = build_seq2seq(len(vocabulary))
+    load_weights(model, args.checkpoint)
+    model.to(device).eval()
+
+    if args.int8:
+        model = quantize_int8(model)
+
+    shortlist = Shortlist.load(args.shortlist) if args.shortlist else None
+    cache = TranslationCache(model, args.cache_entries, args.cache_dir) if args.cache_entries > 0 else None
+
+    max_src_len = model.encoder.max_seq_len
+    num_sentences, start_time = 0, time.perf_counter()
+
+    with open_text(args.input, 'rt') as lines, open_text(args.output, 'wt') as out:
+        while True:
+            window = list(islice(lines, args.window))
+            if len(window) == 0:
+                break
+
+            sources = [parse_line(line, args.input_format, vocabulary)[:max_src_len] for line in window]
+            translations = translate_window(model, sources, args.max_len, args.max_batch_tokens, args.max_batch_size,
+                                            device, cache=cache, shortlist=shortlist)
+
+            out.write(''.join(format_line(ids, args.output_format, vocabulary) + '\n' for ids in translations))
+            out.flush()
+
+            num_sentences += len(window)
+            elapsed = time.perf_counter() - start_time
+            cache_stats = ' | cache hit rate = %.3f' % cache.stats()['hit_rate'] if cache is not None else ''
+            print('%d sentences | %.1f sentences / s%s' % (num_sentences, num_sentences / elapsed, cache_stats),
+                  file=sys.stderr)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='streaming batch translation, one sentence per line')
+    parser.add_argument("--checkpoint", help="model weights", default='output/model_seq2seq.weights')
+    parser.add_argument("--input", help="input file, gzip if it ends in .gz, - for stdin", default='-')
+    parser.add_argument("--output", help="output file, gzip if it ends in .gz, - for stdout", default='-')
+    parser.add_argument("--input_format", choices=['bpe', 'ids'], default='bpe',
+                        help="BPE tokens or token ids (as in the dataset files) per line")
+    parser.add_argument("--output_format", choices=['text', 'bpe', 'ids'], default='text',
+                        help="detokenized text, BPE tokens or token ids per line")
+    parser.add_argument("--window", type=int, default=1024, help="lines sorted by length together")
+    parser.add_argument("--max_batch_tokens", type=int, default=4096, help="padded source tokens per batch")
+    parser.add_argument("--max_batch_size", type=int, default=128)
+    parser.add_argument("--max_len", type=int, default=120)
+    parser.add_argument("--cache_entries", type=int, default=0, help="translations kept in memory, 0 disables the cache")
+    parser.add_argument("--cache_dir", default=None, help="on disk translation cache, behind the in memory one")
+    parser.add_argument("--shortlist", default=None, help="lexical shortlist (build_shortlist.py) restricting the output vocabulary")
+    parser.add_argument("--int8", action='store_true', help="int8 dynamically quantized linear layers, on the cpu")
+    parser.add_argument("--device", default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--threads", type=int, default=4)
+
+    main(parser.parse_args())
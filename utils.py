@@ -1,8 +1,12 @@
+import gzip
+import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 from torch.nn.utils.rnn import pad_sequence
 import re
 
+from model.xtransformer import XTransformer
+
 def ids_to_tokens(ids_list, vocabulary):
     # Create a reverse vocabulary, mapping id -> token
     reverse_vocab = {id: token for token, id in vocabulary.items()}
@@ -16,6 +20,35 @@ def BPE_to_eval(BPE_list):
 
     return replace_string
 
+def load_ids(path):
+    # one sentence of space separated token ids per line, gzip compressed
+    with gzip.open(path, 'r') as file:
+        lines = file.read().decode(encoding='utf-8').split('\n')
+
+    if lines[-1] == '':
+        lines = lines[:-1]
+
+    return [np.array([int(x) for x in line.split()]) for line in lines]
+
+
+def build_seq2seq(num_tokens, max_seq_len=120, **kwargs):
+    # the translation model of train_enc_dec_mp.py, which builds it here too, so every tool loads its checkpoints
+    return XTransformer(
+        dim=512,
+        tie_token_embeds=True,
+        return_tgt_loss=True,
+        enc_num_tokens=num_tokens,
+        enc_depth=6,
+        enc_heads=8,
+        enc_max_seq_len=max_seq_len,
+        dec_num_tokens=num_tokens,
+        dec_depth=6,
+        dec_heads=8,
+        dec_max_seq_len=max_seq_len,
+        **kwargs
+    )
+
+
 def epoch_time(start_time, end_time):
     elapsed_time = end_time - start_time
     elapsed_mins = int(elapsed_time / 60)
@@ -51,6 +84,42 @@ class TextSamplerDataset(Dataset):
         return torch.IntTensor(src), torch.IntTensor(tgt)
 
 
+class ResumableRandomSampler(Sampler):
+    '''
+    Random sampler whose permutation only depends on (seed, epoch): every process draws the same order, and the
+    order of an epoch can be restored from its state_dict. `seek` jumps to any position of any epoch, so a resumed run
+    skips the samples it has already seen without loading them.
+    The method is deliberately not called `set_epoch`, which accelerate calls with its own iteration counter.
+    '''
+
+    def __init__(self, data_source, seed=0):
+        self.num_samples = len(data_source)
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+
+    def seek(self, epoch, start_index=0):
+        self.epoch = epoch
+        self.start_index = start_index
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(self.num_samples, generator=generator)
+        return iter(indices[self.start_index:].tolist())
+
+    def __len__(self):
+        return self.num_samples - self.start_index
+
+    def state_dict(self, num_consumed=0):
+        # num_consumed: samples of the current epoch consumed since the last seek
+        return {'seed': self.seed, 'epoch': self.epoch, 'start_index': self.start_index + num_consumed}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict['seed']
+        self.seek(state_dict['epoch'], state_dict.get('start_index', 0))
+
+
 class MyCollate:
     def __init__(self, pad_idx):
         self.pad_idx = pad_idx
@@ -68,6 +137,65 @@ class MyCollate:
         return source, target
 
 
+def pack_sequences(sequences, max_len):
+    # all sequences in one flat int32 array, with their offsets and (truncated) lengths
+    lengths = np.array([min(len(seq), max_len) for seq in sequences], dtype=np.int64)
+    offsets = np.zeros(len(sequences), dtype=np.int64)
+    offsets[1:] = np.cumsum([len(seq) for seq in sequences])[:-1]
+    flat = np.concatenate([np.asarray(seq, dtype=np.int32) for seq in sequences]) if len(sequences) > 0 else \
+        np.zeros(0, dtype=np.int32)
+    return flat, offsets, lengths
+
+
+class PackedTextDataset(Dataset):
+    '''
+    Same pairs as TextSamplerDataset, packed in two flat arrays instead of a numpy array per sentence. Items are only
+    indices: batches are gathered straight from the flat arrays by PackedCollate, without a tensor per sentence.
+    '''
+
+    def __init__(self, X, Y, max_len):
+        assert len(X) == len(Y), 'source and target corpora must be aligned'
+        self.max_len = max_len
+        self.src = pack_sequences(X, max_len)
+        self.tgt = pack_sequences(Y, max_len)
+
+    def __len__(self):
+        return len(self.src[2])
+
+    def __getitem__(self, index):
+        return index
+
+
+class PackedCollate:
+    '''
+    Collates a batch of PackedTextDataset indices in one vectorized gather per side: int64 source and target ids padded
+    with pad_idx, and the source mask (src != pad_idx), which is the grid of positions within each sentence, from the
+    same pass. The column grid is built once, batches only allocate their output arrays, as DataLoader workers hand
+    them to the main process in shared memory. Pinning is left to the DataLoader's pin_memory.
+    '''
+
+    def __init__(self, dataset, pad_idx):
+        self.dataset = dataset
+        self.pad_idx = pad_idx
+        self.columns = np.arange(dataset.max_len, dtype=np.int64)
+
+    def gather(self, packed, indices):
+        flat, offsets, lengths = packed
+        lengths = lengths[indices]
+        columns = self.columns[:max(int(lengths.max()), 1)]
+
+        valid = columns[None, :] < lengths[:, None]
+        out = np.full(valid.shape, self.pad_idx, dtype=np.int64)
+        out[valid] = flat[(offsets[indices, None] + columns[None, :])[valid]]
+        return out, valid
+
+    def __call__(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        src, mask = self.gather(self.dataset.src, indices)
+        tgt, _ = self.gather(self.dataset.tgt, indices)
+        return torch.from_numpy(src), torch.from_numpy(tgt), torch.from_numpy(mask)
+
+
 def mpp_generate_postprocessing(tensor_ids, eos_token):
     list_ids = tensor_ids.tolist()[0]
 
@@ -76,4 +204,34 @@ def mpp_generate_postprocessing(tensor_ids, eos_token):
     except ValueError:
         target_index = None
 
-    return tensor_ids[0][:target_index].unsqueeze(0)
\ No newline at end of file
+    return tensor_ids[0][:target_index].unsqueeze(0)
+
+
+def batch_generate_postprocessing(tensor_ids, eos_token):
+    # list of token ids per sequence, cut before the first eos token
+    sequences = []
+    for ids in tensor_ids.tolist():
+        if eos_token in ids:
+            ids = ids[:ids.index(eos_token)]
+        sequences.append(ids)
+    return sequences
+
+
+def length_batches(lengths, max_batch_tokens, max_batch_size):
+    # indices grouped into batches of similar lengths, each at most max_batch_tokens once padded to its longest
+    order = np.argsort(lengths, kind='stable')
+    batches, batch, longest = [], [], 0
+
+    for i in order.tolist():
+        longest_with = max(longest, lengths[i])
+        if len(batch) > 0 and (len(batch) == max_batch_size or (len(batch) + 1) * longest_with > max_batch_tokens):
+            batches.append(batch)
+            batch, longest_with = [], lengths[i]
+
+        batch.append(i)
+        longest = longest_with
+
+    if len(batch) > 0:
+        batches.append(batch)
+
+    return batches